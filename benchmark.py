@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""Benchmarks the collection code against the offline vSphere simulator
+
+For each combination of inventory sizes this generates a synthetic inventory,
+then runs each code path against it in a separate process and reports:
+
+ - wall time, in seconds
+ - number of round trips made to the (simulated) vCenter
+ - peak RSS growth of the process while running the code path
+
+Code paths:
+ - vms_per_vm: `load_all_vms_from_api`
+ - vms_bulk: `load_all_vms_from_property_collector`
+ - files_search: `load_all_files_from_search_api`
+ - files_folders: `load_all_files_from_api`
+ - reconcile: `reconcile.find_unaccounted_files`
+ - files_list: all the files from `load_all_files_from_search_api` held in
+   a list of `DsFile`
+ - files_table: the same held in a `FileTable`
+
+Example: `python benchmark.py --vms 1000 10000 --files 10000 100000`
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+
+from collections import OrderedDict
+from cli_helper import ArgBuilder, host_args
+from reconcile import find_unaccounted_files
+from utils import convert_size
+from vsphere_api import VSphereApi
+from vsphere_objects import FileTable
+from vsphere_sim import SimInventory, sim_connect
+
+PATHS = OrderedDict([
+    ('vms_per_vm', lambda api, inv: len(api.load_all_vms_from_api())),
+    ('vms_bulk', lambda api, inv: len(
+        api.load_all_vms_from_property_collector())),
+    ('files_search', lambda api, inv: sum(
+        1 for f in api.load_all_files_from_search_api())),
+    ('files_folders', lambda api, inv: sum(
+        1 for f in api.load_all_files_from_api())),
+    ('reconcile', lambda api, inv: sum(
+        1 for f in find_unaccounted_files(inv.vms, inv.files))),
+    ('files_list', lambda api, inv: len(
+        list(api.load_all_files_from_search_api()))),
+    ('files_table', lambda api, inv: len(
+        FileTable(api.load_all_files_from_search_api()))),
+])
+
+
+def max_rss():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_path(name, inventory, args, results):
+    """Runs one code path, meant to be run in its own process"""
+    apiArgs = host_args(ArgBuilder().parser.parse_args(
+        ['-H', 'sim', '-u', 'sim', '-p', 'sim',
+         '--max_searches', str(args.max_searches)]), 'sim')
+    si = sim_connect(inventory,
+                     latency=args.latency,
+                     search_latency=args.search_latency,
+                     search_rate=args.search_rate)
+    api = VSphereApi(apiArgs, service_instance=si)
+
+    # logging isn't set up here, so the code paths' progress isn't timed
+    rssBefore = max_rss()
+    start = time.time()
+    count = PATHS[name](api, inventory)
+    secs = time.time() - start
+    rss = max_rss() - rssBefore
+    results.put({
+        'path': name,
+        'vms': len(inventory.vms),
+        'files': len(inventory.files),
+        'records': count,
+        'secs': secs,
+        'round_trips': si._stub.round_trips,
+        'peak_rss': rss,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark collection code against a simulated vCenter')
+    parser.add_argument(
+        '--vms', type=int, nargs='+', default=[1000],
+        help='Number of VMs to generate, pass several to compare')
+    parser.add_argument(
+        '--files', type=int, nargs='+', default=[10000],
+        help='Number of datastore files to generate, pass several to compare')
+    parser.add_argument(
+        '--datastores', type=int, default=4,
+        help='Number of datastores to spread the files over')
+    parser.add_argument(
+        '--paths', nargs='+', default=list(PATHS.keys()),
+        choices=list(PATHS.keys()),
+        help='Code paths to run')
+    parser.add_argument(
+        '--latency', type=float, default=0.001,
+        help='Seconds each simulated request takes')
+    parser.add_argument(
+        '--search_latency', type=float, default=0.0,
+        help='Seconds each simulated datastore search takes')
+    parser.add_argument(
+        '--search_rate', type=float, default=None,
+        help='Files per second a simulated datastore search can search')
+    parser.add_argument(
+        '--max_searches', type=int, default=4,
+        help='Max number of datastore searches to run at once')
+    parser.add_argument(
+        '--json', default=False, action='store_true',
+        help='Output results as json')
+    args = parser.parse_args()
+
+    rows = []
+    for vmCount in args.vms:
+        for fileCount in args.files:
+            inventory = SimInventory.generate(
+                vmCount, fileCount, datastore_count=args.datastores)
+            for name in args.paths:
+                results = multiprocessing.Queue()
+                p = multiprocessing.Process(
+                    target=run_path, args=(name, inventory, args, results))
+                p.start()
+                row = results.get()
+                p.join()
+                rows.append(row)
+                if not args.json:
+                    print("{path:14} {vms:>8} VMs {files:>9} files "
+                          "{secs:>9.2f}s {round_trips:>9} round trips "
+                          "{rss} peak RSS".format(
+                              rss=convert_size(row['peak_rss']), **row))
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+
+
+if __name__ == '__main__':
+    main()
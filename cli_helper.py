@@ -1,17 +1,40 @@
 import argparse
+import copy
 import getpass
+import os.path
+
+from progress import setup_logging
 
 
 class ArgBuilder:
     """
     Builds a standard argument parser with arguments for talking to vCenter
 
-    -h service_host_name_or_ip
+    -H service_host_name_or_ip, repeat for several vCenters
+    --hosts_file optional file listing vCenters, one per line
     -o optional_port_number
     -u required_user
     -p optional_password
     -S skip ssl validation
     -c cache the output in local json files
+    --cache_dir optional directory for the cache, a subdirectory per vCenter
+    --session_cache reuse the vSphere session from the previous run
+    --store cache format, ndjson files or sqlite database
+    --max_age optional age in seconds after which the cache is refetched
+    --refresh_changed refetch cached files only on datastores that changed
+    --delta update cached VMs with just the changes since the last run
+    --crawl search whole datastores or each top level folder, resumably
+    --concurrency optional number of concurrent requests to vSphere
+    --rate optional max requests per second to vSphere
+    --max_searches optional number of concurrent datastore searches
+    --search_timeout optional seconds before a datastore search is cancelled
+    --split_after optional seconds before a search is split into its folders
+    --split_files optional number of files above which a search is split
+    --profile optionally print a profile of requests made to vSphere
+    -v more detailed progress, a line for every VM and file found
+    -q only print warnings and errors
+    --log_file optional file to write detailed progress to
+    --processes optional number of vCenters to collect from at once
     """
     def __init__(self):
         self.args = None
@@ -21,9 +44,18 @@ class ArgBuilder:
         # because -h is reserved for 'help' we use -H for service
         self.parser.add_argument(
             '-H', '--host',
-            required=True,
+            dest='hosts',
+            metavar='HOST',
+            default=[],
+            action='append',
+            help='vSphere service to connect to, repeat to collect from '
+                 'several, as host or host:port')
+
+        self.parser.add_argument(
+            '--hosts_file',
+            default=None,
             action='store',
-            help='vSphere service to connect to')
+            help='File of vSphere services to connect to, one per line')
 
         # because we want -p for password, we use -o for port
         self.parser.add_argument(
@@ -57,6 +89,135 @@ class ArgBuilder:
             action='store_true',
             help='Cache results from vSphere')
 
+        self.parser.add_argument(
+            '--cache_dir',
+            default=None,
+            action='store',
+            help='Directory to keep the cache in, with several vCenters '
+                 'each gets a subdirectory')
+
+        self.parser.add_argument(
+            '--session_cache',
+            default=False,
+            action='store_true',
+            help='Save the vSphere session and reuse it on the next run')
+
+        self.parser.add_argument(
+            '--store',
+            default='ndjson',
+            choices=['ndjson', 'sqlite'],
+            action='store',
+            help='Format of the cache: ndjson files or a sqlite database')
+
+        self.parser.add_argument(
+            '--max_age',
+            type=int,
+            default=None,
+            action='store',
+            help='Refetch cached results older than this many seconds')
+
+        self.parser.add_argument(
+            '--refresh_changed',
+            default=False,
+            action='store_true',
+            help='Refetch cached files for datastores whose usage changed')
+
+        self.parser.add_argument(
+            '--delta',
+            default=False,
+            action='store_true',
+            help='Update cached VMs with just the changes since the last run, '
+                 'best with --session_cache')
+
+        self.parser.add_argument(
+            '--crawl',
+            default='search',
+            choices=['search', 'folders'],
+            action='store',
+            help='Find files with one search per datastore, or one per top '
+                 'level folder which can resume an interrupted crawl')
+
+        self.parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=15,
+            action='store',
+            help='Max number of requests to vSphere to make at once')
+
+        self.parser.add_argument(
+            '--rate',
+            type=float,
+            default=None,
+            action='store',
+            help='Max number of requests to vSphere to make per second')
+
+        self.parser.add_argument(
+            '--max_searches',
+            type=int,
+            default=4,
+            action='store',
+            help='Max number of datastore searches to run at once')
+
+        self.parser.add_argument(
+            '--search_timeout',
+            type=int,
+            default=None,
+            action='store',
+            help='Seconds to wait for a datastore search before giving up')
+
+        self.parser.add_argument(
+            '--split_after',
+            type=int,
+            default=None,
+            action='store',
+            help='Seconds after which a datastore search is cancelled and '
+                 'its folders searched separately, remembered with -c')
+
+        self.parser.add_argument(
+            '--split_files',
+            type=int,
+            default=None,
+            action='store',
+            help='Split searches that find more than this many files on the '
+                 'next run, with -c')
+
+        self.parser.add_argument(
+            '--profile',
+            nargs='?',
+            const='table',
+            default=None,
+            choices=['table', 'json'],
+            help='Print a profile of requests made to vSphere to stderr, '
+                 'as a table or a json trace')
+
+        verbosity = self.parser.add_mutually_exclusive_group()
+        verbosity.add_argument(
+            '-v', '--verbose',
+            default=False,
+            action='store_true',
+            help='Print a line for every VM and file found')
+
+        verbosity.add_argument(
+            '-q', '--quiet',
+            default=False,
+            action='store_true',
+            help='Only print warnings and errors')
+
+        self.parser.add_argument(
+            '--log_file',
+            default=None,
+            action='store',
+            help='Write detailed progress to this file, whatever the '
+                 'verbosity')
+
+        self.parser.add_argument(
+            '--processes',
+            type=int,
+            default=8,
+            action='store',
+            help='Max number of vCenters to collect from at once, each in '
+                 'its own process')
+
     def prompt_for_password(self):
         """
         if no password is specified on the command line, prompt for it
@@ -64,7 +225,7 @@ class ArgBuilder:
         if not self.args.password:
             self.args.password = getpass.getpass(
                 prompt='Enter password for host %s and user %s: ' %
-                       (self.args.host, self.args.user))
+                       (', '.join(self.args.hosts), self.args.user))
         return self.args
 
     def add_argument(self, *args, **kwargs):
@@ -76,4 +237,41 @@ class ArgBuilder:
         to vSphere.
         """
         self.args = self.parser.parse_args()
+        self.args.hosts = read_hosts(self.args)
+        if not self.args.hosts:
+            self.parser.error('-H or --hosts_file is required')
+        setup_logging(self.args)
         return self.prompt_for_password()
+
+
+def read_hosts(args):
+    """Lists the vCenters from `-H` and `--hosts_file`, without duplicates
+
+    The file has a host, or host:port, per line.  Blank lines and lines
+    starting with `#` are skipped.
+    """
+    hosts = list(args.hosts)
+    if args.hosts_file:
+        with open(args.hosts_file) as fp:
+            hosts.extend(line.strip() for line in fp)
+    unique = []
+    for host in hosts:
+        if host and not host.startswith('#') and host not in unique:
+            unique.append(host)
+    return unique
+
+
+def host_args(args, host):
+    """Returns a copy of `args` for collecting from one vCenter
+
+    `host` can include the port, as host:port.  When collecting from
+    several vCenters, each one is cached in its own subdirectory of
+    `--cache_dir`.
+    """
+    hostArgs = copy.copy(args)
+    hostArgs.host, _, port = host.partition(':')
+    if port:
+        hostArgs.port = int(port)
+    if len(args.hosts) > 1 and args.cache:
+        hostArgs.cache_dir = os.path.join(args.cache_dir or '', host)
+    return hostArgs
@@ -0,0 +1,123 @@
+"""Runs blocking vSphere calls concurrently
+
+Every call to vSphere blocks until the SOAP response comes back, so to
+collect a lot of objects quickly we need to have many calls in flight at
+once.  The `Collector` runs a function over a list of items on a bounded
+pool of worker threads and hands back the results as they complete.  If the
+function raises, the exception is passed back to the caller rather than
+killing the worker.
+
+The `TokenBucket` limits how many requests per second are made, so that a
+large collection doesn't trip vCenter's request throttling.
+"""
+import sys
+import threading
+import time
+
+import six
+from Queue import Queue, Empty
+from threading import Thread
+
+
+class Collector:
+    def __init__(self, concurrency=15):
+        self.concurrency = concurrency
+
+    def map(self, func, items, concurrency=None, return_exceptions=False):
+        """Calls `func` on each item, yielding results as they complete
+
+        At most `concurrency` calls run at once, defaulting to the
+        collector's setting.  If a call raises, the exception is re-raised
+        here and any calls that haven't started yet are skipped.  With
+        `return_exceptions` the exception is yielded as the result instead
+        and all the items are still processed, unless it's not an
+        `Exception`, like `KeyboardInterrupt`, which is always re-raised.
+        """
+        items = list(items)
+        work = Queue()
+        for item in items:
+            work.put(item)
+        results = Queue()
+        stop = threading.Event()
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    item = work.get_nowait()
+                except Empty:
+                    return
+                try:
+                    results.put((True, func(item), None))
+                except BaseException as e:
+                    # a result is always posted, or the caller waits for it
+                    #  forever
+                    results.put((False, e, sys.exc_info()[2]))
+
+        threads = []
+        for i in range(min(concurrency or self.concurrency, len(items))):
+            t = Thread(target=worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        try:
+            for i in range(len(items)):
+                ok, result, tb = results.get()
+                if ok or return_exceptions and isinstance(result, Exception):
+                    yield result
+                else:
+                    six.reraise(type(result), result, tb)
+        finally:
+            # let the workers finish what they're doing, but nothing more
+            stop.set()
+            [th.join() for th in threads]
+
+
+class TokenBucket:
+    """Limits requests to `rate` per second, allowing bursts of `burst`"""
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request can be made"""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def rate_limit_stub(stub, bucket):
+    """Hooks into a pyVmomi stub so each request waits on `bucket`
+
+    Property accesses are made by the stub as a property collector request,
+    these only wait once.
+    """
+    local = threading.local()
+    invokeMethod = stub.InvokeMethod
+    invokeAccessor = stub.InvokeAccessor
+
+    def limited(func, *args):
+        if getattr(local, 'depth', 0):
+            return func(*args)
+        bucket.acquire()
+        local.depth = 1
+        try:
+            return func(*args)
+        finally:
+            local.depth = 0
+
+    stub.InvokeMethod = lambda mo, info, args, *rest: limited(
+        invokeMethod, mo, info, args, *rest)
+    stub.InvokeAccessor = lambda mo, info: limited(
+        invokeAccessor, mo, info)
@@ -0,0 +1,131 @@
+"""Collects from several vCenters at once, each in its own process
+
+Each vCenter gets a worker process with its own vSphere session, cache and
+thread pools, so a slow or large vCenter doesn't hold up the others and the
+collection work (parsing SOAP responses, matching files to VMs) is spread
+over the CPUs rather than sharing one Python interpreter.
+
+The function run for each vCenter gets a copy of the arguments for just
+that vCenter (see `cli_helper.host_args`) and should return something
+small that can be pickled, like unaccounted folders or a rollup dict,
+which the caller merges.  With a single vCenter the function is run in
+this process.  `stream` does the same for a generator, passing its records
+back to the caller in batches as they're found.
+"""
+import multiprocessing
+
+from cli_helper import host_args
+from progress import log, tag_logging
+
+
+# records are passed back from `stream` workers in batches of this many
+BATCH_SIZE = 500
+
+
+class CollectionError(Exception):
+    """None of the vCenters could be collected from"""
+    pass
+
+
+def _run(task):
+    func, args = task
+    tag_logging(args.host)
+    try:
+        return args.host, func(args), None
+    except Exception as e:
+        # the exception may not survive pickling, so pass back the message
+        log.exception("Failed to collect")
+        return args.host, None, str(e) or type(e).__name__
+
+
+def collect(args, func):
+    """Calls `func` with the arguments for each vCenter in `args.hosts`
+
+    Returns a list of (vCenter, result) in the order the vCenters were
+    given.  vCenters that fail are logged and left out, if they all fail
+    a `CollectionError` is raised.
+    """
+    tasks = [(func, host_args(args, host)) for host in args.hosts]
+    if len(tasks) == 1:
+        func, hostArgs = tasks[0]
+        return [(hostArgs.host, func(hostArgs))]
+
+    # a fresh process for each vCenter, so nothing is shared between them
+    pool = multiprocessing.Pool(min(args.processes, len(tasks)),
+                                maxtasksperchild=1)
+    try:
+        # a timeout on get() keeps the main process responsive to Ctrl-C
+        done = pool.map_async(_run, tasks, chunksize=1).get(2 ** 31)
+    finally:
+        pool.terminate()
+
+    failed = [(host, error) for (host, result, error) in done if error]
+    for host, error in failed:
+        log.error("Couldn't collect from %s: %s", host, error)
+    if len(failed) == len(done):
+        raise CollectionError("Couldn't collect from any vCenter")
+    return [(host, result) for (host, result, error) in done if not error]
+
+
+def _stream(task):
+    func, args, queue = task
+    tag_logging(args.host)
+    error = None
+    try:
+        batch = []
+        for record in func(args):
+            batch.append(record)
+            if len(batch) >= BATCH_SIZE:
+                queue.put((args.host, batch, None))
+                batch = []
+        queue.put((args.host, batch, None))
+    except Exception as e:
+        log.exception("Failed to collect")
+        error = str(e) or type(e).__name__
+    # None rather than a batch marks the end of this vCenter's records
+    queue.put((args.host, None, error))
+
+
+def stream(args, func):
+    """Yields (vCenter, record) for each record `func` yields, as it's found
+
+    Like `collect`, but `func` is a generator and its records are passed
+    back while it's still running, so the caller can write them out before
+    the collection is finished.  Records from the vCenters are mixed
+    together in the order they come in.  vCenters that fail are logged, if
+    they all fail a `CollectionError` is raised once the records from the
+    others are yielded.
+    """
+    tasks = [(func, host_args(args, host)) for host in args.hosts]
+    if len(tasks) == 1:
+        func, hostArgs = tasks[0]
+        for record in func(hostArgs):
+            yield hostArgs.host, record
+        return
+
+    manager = multiprocessing.Manager()
+    # bounded, so the workers wait for the caller rather than pile up
+    #  records in memory
+    queue = manager.Queue(args.processes * 4)
+    pool = multiprocessing.Pool(min(args.processes, len(tasks)),
+                                maxtasksperchild=1)
+    try:
+        pool.map_async(_stream, [(func, hostArgs, queue)
+                                 for func, hostArgs in tasks], chunksize=1)
+        failed = []
+        running = len(tasks)
+        while running:
+            host, records, error = queue.get()
+            if records is None:
+                running -= 1
+                if error:
+                    log.error("Couldn't collect from %s: %s", host, error)
+                    failed.append(host)
+                continue
+            for record in records:
+                yield host, record
+    finally:
+        pool.terminate()
+        manager.shutdown()
+    if len(failed) == len(tasks):
+        raise CollectionError("Couldn't collect from any vCenter")
@@ -19,14 +19,40 @@ still active too.
 At the end of the script, anything not marked active is considered abandoned.
 The script will print out a list of these files and the file sizes so that you
 can get a picture for how much space is being consumed by abandoned files.
+
+Several vCenters, given with `-H` more than once or in `--hosts_file`, are
+searched at once.  Each vCenter's files are only matched against its own
+VMs, then the folders are reported together, each starting with its
+vCenter, or with `--per_vcenter` in a separate report for each vCenter.
+
+Only the files that could be reported are searched for: vSphere is asked for
+just the files matching `--match`, if given, and folders on the ignore list
+are left out of the search where they can be.
+
+With `--format`, rather than the report, each unaccounted file is written as
+a record as soon as it's found, see `writers`.
+
+Files are matched to the VMs a datastore at a time in a pool of processes,
+up to `--match_processes`, and each folder is put in its category as it's
+matched, so the local work spreads over the cores.
+
+With `--snapshot`, every file and the disk usage are also saved in a dated
+snapshot, so `snapshot_diff.py` can show what's changed between runs.  It
+turns on the cache, `-c`, so the report uses the files the snapshot searched
+rather than searching the datastores again.
 """
 from __future__ import print_function
 
 import os.path
 
-from collections import defaultdict
 from vsphere_api import VSphereApi
 from cli_helper import ArgBuilder
+from fanout import collect, stream
+from progress import log
+from reconcile import FOLDER_CATEGORIES, FolderSummary
+from writers import add_arguments, open_writer
+
+FILE_FIELDS = ['vcenter', 'datastore', 'folder', 'file', 'size']
 
 
 def parse_ignore_list(args):
@@ -34,12 +60,71 @@ def parse_ignore_list(args):
         args.ignore = []
     if args.ignore_path:
         if not os.path.exists(args.ignore_path):
-            print("[WARNING] ignore file does not exist, skipping")
+            log.warning("ignore file does not exist, skipping")
         else:
             lines = open(args.ignore_path, 'r').readlines()
             args.ignore.extend([line.strip() for line in lines])
 
 
+def parse_snapshot(args):
+    # the report reads the files searched for the snapshot from the cache
+    if args.snapshot:
+        args.cache = True
+
+
+def collect_unaccounted(args):
+    """Summarises the folders in one vCenter that aren't accounted for"""
+    try:
+        vApi = None
+        vApi = VSphereApi(args)
+        if args.snapshot:
+            vApi.save_snapshot()
+
+        # only the folder names of each category come back from matching
+        return vApi.summarize_unaccounted_folders(
+            args.ignore, args.match, args.match_processes)
+    finally:
+        if vApi:
+            vApi.close()
+            if vApi.profiler:
+                vApi.profiler.report(args.profile)
+
+
+def unaccounted_records(args):
+    """Yields a record for each file in one vCenter not accounted for"""
+    try:
+        vApi = None
+        vApi = VSphereApi(args)
+        if args.snapshot:
+            vApi.save_snapshot()
+        for f in vApi.iter_unaccounted_files(args.ignore, args.match):
+            yield {'vcenter': args.host,
+                   'datastore': f.datastore,
+                   'folder': f.pathTo,
+                   'file': f.fileName,
+                   'size': f.size}
+    finally:
+        if vApi:
+            vApi.close()
+            if vApi.profiler:
+                vApi.profiler.report(args.profile)
+
+
+def print_report(summary):
+    print()
+    print("Unaccounted file count [{}]".format(summary.checked))
+    print("Removing known VMs from the list...")
+    print()
+    print("Found {} files that are unaccounted.".format(summary.files))
+    print("Investigating the remaining files...")
+
+    for category, title in FOLDER_CATEGORIES.items():
+        print("  {}...".format(title))
+        for folder in summary.categories[category]:
+            print("    {}".format(folder))
+        print("  ... count = {}".format(len(summary.categories[category])))
+
+
 def main():
     ab = ArgBuilder()
     ab.add_argument(
@@ -52,86 +137,57 @@ def main():
         required=False,
         action='store',
         help='path to a file of directories to ignore')
+    ab.add_argument(
+        '-m', '--match',
+        required=False,
+        action='append',
+        help='only look for files with names matching this pattern, like '
+             '*.vmdk, repeat for more')
+    ab.add_argument(
+        '--per_vcenter',
+        default=False,
+        action='store_true',
+        help='Report on each vCenter separately')
+    ab.add_argument(
+        '--match_processes',
+        type=int,
+        default=None,
+        action='store',
+        help='Max number of processes matching files to VMs, one datastore '
+             'each, by default one per core')
+    ab.add_argument(
+        '--snapshot',
+        default=False,
+        action='store_true',
+        help='Also save a dated snapshot of all the files and disk usage to '
+             'compare with snapshot_diff.py, turns on -c')
+    add_arguments(ab)
     args = ab.process_args()
     parse_ignore_list(args)
-
-    try:
-        vApi = None
-        vApi = VSphereApi(args)
-
-        files = vApi.list_all_files()
-        vms = vApi.list_all_vms()
-
-        # skip certain files
-        files = [f for f in files
-                 if not any([f.pathTo.find(s) != -1 for s in args.ignore])]
-
-        print()
-        print("Unaccounted file count [{}]".format(len(files)))
-        print("Removing known VMs from the list...")
-        for vm in vms:
-            newFiles = []
-            for f in files:
-                # remove paths starting with VM name
-                if f.pathTo == '[{}] {}/'.format(f.datastore, vm.name):
-                    continue
-                # remove other references to VM files
-                vmDisksLoc = vm.path.split('/')[0]
-                if f.pathTo == '{}/'.format(vmDisksLoc):
-                    continue
-                # remove attached disks
-                if any([os.path.join(f.pathTo, f.fileName) == disk.path
-                        for disk in vm.disks]):
-                    continue
-                newFiles.append(f)
-            files = newFiles
-
-        print()
-        print("Found {} files that are unaccounted.".format(len(files)))
-        print("Investigating the remaining files...")
-        folders = defaultdict(list)
-        for f in files:
-            folders[f.pathTo].append(f.fileName)
-
-        # if file count is two, check if files are env.iso and env.json
-        print("  Folders with only `env.json` and `env.iso`...")
-        twoFileCnt = 0
-        for k, v in folders.items():
-            if len(v) == 2 and 'env.iso' in v and 'env.json' in v:
-                print("    {}".format(k))
-                twoFileCnt += 1
-        print("  ... count = {}".format(twoFileCnt))
-
-        print("  Folders with one file...")
-        oneFileCnt = 0
-        for k, v in folders.items():
-            if len(v) == 1:
-                print("    {}".format(k))
-                oneFileCnt += 1
-        print("  ... count = {}".format(oneFileCnt))
-
-        print("  Folders that are empty...")
-        emptyCnt = 0
-        for k, v in folders.items():
-            if len(v) == 0:
-                print("    {}".format(k))
-                emptyCnt += 1
-        print("  ... count = {}".format(emptyCnt))
-
-        print("  Folders with more than two files...")
-        moreThanTwoCnt = 0
-        for k, v in folders.items():
-            if len(v) > 2:
-                print("    {}".format(k))
-                moreThanTwoCnt += 1
-        print("  ... count = {}".format(moreThanTwoCnt))
-
-        # TODO: just like VM folders, the persistent disk folders are listed
-        #        under two different names.  One is a id of sorts and the
-        #        other is a friendly name.
-    finally:
-        if vApi:
-            vApi.close()
+    parse_snapshot(args)
+
+    writer = open_writer(args, FILE_FIELDS)
+    if writer:
+        with writer:
+            for vcenter, record in stream(args, unaccounted_records):
+                writer.write(record)
+        return
+
+    results = collect(args, collect_unaccounted)
+
+    if args.per_vcenter:
+        for vcenter, summary in results:
+            print()
+            print("vCenter {}:".format(vcenter))
+            print_report(summary)
+    elif len(results) == 1:
+        print_report(results[0][1])
+    else:
+        # datastore names are only unique within a vCenter
+        merged = FolderSummary()
+        for vcenter, summary in results:
+            merged.merge(summary, prefix=vcenter)
+        print_report(merged)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,245 @@
+"""Records where the time goes when talking to vSphere
+
+The `Profiler` hooks into the pyVmomi stub, the object through which every
+method call and property access on a managed object becomes a SOAP request.
+For each request it records the vSphere method (or `get:<property>` for
+property accesses), how long it took, how many bytes went each way and which
+phase of the run it was made in.  Phases are the `VSphereApi` methods, see
+`Profiler.wrap_phase`.
+
+At the end of a run, `report` prints either a summary table per phase and
+per method with a latency histogram, or a json trace of every request.
+"""
+from __future__ import print_function
+
+import inspect
+import json
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from utils import convert_size
+
+# upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, None]
+
+
+class Stats:
+    def __init__(self):
+        self.requests = 0
+        self.secs = 0.0
+        self.sent = 0
+        self.received = 0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, secs, sent, received):
+        self.requests += 1
+        self.secs += secs
+        self.sent += sent
+        self.received += received
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if bound is None or secs <= bound:
+                self.histogram[i] += 1
+                break
+
+    def to_dict(self):
+        return OrderedDict([
+            ('requests', self.requests),
+            ('secs', self.secs),
+            ('bytes_sent', self.sent),
+            ('bytes_received', self.received),
+            ('histogram', self.histogram),
+        ])
+
+
+class _CountingResponse(object):
+    """Wraps an HTTP response to count the bytes read from it"""
+    def __init__(self, resp, counter):
+        self._resp = resp
+        self._counter = counter
+
+    def read(self, *args):
+        data = self._resp.read(*args)
+        self._counter(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._resp, name)
+
+
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.events = []
+        self.methods = OrderedDict()
+        self.phases = OrderedDict()
+        self.phaseSecs = OrderedDict()
+        # phases are shared by all threads, the worker threads make
+        #  requests on behalf of whichever phase started them
+        self.phaseStack = []
+
+    def current_phase(self):
+        return self.phaseStack[-1] if self.phaseStack else 'other'
+
+    def record(self, method, start, secs, sent=0, received=0):
+        phase = self.current_phase()
+        with self.lock:
+            self.events.append(OrderedDict([
+                ('phase', phase),
+                ('method', method),
+                ('start', start - self.started),
+                ('secs', secs),
+                ('bytes_sent', sent),
+                ('bytes_received', received),
+                ('thread', threading.current_thread().name),
+            ]))
+            self.methods.setdefault(method, Stats()).add(secs, sent, received)
+            self.phases.setdefault(phase, Stats()).add(secs, sent, received)
+
+    def _enter_phase(self, name):
+        self.phaseStack.append(name)
+        return time.time()
+
+    def _exit_phase(self, name, start):
+        self.phaseStack.pop()
+        with self.lock:
+            self.phaseSecs[name] = self.phaseSecs.get(name, 0.0) + \
+                time.time() - start
+
+    def wrap_phase(self, name, func):
+        """Wraps `func` so that requests made while it runs are in `name`
+
+        Generators are wrapped so that only the time spent producing each
+        item counts towards the phase, not the time the caller spends
+        between items.
+        """
+        def wrapper(*args, **kwargs):
+            start = self._enter_phase(name)
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                self._exit_phase(name, start)
+            if inspect.isgenerator(result):
+                return self._wrap_generator(name, result)
+            return result
+        return wrapper
+
+    def _wrap_generator(self, name, gen):
+        while True:
+            start = self._enter_phase(name)
+            try:
+                item = next(gen)
+            except StopIteration:
+                return
+            finally:
+                self._exit_phase(name, start)
+            yield item
+
+    def instrument_stub(self, stub):
+        """Hooks into a pyVmomi stub so every request is recorded
+
+        Property accesses are made by the stub as property collector
+        requests, these are recorded once as `get:<property>` rather than
+        as the request underneath.  Byte counts are only available for real
+        SOAP stubs.
+        """
+        invokeMethod = stub.InvokeMethod
+        invokeAccessor = stub.InvokeAccessor
+
+        def timed(name, func, *args):
+            local = self.local
+            if getattr(local, 'depth', 0):
+                return func(*args)
+            local.depth = 1
+            local.sent = local.received = 0
+            start = time.time()
+            try:
+                return func(*args)
+            finally:
+                local.depth = 0
+                self.record(name, start, time.time() - start,
+                            local.sent, local.received)
+
+        stub.InvokeMethod = lambda mo, info, args, *rest: timed(
+            info.wsdlName, invokeMethod, mo, info, args, *rest)
+        stub.InvokeAccessor = lambda mo, info: timed(
+            'get:' + info.name, invokeAccessor, mo, info)
+
+        if hasattr(stub, 'SerializeRequest'):
+            serializeRequest = stub.SerializeRequest
+
+            def count_sent(*args):
+                req = serializeRequest(*args)
+                self.local.sent = getattr(self.local, 'sent', 0) + len(req)
+                return req
+            stub.SerializeRequest = count_sent
+
+        if hasattr(stub, 'GetConnection'):
+            getConnection = stub.GetConnection
+
+            def count_received(n):
+                self.local.received = getattr(self.local, 'received', 0) + n
+
+            def get_connection():
+                conn = getConnection()
+                if not getattr(conn, '_profiled', False):
+                    getResponse = conn.getresponse
+                    conn.getresponse = lambda: _CountingResponse(
+                        getResponse(), count_received)
+                    conn._profiled = True
+                return conn
+            stub.GetConnection = get_connection
+
+    def summary(self):
+        return OrderedDict([
+            ('secs', time.time() - self.started),
+            ('phases', OrderedDict(
+                (name, dict(stats.to_dict(),
+                            wall_secs=self.phaseSecs.get(name)))
+                for name, stats in self.phases.items())),
+            ('methods', OrderedDict(
+                (name, stats.to_dict())
+                for name, stats in self.methods.items())),
+        ])
+
+    def report(self, fmt='table', out=None):
+        """Prints the profile as a `table` or a `json` trace"""
+        out = out or sys.stderr
+        if fmt == 'json':
+            json.dump(OrderedDict([('summary', self.summary()),
+                                   ('requests', self.events)]),
+                      out, indent=2)
+            print(file=out)
+            return
+
+        print("Profile ({:.2f} secs total):".format(
+            time.time() - self.started), file=out)
+        print("  By phase:", file=out)
+        names = list(self.phaseSecs.keys()) + \
+            [name for name in self.phases if name not in self.phaseSecs]
+        for name in names:
+            stats = self.phases.get(name, Stats())
+            wall = self.phaseSecs.get(name)
+            print("    {:40} {:>9} wall {:>8} reqs {:>9.2f}s in "
+                  "requests".format(
+                      name, '{:.2f}s'.format(wall) if wall else '-',
+                      stats.requests, stats.secs), file=out)
+
+        labels = ['<{}ms'.format(int(b * 1000)) if b else
+                  '>{}s'.format(int(LATENCY_BUCKETS[-2]))
+                  for b in LATENCY_BUCKETS]
+        print("  By method:", file=out)
+        print("    {:40} {:>8} {:>10} {:>10} {:>10}   {}".format(
+            'method', 'reqs', 'secs', 'sent', 'received', ' '.join(labels)),
+            file=out)
+        for name, stats in sorted(self.methods.items(),
+                                  key=lambda item: -item[1].secs):
+            histogram = ' '.join(str(n).rjust(len(label)) for n, label
+                                 in zip(stats.histogram, labels))
+            print("    {:40} {:>8} {:>9.2f}s {:>10} {:>10}   {}".format(
+                name, stats.requests, stats.secs,
+                convert_size(stats.sent), convert_size(stats.received),
+                histogram), file=out)
@@ -0,0 +1,141 @@
+"""Logging and progress reporting
+
+Status messages go through the `logging` module rather than `print`, so the
+report on stdout isn't drowned out and messages about every VM and file can
+be turned on when they're wanted.  Messages go to stderr:
+
+ - by default, progress and warnings
+ - with `-q`, just warnings and errors
+ - with `-v`, also a line for every VM and file found
+
+`--log_file` writes everything, including the per-record detail, to a file
+regardless of the console level.
+
+Loops that handle lots of records should use `Progress`, which logs a
+summary line with counts, rate and ETA at most every few seconds rather
+than a line per record.
+"""
+import logging
+import threading
+import time
+
+import six
+
+LOGGER_NAME = 'vsphere_reporting'
+# minimum seconds between progress lines
+PROGRESS_INTERVAL = 5.0
+
+log = logging.getLogger(LOGGER_NAME)
+# stays quiet until `setup_logging` is called, e.g. when run by `benchmark`
+log.addHandler(logging.NullHandler())
+
+
+def setup_logging(args):
+    """Configures logging from the `-v`, `-q` and `--log_file` arguments"""
+    level = logging.INFO
+    if args.quiet:
+        level = logging.WARNING
+    elif args.verbose:
+        level = logging.DEBUG
+
+    log.setLevel(logging.DEBUG if args.log_file else level)
+    log.propagate = False
+    console = logging.StreamHandler()
+    console.setLevel(level)
+    console.setFormatter(logging.Formatter('%(message)s'))
+    log.addHandler(console)
+
+    if args.log_file:
+        debug = logging.FileHandler(args.log_file)
+        debug.setLevel(logging.DEBUG)
+        debug.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s [%(threadName)s] %(message)s'))
+        log.addHandler(debug)
+
+
+class _TagFilter(logging.Filter):
+    def __init__(self, tag):
+        logging.Filter.__init__(self)
+        self.prefix = tag.replace('%', '%%') + ': '
+
+    def filter(self, record):
+        msg = record.msg
+        if not isinstance(msg, six.string_types):
+            msg = str(msg)
+        # unicode messages, e.g. with a VM's name, stay unicode
+        record.msg = self.prefix + msg
+        return True
+
+
+def tag_logging(tag):
+    """Starts every message with `tag`, e.g. the vCenter it's about"""
+    for f in log.filters[:]:
+        if isinstance(f, _TagFilter):
+            log.removeFilter(f)
+    log.addFilter(_TagFilter(tag))
+
+
+def format_secs(secs):
+    secs = int(secs)
+    if secs < 60:
+        return '{}s'.format(secs)
+    if secs < 3600:
+        return '{}m{:02}s'.format(secs // 60, secs % 60)
+    return '{}h{:02}m'.format(secs // 3600, secs % 3600 // 60)
+
+
+class Progress:
+    """Logs the progress of a long running loop, at most every `interval`
+
+    Counts units of work `done` out of an optional `total`, from which the
+    ETA is estimated.  It can also count `items` found along the way, for
+    example files found while searching datastores.  Safe to update from
+    several threads.
+    """
+    def __init__(self, what, total=None, items=None,
+                 interval=PROGRESS_INTERVAL, logger=log):
+        self.what = what
+        self.total = total
+        self.items = items
+        self.interval = interval
+        self.logger = logger
+        self.done = 0
+        self.found = 0
+        self.started = self.logged = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, done=1, items=0):
+        with self.lock:
+            self.done += done
+            self.found += items
+            now = time.time()
+            if now - self.logged < self.interval:
+                return
+            self.logged = now
+        self._log(now)
+
+    def iterate(self, iterable):
+        """Yields from `iterable`, counting each item as done"""
+        for item in iterable:
+            yield item
+            self.update()
+
+    def finish(self):
+        self._log(time.time(), finished=True)
+
+    def _log(self, now, finished=False):
+        elapsed = max(now - self.started, 0.001)
+        msg = '{}: {:,}'.format(self.what, self.done)
+        if self.total is not None:
+            msg += '/{:,}'.format(self.total)
+        count = self.done
+        if self.items:
+            msg += ', {:,} {}'.format(self.found, self.items)
+            count = self.found
+        msg += ' ({:,.0f}/s)'.format(count / elapsed)
+        if finished:
+            msg += ' in {}'.format(format_secs(elapsed))
+        elif self.total and self.done:
+            msg += ', ETA {}'.format(format_secs(
+                elapsed / self.done * (self.total - self.done)))
+        self.logger.info(msg)
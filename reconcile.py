@@ -0,0 +1,366 @@
+"""Matches datastore files against the VMs that are known to vSphere
+
+The original approach compared every file against every VM, which is
+O(VMs x files).  Here we build a few lookup sets from the list of VMs in one
+pass, then each file can be checked with constant time lookups so that the
+whole reconciliation is O(VMs + files).
+
+On vSAN and VVol datastores each top level folder is listed twice, once
+under its friendly name and once under its UUID, and vSphere may give a
+VM's paths in either form.  `FolderAliases` maps between the two so that
+files are only crawled once and still match the VMs they belong to.
+
+For the report of abandoned folders, files are split into shards by
+datastore and each shard is matched and its folders summarised in a pool of
+processes, see `summarize_unaccounted`.  A folder is only ever on one
+datastore, so shards never share folders and their summaries just add up.
+"""
+import fnmatch
+import multiprocessing
+import os.path
+from collections import OrderedDict, defaultdict
+
+
+def vm_home(vm):
+    """The folder holding a VM's configuration, i.e. `[ds] folder/`"""
+    return '{}/'.format(vm.path.split('/')[0])
+
+
+def file_path(f):
+    """The full datastore path of a file, i.e. `[ds] folder/file.vmdk`"""
+    return os.path.join(f.pathTo, f.fileName)
+
+
+def folder_name(pathTo, prefix):
+    """The name of `pathTo` if it's a folder directly under `prefix`
+
+    `prefix` is the root of a datastore, i.e. `[ds] `.  Returns None when
+    `pathTo` is somewhere else.
+    """
+    if pathTo.startswith(prefix) and pathTo.endswith('/'):
+        return pathTo[len(prefix):-1]
+    return None
+
+
+def top_folder(path):
+    """The top level folder of a datastore path, i.e. `[ds] folder/`
+
+    Returns None for paths that aren't in a folder.
+    """
+    i = path.find('/')
+    return path[:i + 1] if i != -1 else None
+
+
+class FileFilter:
+    """Which files a report needs, so searches can leave out the rest
+
+    `match` are patterns of file names, like `*.vmdk`, and files in
+    folders whose path contains any of the strings in `ignore` are left out.
+    Searches pass `match` to vSphere as the search's `matchPattern`, so
+    other files are never sent, and leave out ignored folders before
+    they're searched where they can.  Files that get through anyway are
+    left out by `accepts`.
+    """
+    def __init__(self, match=(), ignore=()):
+        self.match = sorted(set(match or ()))
+        # an empty string would ignore everything
+        self.ignore = sorted(set(s for s in ignore or () if s))
+
+    def __nonzero__(self):
+        return bool(self.match or self.ignore)
+    __bool__ = __nonzero__
+
+    def is_ignored(self, pathTo):
+        return any(pathTo.find(s) != -1 for s in self.ignore)
+
+    def matches(self, fileName):
+        return not self.match or \
+            any(fnmatch.fnmatchcase(fileName, p) for p in self.match)
+
+    def accepts(self, f):
+        return self.matches(f.fileName) and not self.is_ignored(f.pathTo)
+
+    def covers(self, other):
+        """Checks if the files kept by `other` are all kept by this filter
+
+        i.e. if files searched with this filter can be used for `other`.
+        """
+        return (not self.match or
+                bool(other.match) and set(other.match) <= set(self.match)) \
+            and set(self.ignore) <= set(other.ignore)
+
+    def to_dict(self):
+        return {'match': self.match, 'ignore': self.ignore}
+
+    @classmethod
+    def from_dict(cls, d):
+        """Loads a filter saved with `to_dict`, None is no filter"""
+        return cls(**d) if d else cls()
+
+
+class FolderAliases:
+    """Maps the friendly names of top level folders to their UUIDs
+
+    vSAN and VVol datastores store each VM's folder as an object named by
+    a UUID, and list a link to it under a friendly name.  A search of the
+    datastore lists the folder's files under both names.  The listing of the
+    datastore's root tells us which is which, the UUID entry comes back with
+    its `friendlyName` set.
+
+    Aliases are kept as pairs of top level folders, i.e. `[ds] name/` and
+    `[ds] uuid/`, so that converting a path takes one lookup.  The friendly
+    name is the canonical form, that's what folders are called in reports
+    and what's matched against VM names.
+    """
+    def __init__(self, aliases=None):
+        self.by_uuid = {}
+        self.by_name = {}
+        # UUID folders that are also listed by their friendly name
+        self.duplicates = set()
+        for datastore, folders in (aliases or {}).items():
+            for uuid, name in folders.items():
+                self.add(datastore, uuid, name)
+
+    def __len__(self):
+        return len(self.by_uuid)
+
+    def add(self, datastore, uuid, name):
+        uuidFolder = '[{}] {}/'.format(datastore, uuid)
+        nameFolder = '[{}] {}/'.format(datastore, name)
+        self.by_uuid[uuidFolder] = nameFolder
+        self.by_name[nameFolder] = uuidFolder
+
+    def add_root_listing(self, datastore, infos):
+        """Records the aliases in a listing of a datastore's root folder
+
+        `infos` are the `FileInfo` of each entry in the root folder.
+        Returns the names of the folders that need to be searched, which
+        leaves out the UUID of any folder that's also listed by its friendly
+        name.
+        """
+        names = set(f.path for f in infos)
+        folders = []
+        for f in infos:
+            name = getattr(f, 'friendlyName', None)
+            if name and name != f.path:
+                self.add(datastore, f.path, name)
+                if name in names:
+                    self.duplicates.add('[{}] {}/'.format(datastore, f.path))
+                    continue
+            folders.append(f.path)
+        return folders
+
+    def is_duplicate(self, pathTo):
+        """Checks if `pathTo` is in a UUID folder also listed by name"""
+        return bool(self.duplicates) and top_folder(pathTo) in self.duplicates
+
+    def canonical(self, path):
+        """Converts a path in a UUID folder to use the friendly name"""
+        folder = top_folder(path)
+        name = self.by_uuid.get(folder) if folder else None
+        return name + path[len(folder):] if name else path
+
+    def uuid_path(self, path):
+        """Converts a path in a named folder to use the UUID, if it has one"""
+        folder = top_folder(path)
+        uuid = self.by_name.get(folder) if folder else None
+        return uuid + path[len(folder):] if uuid else None
+
+    def forget(self, datastores):
+        for uuidFolder, nameFolder in list(self.by_uuid.items()):
+            if uuidFolder[1:uuidFolder.index(']')] in datastores:
+                del self.by_uuid[uuidFolder]
+                del self.by_name[nameFolder]
+                self.duplicates.discard(uuidFolder)
+
+    def to_dict(self):
+        """Returns the aliases as datastore -> {uuid: name}"""
+        aliases = {}
+        for uuidFolder, nameFolder in self.by_uuid.items():
+            i = uuidFolder.index('] ')
+            aliases.setdefault(uuidFolder[1:i], {})[
+                uuidFolder[i + 2:-1]] = nameFolder[i + 2:-1]
+        return aliases
+
+
+class VmIndex:
+    """Lookup tables for the datastore paths that belong to known VMs
+
+    A file is considered accounted for when any of the following is true:
+
+     - it lives in a top level folder named after a VM, on any datastore
+     - it lives in the folder that holds a VM's configuration (`vmx`)
+     - it is a disk attached to a VM, regardless of where it lives
+
+    Files are expected to be in the canonical form given by `aliases`,
+    VM paths can be in either form.  `aliases` may still be filling up as
+    files are checked, so the files' paths are converted rather than the
+    VMs'.
+    """
+    def __init__(self, vms, aliases=None):
+        self.aliases = aliases if aliases is not None else FolderAliases()
+        self.vm_names = set()
+        self.vm_homes = set()
+        self.disk_paths = set()
+        for vm in vms:
+            self.vm_names.add(vm.name)
+            self.vm_homes.add(vm_home(vm))
+            for disk in vm.disks:
+                self.disk_paths.add(disk.path)
+        self._ds_prefixes = {}
+
+    def _ds_prefix(self, datastore):
+        # formatting the prefix is cheap, but there are only a handful of
+        #  datastores and millions of files so remember them
+        prefix = self._ds_prefixes.get(datastore)
+        if prefix is None:
+            prefix = '[{}] '.format(datastore)
+            self._ds_prefixes[datastore] = prefix
+        return prefix
+
+    def is_vm_folder(self, f):
+        return folder_name(
+            f.pathTo, self._ds_prefix(f.datastore)) in self.vm_names
+
+    def is_vm_home(self, f):
+        if f.pathTo in self.vm_homes:
+            return True
+        return bool(self.aliases) and \
+            self.aliases.uuid_path(f.pathTo) in self.vm_homes
+
+    def is_attached_disk(self, f):
+        path = file_path(f)
+        if path in self.disk_paths:
+            return True
+        return bool(self.aliases) and \
+            self.aliases.uuid_path(path) in self.disk_paths
+
+    def is_accounted(self, f):
+        return (self.is_vm_folder(f) or
+                self.is_vm_home(f) or
+                self.is_attached_disk(f))
+
+
+def find_unaccounted_files(vms, files, aliases=None):
+    """Yields each file in `files` that does not belong to one of `vms`
+
+    `files` can be any iterable, it's consumed in a single pass.
+    """
+    index = VmIndex(vms, aliases)
+    for f in files:
+        if not index.is_accounted(f):
+            yield f
+
+
+# category -> title, see `classify_folder`
+FOLDER_CATEGORIES = OrderedDict([
+    ('env_only', "Folders with only `env.json` and `env.iso`"),
+    ('one_file', "Folders with one file"),
+    ('empty', "Folders that are empty"),
+    ('many_files', "Folders with more than two files"),
+])
+
+
+def classify_folder(fileNames):
+    """The category of a folder of unaccounted `fileNames`, or None
+
+    Folders with two files other than `env.iso` and `env.json` aren't in
+    any category.
+    """
+    if len(fileNames) == 2:
+        if 'env.iso' in fileNames and 'env.json' in fileNames:
+            return 'env_only'
+        return None
+    if len(fileNames) == 1:
+        return 'one_file'
+    if not fileNames:
+        return 'empty'
+    return 'many_files'
+
+
+class FolderSummary:
+    """The folders of unaccounted files, sorted into `FOLDER_CATEGORIES`
+
+    Only the folder names are kept, not the files, so summaries are cheap
+    to send back from another process and to merge.
+    """
+    def __init__(self):
+        # files matched against the VMs, and how many weren't accounted for
+        self.checked = 0
+        self.files = 0
+        self.categories = OrderedDict(
+            (category, []) for category in FOLDER_CATEGORIES)
+
+    def add(self, folder, fileNames):
+        self.files += len(fileNames)
+        category = classify_folder(fileNames)
+        if category:
+            self.categories[category].append(folder)
+
+    def merge(self, other, prefix=None):
+        """Adds the folders in `other`, with `prefix` before each name"""
+        self.checked += other.checked
+        self.files += other.files
+        for category, folders in other.categories.items():
+            self.categories[category].extend(
+                folders if prefix is None else
+                ["{} {}".format(prefix, folder) for folder in folders])
+        return self
+
+
+def _summarize_shard(index, files):
+    folders = defaultdict(list)
+    for f in files:
+        if not index.is_accounted(f):
+            folders[f.pathTo].append(f.fileName)
+    summary = FolderSummary()
+    summary.checked = len(files)
+    for folder, fileNames in folders.items():
+        summary.add(folder, fileNames)
+    return summary
+
+
+# the index in each worker process, built once by `_init_shard_worker`
+_shardIndex = None
+
+
+def _init_shard_worker(vms, aliases):
+    global _shardIndex
+    _shardIndex = VmIndex(vms, aliases)
+
+
+def _summarize_shard_worker(files):
+    return _summarize_shard(_shardIndex, files)
+
+
+def summarize_unaccounted(vms, shards, aliases=None, processes=None):
+    """Summarises the folders of files that don't belong to one of `vms`
+
+    `shards` is a list of collections of files, one per datastore.  Each
+    shard is matched and summarised in one of up to `processes` processes,
+    by default one per core, and the summaries merged into one
+    `FolderSummary`.  Each worker builds the `VmIndex` once.  Processes in
+    a pool can't start another, so there, or with a single shard, the
+    shards are summarised in this process.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(shards))
+    if processes <= 1 or multiprocessing.current_process().daemon:
+        index = VmIndex(vms, aliases)
+        results = [_summarize_shard(index, files) for files in shards]
+    else:
+        pool = multiprocessing.Pool(processes, _init_shard_worker,
+                                    (vms, aliases))
+        try:
+            # the biggest first, so they don't hold up the end
+            results = pool.map(_summarize_shard_worker,
+                               sorted(shards, key=len, reverse=True),
+                               chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    summary = FolderSummary()
+    for result in results:
+        summary.merge(result)
+    return summary
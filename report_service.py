@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""A service that keeps the inventory loaded and serves reports over HTTP
+
+Rather than logging in and crawling every time a report is wanted, this
+stays logged in to vSphere and keeps the VMs and datastore files in memory.
+A background thread keeps them up-to-date: every `--interval` seconds it
+applies the VM changes since the last refresh, which is one cheap request
+(see `vm_inventory`), and every `--files_interval` seconds it crawls the
+datastores again.  Reports are worked out after each refresh, so requests
+are answered from memory.
+
+If a refresh fails, the last good data keeps being served and the next
+refresh logs in again.
+
+Endpoints, all return json:
+
+ - `/disk_usage?group_by=datastore,resource_pool` usage by each `group_by`,
+   which can be repeated, defaults to `resource_pool`
+ - `/abandoned_files?ignore=path` folders with files that don't belong to
+   any VM, skipping folders containing any `ignore`
+ - `/status` when the data was last refreshed and any error
+
+Example:
+`python report_service.py -H my-vsphere-server -u user --listen_port 8080`
+"""
+import json
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from collections import defaultdict
+from urlparse import urlparse, parse_qs
+
+from cli_helper import ArgBuilder, host_args
+from progress import log
+from reconcile import find_unaccounted_files
+from rollup import VCENTER, Rollup, parse_grouping, vcenter_grouping
+from vm_inventory import VmInventory
+from vsphere_api import VSphereApi
+from vsphere_objects import FileTable
+
+
+class Snapshot:
+    """The inventory and reports as of one refresh, never changed after"""
+    def __init__(self, vcenter, vms, files, aliases, refreshed):
+        self.vcenter = vcenter
+        self.vms = vms
+        self.files = files
+        self.refreshed = refreshed
+        self.rollup = Rollup().add_all(vms)
+        # nested groupings are added to the rollup when they're asked for
+        self.lock = threading.Lock()
+        folders = defaultdict(list)
+        for f in find_unaccounted_files(vms, files, aliases):
+            folders[f.pathTo].append(f.fileName)
+        self.unaccounted = folders
+
+    def disk_usage(self, groupings):
+        # grouping by just the vCenter needs nothing more from the VMs
+        extra = [vcenter_grouping(g) for g in groupings]
+        with self.lock:
+            self.rollup.extend([g for g in extra if g], self.vms)
+        rollup = self.rollup
+        if any(VCENTER in grouping for grouping in groupings):
+            rollup = Rollup.merge([(self.vcenter, rollup)], groupings)
+        return {
+            'refreshed': self.refreshed['vms'],
+            'total': rollup.total,
+            'groups': dict(
+                (','.join(grouping), [
+                    {'group': list(group), 'size': size, 'disks': disks}
+                    for group, size, disks in rollup.rows(grouping)])
+                for grouping in groupings),
+        }
+
+    def abandoned_files(self, ignore=()):
+        folders = dict((folder, files)
+                       for folder, files in self.unaccounted.items()
+                       if not any(folder.find(s) != -1 for s in ignore))
+        return {
+            'refreshed': self.refreshed['files'],
+            'count': sum(len(files) for files in folders.values()),
+            'folders': folders,
+        }
+
+
+class ReportService:
+    def __init__(self, args, api_factory=None):
+        """`api_factory` makes a connected `VSphereApi`, for testing"""
+        self.args = args
+        self.api_factory = api_factory or (
+            lambda: VSphereApi(args, always_connect=True))
+        self.api = None
+        self.inventory = None
+        self.files = None
+        self.aliases = None
+        self.refreshed = {'vms': None, 'files': None}
+        self.snapshot = None
+        self.error = None
+        self.stopped = threading.Event()
+
+    def refresh(self, files=False):
+        """Brings the VMs, and the files if asked or never loaded, up-to-date
+
+        A new snapshot is swapped in once the reports are worked out, so
+        requests are never held up by a refresh.
+        """
+        try:
+            if self.api is None:
+                self.api = self.api_factory()
+                self.inventory = None
+            if self.inventory is None:
+                self.inventory = VmInventory(self.api.service_instance,
+                                             self.api._build_disks)
+                self.inventory.start()
+            changed = self.inventory.update()
+            now = time.time()
+            self.refreshed['vms'] = now
+            if files or self.files is None:
+                # the cache would otherwise be fresh until --max_age
+                self.files = FileTable(self.api.list_all_files(refresh=files))
+                self.aliases = self.api.aliases
+                self.refreshed['files'] = now
+            elif not changed and self.snapshot:
+                return
+            self.snapshot = Snapshot(self.args.host,
+                                     self.inventory.list_vms(), self.files,
+                                     self.aliases, dict(self.refreshed))
+            self.error = None
+            log.info("Refreshed %d VMs & %d files", len(self.snapshot.vms),
+                     len(self.files))
+        except Exception as e:
+            log.exception("Refresh failed, will log in again next time")
+            self.error = str(e)
+            self._close()
+
+    def _close(self):
+        if self.api:
+            try:
+                self.api.close()
+            except Exception:
+                pass
+        self.api = None
+        self.inventory = None
+
+    def run_refresher(self):
+        lastFiles = time.time()
+        while not self.stopped.wait(self.args.interval):
+            crawl = time.time() - lastFiles >= self.args.files_interval
+            if crawl:
+                lastFiles = time.time()
+            self.refresh(files=crawl)
+
+    def status(self):
+        return {'refreshed': self.refreshed,
+                'ready': self.snapshot is not None,
+                'error': self.error}
+
+    def stop(self):
+        self.stopped.set()
+        self._close()
+
+
+class ReportHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        service = self.server.service
+        snapshot = service.snapshot
+        if url.path == '/status':
+            return self._send(200, service.status())
+        if url.path not in ('/disk_usage', '/abandoned_files'):
+            return self._send(404, {'error': 'Not found'})
+        if snapshot is None:
+            return self._send(503, {'error': 'Still loading'})
+        if url.path == '/abandoned_files':
+            return self._send(200, snapshot.abandoned_files(
+                query.get('ignore', [])))
+        try:
+            groupings = [parse_grouping(g) for g in
+                         query.get('group_by', ['resource_pool'])]
+        except ValueError as e:
+            return self._send(400, {'error': str(e)})
+        return self._send(200, snapshot.disk_usage(groupings))
+
+    def _send(self, code, body):
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug("%s " + format, self.client_address[0], *args)
+
+
+class ReportServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        HTTPServer.__init__(self, address, ReportHandler)
+        self.service = service
+
+
+def main():
+    ab = ArgBuilder()
+    ab.add_argument(
+        '--listen',
+        default='127.0.0.1',
+        action='store',
+        help='Address to serve reports on')
+    ab.add_argument(
+        '--listen_port',
+        type=int,
+        default=8080,
+        action='store',
+        help='Port to serve reports on')
+    ab.add_argument(
+        '--interval',
+        type=int,
+        default=300,
+        action='store',
+        help='Seconds between refreshes of the VMs')
+    ab.add_argument(
+        '--files_interval',
+        type=int,
+        default=3600,
+        action='store',
+        help='Seconds between crawls of the datastores')
+    args = ab.process_args()
+    if len(args.hosts) > 1:
+        ab.parser.error('only one vCenter can be served at a time')
+    args = host_args(args, args.hosts[0])
+
+    service = ReportService(args)
+    server = ReportServer((args.listen, args.listen_port), service)
+    try:
+        service.refresh()
+        refresher = threading.Thread(target=service.run_refresher)
+        refresher.daemon = True
+        refresher.start()
+        log.info("Serving reports on http://%s:%d/", args.listen,
+                 args.listen_port)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,15 +5,107 @@ This script will recursively search for all VMs that are visible to the
 authenticated user.  It will then iterate over each VM, look at the attached
 disks and report on that usage.
 
-Current Report Options:
+Current Report Options, any number of these can be reported at once:
  - Usage by Resource Pool
+ - Usage by Datastore
+ - Usage by Host
+ - Usage by Cluster
+ - Usage by Folder
+ - Usage by Power State
+ - Usage by Disk Type (thin or thick)
+ - Usage by vCenter, when collecting from several
+ - Usage by a combination of the above, i.e. `-g datastore,resource_pool`
+
+By default usage is the capacity of the VMs' disks, which overstates thin
+disks.  With `--actual` it's the space committed on the datastores and
+the space provisioned (committed plus what thin disks could still grow by),
+from the VMs' storage layout.  These come from the same bulk request as
+the rest of the VM properties, so there's no need to search the datastores.
+Usage by disk type isn't known from the storage layout.
+
+Usage across several vCenters, given with `-H` more than once or in
+`--hosts_file`, is collected from each of them at once and summed.  Group
+by `vcenter` to report on each one separately.
+
+With `--per_vm` the usage of each VM is reported instead, as the VMs are
+loaded.  With `--format` the report is written as records for other tools,
+see `writers`: a record for each group with its `grouping` (empty for the
+total), `group`, number of `disks` and the usage, or with `--per_vm` a
+record for each VM.
 """
 from __future__ import print_function
 from operator import itemgetter
 from vsphere_api import VSphereApi
 from cli_helper import ArgBuilder
-from collections import defaultdict
+from fanout import collect, stream
+from rollup import DIMENSIONS, MEASURES, VCENTER, Rollup, parse_grouping, \
+    vcenter_grouping
 from utils import convert_size
+from writers import add_arguments, open_writer
+
+VM_FIELDS = ['vcenter', 'name', 'resource_pool', 'host', 'cluster', 'folder',
+             'power_state', 'disks']
+GROUP_FIELDS = ['grouping', 'group', 'disks']
+
+
+def collect_rollups(args):
+    """Sums the disk usage in one vCenter, as a dict of rollup dicts"""
+    try:
+        vApi = None
+        vApi = VSphereApi(args)
+
+        # all the groupings & measures are summed in one pass over the VMs
+        groupings = [vcenter_grouping(g) for g in args.group_by]
+        rollups = vApi.disk_usage_rollups([g for g in groupings if g],
+                                          args.measures)
+        return dict((measure, rollup.to_dict())
+                    for measure, rollup in rollups.items())
+    finally:
+        if vApi:
+            vApi.close()
+            if vApi.profiler:
+                vApi.profiler.report(args.profile)
+
+
+def vm_records(args):
+    """Yields a record of the disk usage of each VM in one vCenter"""
+    try:
+        vApi = None
+        vApi = VSphereApi(args)
+        for vm in vApi.list_all_vms():
+            record = {
+                'vcenter': args.host,
+                'name': vm.name,
+                'resource_pool': vm.resourcePool,
+                'host': vm.host,
+                'cluster': vm.cluster,
+                'folder': vm.folder,
+                'power_state': vm.state,
+                'disks': len(vm.disks),
+            }
+            for measure in args.measures:
+                record[measure] = sum(size for item, size in
+                                      MEASURES[measure](vm))
+            yield record
+    finally:
+        if vApi:
+            vApi.close()
+            if vApi.profiler:
+                vApi.profiler.report(args.profile)
+
+
+def report_vms(args, writer, label):
+    if not writer:
+        print("Disk Usage by VM{}:".format(label))
+    for vcenter, record in stream(args, vm_records):
+        if writer:
+            writer.write(record)
+        else:
+            name = record['name']
+            if len(args.hosts) > 1:
+                name = "{} / {}".format(vcenter, name)
+            print("    {:40} -> {}".format(name, ' of '.join(
+                convert_size(record[m]) for m in args.measures)))
 
 
 def main():
@@ -22,32 +114,94 @@ def main():
         '-s', '--sort',
         default='size',
         action='store',
-        help='Sort order: resource_pool or size')
+        help='Sort order: name (or resource_pool) or size')
+    ab.add_argument(
+        '-g', '--group_by',
+        action='append',
+        type=parse_grouping,
+        help='Dimensions to group usage by, comma separated for nested '
+             'groups.  Repeat for more reports.  One of: {}'.format(
+                 ', '.join(list(DIMENSIONS) + [VCENTER])))
+    ab.add_argument(
+        '--actual',
+        default=False,
+        action='store_true',
+        help='Report space committed and provisioned on the datastores, '
+             'rather than disk capacity')
+    ab.add_argument(
+        '--per_vm',
+        default=False,
+        action='store_true',
+        help='Report the usage of each VM as it is loaded, rather than '
+             'grouped')
+    add_arguments(ab)
     args = ab.process_args()
-    sort_order = 0 if args.sort == 'resource_pool' else 1
+    args.measures = ['committed', 'provisioned'] if args.actual \
+        else ['capacity']
+    # without -g the report is laid out as it always was
+    defaultLayout = not args.group_by and not args.actual
+    args.group_by = args.group_by or (
+        [('resource_pool',), ('datastore',)] if args.actual
+        else [('resource_pool',)])
+    sort_order = 0 if args.sort in ('name', 'resource_pool') else 1
+    label = ' (committed of provisioned)' if args.actual else ''
 
-    try:
-        vApi = None
-        vApi = VSphereApi(args)
+    if args.per_vm:
+        writer = open_writer(args, VM_FIELDS + args.measures)
+        try:
+            report_vms(args, writer, label)
+        finally:
+            if writer:
+                writer.close()
+        return
 
-        # report on disk usage of resource pools
-        disk_usage = defaultdict(int)
-        total = 0
-        for vm in vApi.list_all_vms():
-            for disk in vm.disks:
-                disk_usage[vm.resourcePool] += disk.size
-                total += disk.size
+    results = collect(args, collect_rollups)
+    rollups = [Rollup.merge([(vcenter, Rollup.from_dict(result[measure]))
+                             for vcenter, result in results],
+                            args.group_by)
+               for measure in args.measures]
+
+    writer = open_writer(args, GROUP_FIELDS + args.measures)
+    if writer:
+        with writer:
+            for grouping in args.group_by + [()]:
+                others = [dict((group, size) for group, size, count in
+                               rollup.rows(grouping))
+                          for rollup in rollups[1:]]
+                for group, size, count in rollups[0].rows(grouping):
+                    record = {'grouping': list(grouping),
+                              'group': list(group),
+                              'disks': count,
+                              args.measures[0]: size}
+                    for measure, other in zip(args.measures[1:], others):
+                        record[measure] = other.get(group, 0)
+                    writer.write(record)
+        return
 
+    if defaultLayout:
         print("Disk Usage:")
-        for row in sorted(disk_usage.items(),
+        for row in sorted(rollups[0].rows(('resource_pool',)),
                           key=itemgetter(sort_order),
                           reverse=sort_order != 0):
             print("    RP {:20} -> {}".format(
-                row[0], convert_size(row[1])))
-        print("Total Usage: {}".format(convert_size(total)))
-    finally:
-        if vApi:
-            vApi.close()
+                row[0][0], convert_size(row[1])))
+        print("Total Usage: {}".format(convert_size(rollups[0].total)))
+        return
+
+    for grouping in args.group_by:
+        print("Disk Usage by {}{}:".format(' / '.join(grouping), label))
+        # the first measure is reported & sorted on, the rest alongside
+        others = [dict((group, size) for group, size, count in
+                       rollup.rows(grouping)) for rollup in rollups[1:]]
+        for row in sorted(rollups[0].rows(grouping),
+                          key=itemgetter(sort_order),
+                          reverse=sort_order != 0):
+            print("    {:40} -> {}".format(
+                ' / '.join(str(k) for k in row[0]),
+                ' of '.join(convert_size(size) for size in
+                            [row[1]] + [o.get(row[0], 0) for o in others])))
+    print("Total Usage{}: {}".format(label, ' of '.join(
+        convert_size(rollup.total) for rollup in rollups)))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,257 @@
+"""Sums VM disk usage over many groupings in one pass
+
+A grouping is a tuple of dimensions, like `('datastore',)` or
+`('datastore', 'resource_pool')` for usage by resource pool within each
+datastore.  A `Rollup` goes over the VMs once, works out each dimension a
+disk belongs to once, and adds the disk's size to every grouping.
+
+What's summed is the rollup's measure: the capacity of the VMs' disks, or
+from the VMs' storage layout the space `committed` on each datastore or
+`provisioned` (committed plus what thin disks could still grow by).  The
+storage measures are summed per datastore a VM uses rather than per disk.
+
+Totals are kept in arrays indexed by group number, rather than a dict of
+objects per group, so a rollup of many groupings over a large inventory
+stays small.  A rollup can be saved as a dict and loaded again, so other
+views of the same data don't need another pass.
+"""
+import array
+from collections import OrderedDict
+
+from vsphere_objects import Disk, SIZE_TYPECODE
+
+
+def datastore_name(path):
+    """The datastore of a datastore path, i.e. `ds` for `[ds] folder/`"""
+    if path and path.startswith('['):
+        return path[1:path.find(']')]
+    return None
+
+
+def _datastore(item):
+    if isinstance(item, Disk):
+        return datastore_name(item.path)
+    return item.datastore
+
+
+# dimension -> function of (vm, item) giving the group the item is in, an
+#  item is a `Disk`, or a `DsUsage` for the storage measures
+DIMENSIONS = OrderedDict([
+    ('resource_pool', lambda vm, item: vm.resourcePool),
+    ('datastore', lambda vm, item: _datastore(item)),
+    ('host', lambda vm, item: vm.host),
+    ('cluster', lambda vm, item: vm.cluster),
+    ('folder', lambda vm, item: vm.folder),
+    ('power_state', lambda vm, item: vm.state),
+    ('disk_type', lambda vm, item: item.type
+        if isinstance(item, Disk) else None),
+])
+
+# measure -> function of vm giving a list of (item, size) to sum
+MEASURES = OrderedDict([
+    ('capacity', lambda vm: [(disk, disk.size or 0) for disk in vm.disks]),
+    ('committed', lambda vm: [(usage, usage.committed)
+                              for usage in vm.storage or ()]),
+    ('provisioned', lambda vm: [(usage, usage.committed + usage.uncommitted)
+                                for usage in vm.storage or ()]),
+])
+
+# every dimension on its own, these are always included in a rollup
+SINGLE_GROUPINGS = [(dimension,) for dimension in DIMENSIONS]
+
+# the vCenter a VM is in, added when rollups from several are merged
+VCENTER = 'vcenter'
+
+
+def parse_grouping(spec):
+    """Parses a grouping given as comma separated dimensions"""
+    grouping = tuple(d.strip() for d in spec.split(','))
+    for dimension in grouping:
+        if dimension not in DIMENSIONS and dimension != VCENTER:
+            raise ValueError("Unknown dimension [{}], expected one of {}"
+                             .format(dimension, ', '.join(
+                                 list(DIMENSIONS) + [VCENTER])))
+    return grouping
+
+
+def vcenter_grouping(grouping):
+    """The part of `grouping` that's summed within each vCenter"""
+    return tuple(d for d in grouping if d != VCENTER)
+
+
+def _add_items(vm, items, dimensions, accumulators):
+    # work out each dimension once per item, however many groupings use it
+    for item, size in items:
+        groups = dict((d, DIMENSIONS[d](vm, item)) for d in dimensions)
+        for acc in accumulators:
+            acc.add(tuple(groups[d] for d in acc.grouping), size)
+
+
+class Accumulator:
+    """Total size and number of disks for each group in a grouping
+
+    Groups are numbered in the order they're first seen.
+    """
+    def __init__(self, grouping):
+        self.grouping = grouping
+        self.index = {}
+        self.keys = []
+        self.sizes = array.array(SIZE_TYPECODE)
+        self.counts = array.array('l')
+
+    def add(self, key, size, count=1):
+        i = self.index.get(key)
+        if i is None:
+            i = self.index[key] = len(self.keys)
+            self.keys.append(key)
+            self.sizes.append(0)
+            self.counts.append(0)
+        self.sizes[i] += size
+        self.counts[i] += count
+
+    def rows(self):
+        """Returns a list of (group, total size, number of disks)"""
+        return list(zip(self.keys, self.sizes, self.counts))
+
+    def to_dict(self):
+        return {'keys': [list(key) for key in self.keys],
+                'sizes': self.sizes.tolist(),
+                'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, grouping, d):
+        acc = cls(grouping)
+        acc.keys = [tuple(key) for key in d['keys']]
+        acc.index = dict((key, i) for i, key in enumerate(acc.keys))
+        acc.sizes.extend(d['sizes'])
+        acc.counts.extend(d['counts'])
+        return acc
+
+
+class Rollup:
+    def __init__(self, groupings=(), measure='capacity'):
+        """Sums `measure` by each of `groupings` plus every single dimension
+
+        `disks` counts the items summed, for the storage measures that's
+        the datastores each VM uses.
+        """
+        self.measure = measure
+        self.accumulators = OrderedDict()
+        for grouping in list(groupings) + SINGLE_GROUPINGS:
+            grouping = tuple(grouping)
+            if grouping not in self.accumulators:
+                self.accumulators[grouping] = Accumulator(grouping)
+        self.dimensions = [d for d in DIMENSIONS if any(
+            d in grouping for grouping in self.accumulators)]
+        self.total = 0
+        self.vms = 0
+        self.disks = 0
+
+    def add(self, vm):
+        items = MEASURES[self.measure](vm)
+        self.vms += 1
+        for item, size in items:
+            self.total += size
+            self.disks += 1
+        _add_items(vm, items, self.dimensions, self.accumulators.values())
+
+    def add_all(self, vms):
+        for vm in vms:
+            self.add(vm)
+        return self
+
+    def covers(self, groupings):
+        return all(tuple(g) in self.accumulators for g in groupings)
+
+    def extend(self, groupings, vms):
+        """Adds any of `groupings` that aren't already covered
+
+        `vms` must be the VMs the rollup was made from.
+        """
+        missing = [Accumulator(tuple(g)) for g in groupings
+                   if not self.covers([g])]
+        if not missing:
+            return
+        dimensions = [d for d in DIMENSIONS
+                      if any(d in acc.grouping for acc in missing)]
+        for vm in vms:
+            _add_items(vm, MEASURES[self.measure](vm), dimensions, missing)
+        for acc in missing:
+            self.accumulators.setdefault(acc.grouping, acc)
+
+    def rows(self, grouping):
+        """Returns a list of (group, total size, number of disks)
+
+        The group is a tuple with a value for each dimension in `grouping`,
+        an empty grouping gives the total.
+        """
+        if not grouping:
+            return [((), self.total, self.disks)]
+        return self.accumulators[tuple(grouping)].rows()
+
+    @classmethod
+    def from_rows(cls, groupings, measure, query, vms):
+        """Builds a rollup from sums worked out elsewhere, i.e. in SQL
+
+        `query(grouping)` returns the rows of a grouping like `rows`, and
+        `vms` is the number of VMs summed.
+        """
+        rollup = cls(groupings, measure)
+        for grouping, acc in rollup.accumulators.items():
+            for key, size, count in query(grouping):
+                acc.add(tuple(key), size, count)
+        for key, size, count in query(()):
+            rollup.total = size
+            rollup.disks = count
+        rollup.vms = vms
+        return rollup
+
+    @classmethod
+    def merge(cls, rollups, groupings=()):
+        """Combines rollups from several vCenters into one
+
+        `rollups` is a list of (vCenter, `Rollup`), all of one measure.  As
+        well as the single dimensions, the merged rollup has each of
+        `groupings`, which can include the `vcenter` dimension, as long as
+        the rest of the grouping is in every rollup.
+        """
+        merged = cls(measure=rollups[0][1].measure if rollups
+                     else 'capacity')
+        merged.accumulators = OrderedDict()
+        for grouping in list(groupings) + SINGLE_GROUPINGS + [(VCENTER,)]:
+            grouping = tuple(grouping)
+            if grouping in merged.accumulators:
+                continue
+            acc = merged.accumulators[grouping] = Accumulator(grouping)
+            for vcenter, rollup in rollups:
+                for key, size, count in rollup.rows(
+                        vcenter_grouping(grouping)):
+                    values = iter(key)
+                    acc.add(tuple(vcenter if d == VCENTER else next(values)
+                                  for d in grouping), size, count)
+        for vcenter, rollup in rollups:
+            merged.total += rollup.total
+            merged.vms += rollup.vms
+            merged.disks += rollup.disks
+        return merged
+
+    def to_dict(self):
+        return {'measure': self.measure,
+                'total': self.total,
+                'vms': self.vms,
+                'disks': self.disks,
+                'groupings': [[list(grouping), acc.to_dict()]
+                              for grouping, acc in self.accumulators.items()]}
+
+    @classmethod
+    def from_dict(cls, d):
+        rollup = cls(measure=d.get('measure', 'capacity'))
+        rollup.accumulators = OrderedDict()
+        for grouping, acc in d['groupings']:
+            grouping = tuple(grouping)
+            rollup.accumulators[grouping] = Accumulator.from_dict(
+                grouping, acc)
+        rollup.total = d['total']
+        rollup.vms = d['vms']
+        rollup.disks = d['disks']
+        return rollup
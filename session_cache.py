@@ -0,0 +1,72 @@
+"""Keeps vSphere sessions on disk so later runs can skip logging in
+
+After logging in, vSphere identifies the session with the
+`vmware_soap_session` cookie.  Saving the cookie lets the next run pick the
+session back up, as long as vSphere hasn't expired it, rather than paying
+for another login.
+
+The cookie is as good as a password while the session lasts, so it's kept
+in a directory only the current user can read.
+"""
+import hashlib
+import json
+import os
+
+
+class SessionCache:
+    CACHE_DIR = os.path.join(os.path.expanduser('~'), '.vsphere_reporting',
+                             'sessions')
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or self.CACHE_DIR
+
+    def _path(self, host, port, user):
+        key = '{}@{}:{}'.format(user, host, port).encode('utf-8')
+        return os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest())
+
+    def load(self, host, port, user):
+        path = self._path(host, port, user)
+        if not os.path.exists(path):
+            return None
+        with open(path) as fp:
+            return json.load(fp)
+
+    def save(self, host, port, user, stub):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, 0o700)
+        # create the file with restricted permissions, rather than fixing
+        #  them after the cookie has been written
+        path = self._path(host, port, user)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'cookie': stub.cookie, 'version': stub.version}, fp)
+
+    def forget(self, host, port, user):
+        path = self._path(host, port, user)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def resume(self, host, port, user, sslContext=None):
+        """Returns a service instance using the saved session, if it's valid
+
+        Checking the session costs one cheap request, reading the current
+        session from the session manager.  Returns None if there's no saved
+        session or vSphere no longer accepts it.
+        """
+        session = self.load(host, port, user)
+        if not session:
+            return None
+        # imported here so runs that never connect don't pay for it
+        from pyVmomi import vim, vmodl, SoapStubAdapter
+        stub = SoapStubAdapter(host=host, port=int(port),
+                               version=session['version'],
+                               sslContext=sslContext)
+        stub.cookie = session['cookie']
+        si = vim.ServiceInstance('ServiceInstance', stub)
+        try:
+            if si.content.sessionManager.currentSession:
+                return si
+        except vmodl.MethodFault:
+            pass
+        self.forget(host, port, user)
+        return None
@@ -9,8 +9,13 @@ setup(name='vsphere_reporting_utils',
       description='Reporting utilities to get information out of vSphere.',
       long_description=open('README.rst', 'r').read(),
       version='1.0.0',
-      py_modules=['cli_helper', 'vsphere_api', 'vsphere_objects'],
-      scripts=['find_abandoned_files.py', 'report_vm_du.py'],
+      py_modules=['cli_helper', 'reconcile', 'utils', 'vsphere_api',
+                  'vsphere_objects', 'vsphere_sim', 'profiler',
+                  'collector', 'session_cache', 'progress',
+                  'vm_inventory', 'rollup', 'fanout', 'writers',
+                  'snapshots', 'benchmark'],
+      scripts=['find_abandoned_files.py', 'report_vm_du.py',
+               'report_service.py', 'snapshot_diff.py'],
       classifiers=[
         "Development Status :: 4 - Beta",
         "Environment :: Console",
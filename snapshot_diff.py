@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""Shows what's changed between two snapshots saved with `--snapshot`
+
+`find_abandoned_files.py --snapshot` saves every file and the VMs' disk
+usage in a dated snapshot, see `snapshots`.  This compares two of them,
+by default the latest two, and reports:
+
+ - how the usage of each resource pool (or other `-g` dimension) changed,
+   most grown first
+ - folders that are newly abandoned, no longer abandoned or whose
+   abandoned files changed size
+ - how many files were added, removed or resized, each one with `-v`
+
+Snapshots are sorted, so they're compared by reading both in step, which
+works on millions of files without loading either snapshot.  With
+`--format`, each change is written as a record instead, with its `change`
+(`added`, `removed` or `resized`), `kind` (the dimension, `folder` or
+`file`), `name` and the `old_size` and `new_size`.
+
+Example: `python snapshot_diff.py --snapshot_dir cache/snapshots`
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+from rollup import DIMENSIONS, MEASURES
+from snapshots import Snapshot, SnapshotStore, diff_abandoned_folders, \
+    diff_files, diff_usage
+from utils import convert_size
+from writers import add_arguments, open_writer
+
+CHANGE_FIELDS = ['change', 'kind', 'name', 'old_size', 'new_size']
+
+
+def convert_delta(old, new):
+    delta = (new or 0) - (old or 0)
+    return "{}{}".format('-' if delta < 0 else '+',
+                         convert_size(abs(delta)).strip())
+
+
+def open_snapshot(store, name):
+    """Opens the snapshot called `name` in `store`, or at the path `name`"""
+    if os.path.exists(os.path.join(name, 'meta.json')):
+        return Snapshot(name)
+    if name not in store.names():
+        raise ValueError("No snapshot [{}] in {}".format(
+            name, store.directory))
+    return store.open(name)
+
+
+def change_records(old, new, grouping, measure):
+    """Yields a record for each change, files last as they're compared"""
+    for group, oldSize, newSize in diff_usage(old, new, grouping, measure):
+        yield {'change': 'added' if not oldSize else
+                         'removed' if not newSize else 'resized',
+               'kind': grouping[0],
+               'name': group[0],
+               'old_size': oldSize,
+               'new_size': newSize}
+    for change, folder, oldSize, newSize in diff_abandoned_folders(old, new):
+        yield {'change': change,
+               'kind': 'folder',
+               'name': folder,
+               'old_size': oldSize,
+               'new_size': newSize}
+    for change, a, b in diff_files(old, new):
+        f = b or a
+        yield {'change': change,
+               'kind': 'file',
+               'name': os.path.join(f.pathTo, f.fileName),
+               'old_size': a.size if a else None,
+               'new_size': b.size if b else None}
+
+
+def print_report(old, new, grouping, measure, verbose=False):
+    print("Comparing snapshots {} and {}".format(old.name, new.name))
+
+    print()
+    print("Disk Usage by {}:".format(grouping[0]))
+    for group, oldSize, newSize in diff_usage(old, new, grouping, measure):
+        print("    {:40} -> {:>10} ({} to {})".format(
+            str(group[0]), convert_delta(oldSize, newSize),
+            convert_size(oldSize), convert_size(newSize)))
+
+    folders = {'added': [], 'removed': [], 'resized': []}
+    for change, folder, oldSize, newSize in diff_abandoned_folders(old, new):
+        folders[change].append((folder, oldSize, newSize))
+    for change, title in [('added', "New abandoned folders"),
+                          ('removed', "Folders no longer abandoned"),
+                          ('resized', "Abandoned folders resized")]:
+        print()
+        print("{}...".format(title))
+        for folder, oldSize, newSize in folders[change]:
+            print("    {:40} -> {:>10}".format(
+                folder, convert_delta(oldSize, newSize)))
+        print("  ... count = {}".format(len(folders[change])))
+
+    print()
+    counts = {'added': 0, 'removed': 0, 'resized': 0}
+    sizes = {'added': 0, 'removed': 0, 'resized': 0}
+    for change, a, b in diff_files(old, new):
+        counts[change] += 1
+        sizes[change] += ((b.size or 0) if b else 0) - \
+            ((a.size or 0) if a else 0)
+        if verbose:
+            f = b or a
+            print("    {:8} {:60} {:>10}".format(
+                change, os.path.join(f.pathTo, f.fileName),
+                convert_delta(a.size if a else 0, b.size if b else 0)))
+    print("Files: {}".format(', '.join(
+        "{} {} ({})".format(counts[change], change,
+                            convert_delta(0, sizes[change]))
+        for change in ['added', 'removed', 'resized'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare two snapshots saved with --snapshot')
+    parser.add_argument(
+        'old', nargs='?', default=None,
+        help='Name or path of the older snapshot, by default the one before '
+             'the latest')
+    parser.add_argument(
+        'new', nargs='?', default=None,
+        help='Name or path of the newer snapshot, by default the latest')
+    parser.add_argument(
+        '--snapshot_dir', default='snapshots',
+        help='Directory the snapshots are kept in, snapshots in the '
+             '--cache_dir, or with several vCenters in their subdirectories')
+    parser.add_argument(
+        '-l', '--list', default=False, action='store_true',
+        help='List the snapshots and exit')
+    parser.add_argument(
+        '-g', '--group_by', default='resource_pool',
+        choices=list(DIMENSIONS),
+        help='Dimension to compare usage by')
+    parser.add_argument(
+        '--measure', default='capacity', choices=list(MEASURES),
+        help='Usage to compare, disk capacity or the space committed or '
+             'provisioned on the datastores')
+    parser.add_argument(
+        '-v', '--verbose', default=False, action='store_true',
+        help='Print a line for every file added, removed or resized')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    store = SnapshotStore(args.snapshot_dir)
+    names = store.names()
+    if args.list:
+        for name in names:
+            meta = store.open(name).meta
+            print("{}  {:>8} VMs {:>10} files  {}".format(
+                name, meta['vms'], meta['files'], meta.get('host') or ''))
+        return
+
+    # the latest snapshots fill in for those not given
+    needed = [name for name in (args.old, args.new) if name is None]
+    if len(names) < len(needed):
+        sys.exit("Need two snapshots to compare, found {} in {}".format(
+            len(names), args.snapshot_dir))
+    latest = names[len(names) - len(needed):]
+    try:
+        old = open_snapshot(store, args.old or latest.pop(0))
+        new = open_snapshot(store, args.new or latest.pop(0))
+    except ValueError as e:
+        sys.exit(str(e))
+    grouping = (args.group_by,)
+
+    writer = open_writer(args, CHANGE_FIELDS)
+    if writer:
+        with writer:
+            for record in change_records(old, new, grouping, args.measure):
+                writer.write(record)
+        return
+
+    print_report(old, new, grouping, args.measure, args.verbose)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""Dated snapshots of the datastore files and disk usage, and diffs of them
+
+The cache only holds the latest run.  To see what's changed since last
+week, a snapshot is saved after a run in a directory of its own, named by
+when it was taken, i.e. `snapshots/2024-05-06T09-30-00/`, holding:
+
+ - `files.ndjson.gz` every file as `[folder, name, size, abandoned]`,
+   sorted by folder and name
+ - `rollups.json.gz` the `rollup.Rollup` of each measure
+ - `meta.json` when it was captured, from which vCenter and counts
+
+As the files are sorted, two snapshots are compared by reading both in step,
+a sorted merge, so diffing millions of files only holds a record from each
+at a time.  The crawl doesn't come back sorted, so files are sorted in runs
+of `SORT_CHUNK` that are written to temporary files and merged.
+"""
+import gzip
+import heapq
+import io
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+
+from rollup import MEASURES, Rollup
+
+SnapshotFile = namedtuple('SnapshotFile',
+                          ['pathTo', 'fileName', 'size', 'abandoned'])
+
+# max number of files held in memory while sorting
+SORT_CHUNK = 200000
+
+NAME_FORMAT = '%Y-%m-%dT%H-%M-%S'
+
+
+def _write_gzip_records(path, records, compresslevel=6):
+    count = 0
+    # gzip's own buffering is slow on python 2, one line at a time
+    with io.BufferedWriter(gzip.open(path, 'wb', compresslevel)) as fp:
+        for rec in records:
+            fp.write(json.dumps(rec).encode('utf-8'))
+            fp.write(b'\n')
+            count += 1
+    return count
+
+
+def _read_gzip_records(path):
+    with io.BufferedReader(gzip.open(path, 'rb')) as fp:
+        for line in fp:
+            yield json.loads(line.decode('utf-8'))
+
+
+def external_sort(records, tmpdir=None, chunk=None):
+    """Yields `records` in sorted order, holding `chunk` at a time
+
+    Records are sorted in runs of `chunk`, by default `SORT_CHUNK`, each run
+    is written to a temporary file in `tmpdir`, then the runs are merged.
+    """
+    chunk = chunk or SORT_CHUNK
+    runs = []
+    tmpdir = tempfile.mkdtemp(dir=tmpdir)
+    try:
+        records = iter(records)
+        while True:
+            batch = sorted(itertools.islice(records, chunk))
+            if not batch:
+                break
+            if not runs and len(batch) < chunk:
+                # it all fitted in one run, no need to write it out
+                for rec in batch:
+                    yield rec
+                return
+            path = os.path.join(tmpdir, 'run-{}.ndjson.gz'.format(len(runs)))
+            # runs are only read back once, so favour speed over size
+            _write_gzip_records(path, batch, compresslevel=1)
+            runs.append(path)
+        for rec in heapq.merge(*[_read_gzip_records(path) for path in runs]):
+            yield rec
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class Snapshot:
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(os.path.join(path, 'meta.json')) as fp:
+            self.meta = json.load(fp)
+
+    def iter_files(self):
+        """Yields each `SnapshotFile`, sorted by folder then name"""
+        for rec in _read_gzip_records(
+                os.path.join(self.path, 'files.ndjson.gz')):
+            yield SnapshotFile._make(rec)
+
+    def iter_abandoned_folders(self):
+        """Yields (folder, number of files, total size), sorted by folder
+
+        For the folders with files that weren't accounted for by a VM.
+        """
+        files = (f for f in self.iter_files() if f.abandoned)
+        for pathTo, group in itertools.groupby(files, lambda f: f.pathTo):
+            count = size = 0
+            for f in group:
+                count += 1
+                size += f.size or 0
+            yield pathTo, count, size
+
+    def rollup(self, measure='capacity'):
+        with gzip.open(os.path.join(self.path, 'rollups.json.gz'), 'rb') as fp:
+            return Rollup.from_dict(json.loads(fp.read().decode('utf-8'))[
+                measure])
+
+
+class SnapshotStore:
+    """The snapshots kept in a directory, one subdirectory each"""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def names(self):
+        """Returns the names of the snapshots, oldest first"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory)
+                      if os.path.exists(os.path.join(
+                          self.directory, name, 'meta.json')))
+
+    def open(self, name):
+        return Snapshot(os.path.join(self.directory, name))
+
+    def save(self, vms, files, is_abandoned, host=None):
+        """Saves a snapshot, returning its name
+
+        `vms` is a list of `Vm`, `files` any iterable of `DsFile` which is
+        consumed once, and `is_abandoned` a function of a `DsFile` telling
+        if it isn't accounted for by any VM.
+        """
+        captured = time.time()
+        name = time.strftime(NAME_FORMAT, time.localtime(captured))
+        if name in self.names():
+            # another snapshot within the same second
+            name = '{}-{}'.format(name, len([
+                n for n in self.names() if n.startswith(name)]))
+        path = os.path.join(self.directory, name)
+        # written to a temporary directory & moved into place, so a failed
+        #  run doesn't leave a partial snapshot
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        rollups = dict((measure, Rollup(measure=measure).add_all(vms))
+                       for measure in MEASURES)
+        with gzip.open(os.path.join(tmp_path, 'rollups.json.gz'), 'wb') as fp:
+            fp.write(json.dumps(dict(
+                (measure, rollup.to_dict())
+                for measure, rollup in rollups.items())).encode('utf-8'))
+
+        fileCount = _write_gzip_records(
+            os.path.join(tmp_path, 'files.ndjson.gz'),
+            external_sort(([f.pathTo, f.fileName, f.size, is_abandoned(f)]
+                           for f in files), tmpdir=self.directory))
+
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as fp:
+            json.dump({'captured': captured, 'host': host,
+                       'vms': len(vms), 'files': fileCount}, fp, indent=2)
+        os.rename(tmp_path, path)
+        return name
+
+
+def _merge(old, new, key):
+    # yields (old, new) pairs of records with the same key, either is None
+    #  when the other snapshot doesn't have it
+    a = next(old, None)
+    b = next(new, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and key(a) < key(b)):
+            yield a, None
+            a = next(old, None)
+        elif a is None or key(b) < key(a):
+            yield None, b
+            b = next(new, None)
+        else:
+            yield a, b
+            a = next(old, None)
+            b = next(new, None)
+
+
+def diff_files(old, new):
+    """Yields (change, old `SnapshotFile`, new `SnapshotFile`)
+
+    `change` is `added`, `removed` or `resized`, unchanged files are left
+    out.  Both snapshots are read once, in step.
+    """
+    for a, b in _merge(old.iter_files(), new.iter_files(),
+                       lambda f: (f.pathTo, f.fileName)):
+        if a is None:
+            yield 'added', None, b
+        elif b is None:
+            yield 'removed', a, None
+        elif a.size != b.size:
+            yield 'resized', a, b
+
+
+def diff_abandoned_folders(old, new):
+    """Yields (change, folder, old size, new size) for abandoned folders
+
+    `change` is `added` for folders that are newly abandoned, `removed`
+    for ones that no longer are and `resized` for ones whose abandoned
+    files changed size.
+    """
+    for a, b in _merge(old.iter_abandoned_folders(),
+                       new.iter_abandoned_folders(), lambda f: f[0]):
+        if a is None:
+            yield 'added', b[0], None, b[2]
+        elif b is None:
+            yield 'removed', a[0], a[2], None
+        elif a[2] != b[2]:
+            yield 'resized', a[0], a[2], b[2]
+
+
+def diff_usage(old, new, grouping, measure='capacity'):
+    """Returns [(group, old size, new size)] for groups whose usage changed
+
+    Sorted by how much they grew, most first.
+    """
+    oldSizes = dict((group, size) for group, size, count in
+                    old.rollup(measure).rows(grouping))
+    newSizes = dict((group, size) for group, size, count in
+                    new.rollup(measure).rows(grouping))
+    changes = [(group, oldSizes.get(group, 0), newSizes.get(group, 0))
+               for group in set(oldSizes) | set(newSizes)
+               if oldSizes.get(group, 0) != newSizes.get(group, 0)]
+    return sorted(changes, key=lambda c: c[2] - c[1], reverse=True)
@@ -0,0 +1,53 @@
+"""Inventories and API objects for the tests, backed by `vsphere_sim`"""
+import shutil
+import tempfile
+import unittest
+
+from cli_helper import ArgBuilder
+from vsphere_api import VSphereApi
+from vsphere_sim import SimInventory, sim_connect
+
+
+def renamed_vsan_inventory(vm_count=50, file_count=2000, datastore_count=2):
+    """A vSAN inventory where no VM is named after its folder
+
+    The VMs' paths are given by their folder's UUID, so their files can
+    only be matched to them through the `FolderAliases`.
+    """
+    inv = SimInventory.generate(vm_count, file_count,
+                                datastore_count=datastore_count, vsan=True)
+    vms = []
+    for vm in inv.vms:
+        ds = vm.path[1:vm.path.index(']')]
+        uuid = inv.uuids[(ds, vm.name)]
+        vms.append(vm._replace(
+            name='renamed-{}'.format(vm.name),
+            path=vm.path.replace('] {}/'.format(vm.name),
+                                 '] {}/'.format(uuid), 1)))
+    return SimInventory(vms, inv.files, inv.uuids)
+
+
+def orphaned_files(inv):
+    """The files the generated inventory put in folders without a VM"""
+    return [f for f in inv.files if '] orphan-' in f.pathTo]
+
+
+class SimTestCase(unittest.TestCase):
+    """Runs each test in a fresh cache directory"""
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+
+    def args(self, *argv):
+        args = ArgBuilder().parser.parse_args(
+            ['-H', 'sim', '-u', 'sim', '-p', 'sim',
+             '--cache_dir', self.cacheDir] + list(argv))
+        args.host = 'sim'
+        return args
+
+    def api(self, inv, *argv, **kwargs):
+        """A `VSphereApi` for `inv`, `kwargs` are passed to `sim_connect`"""
+        return VSphereApi(self.args(*argv),
+                          service_instance=sim_connect(inv, **kwargs))
@@ -0,0 +1,33 @@
+import unittest
+
+from collector import Collector
+
+
+def fail(item):
+    if item == 3:
+        raise SystemExit(item)
+    if item == 5:
+        raise ValueError(item)
+    return item
+
+
+class CollectorTest(unittest.TestCase):
+    def test_results(self):
+        self.assertEqual(sorted(Collector(4).map(lambda i: i * 2, range(10))),
+                         [i * 2 for i in range(10)])
+
+    def test_exceptions(self):
+        self.assertRaises(ValueError, list,
+                          Collector(4).map(fail, range(4, 10)))
+        results = list(Collector(4).map(fail, range(4, 10),
+                                        return_exceptions=True))
+        self.assertEqual(len(results), 6)
+        self.assertEqual(len([r for r in results
+                              if isinstance(r, ValueError)]), 1)
+
+    def test_base_exceptions(self):
+        # raised from the worker thread rather than leaving the caller
+        #  waiting for its result
+        for returnExceptions in (False, True):
+            self.assertRaises(SystemExit, list, Collector(4).map(
+                fail, range(10), return_exceptions=returnExceptions))
@@ -0,0 +1,40 @@
+import os
+
+from tests.helpers import SimTestCase
+from vsphere_api import TaskError
+from vsphere_sim import SimInventory
+
+SEARCH = 'SearchDatastoreSubFolders_Task'
+
+
+def keys(files):
+    return sorted((f.pathTo, f.fileName) for f in files)
+
+
+class FailedDatastoreTest(SimTestCase):
+    """Files from the datastores that were searched are kept when others
+    fail, and the next run only searches the failed ones"""
+    def check(self, *argv):
+        inv = SimInventory.generate(100, 2000)
+        api = self.api(inv, '-c', *argv, failing_datastores=['LUN02'])
+        self.assertRaises(TaskError, api.list_all_files)
+        self.assertEqual(api.failedDatastores, set(['LUN02']))
+        self.assertEqual(
+            [f for f in os.listdir(self.cacheDir) if f.endswith('.tmp')], [])
+        self.assertEqual(
+            keys(api.objStore.iter_files()),
+            keys(f for f in inv.files if f.datastore != 'LUN02'))
+
+        api = self.api(inv, '-c', *argv)
+        self.assertEqual(keys(api.list_all_files()), keys(inv.files))
+        return api
+
+    def test_search(self):
+        api = self.check()
+        self.assertEqual(api.service_instance._stub.calls[SEARCH], 1)
+
+    def test_folders(self):
+        self.check('--crawl', 'folders')
+
+    def test_sqlite(self):
+        self.check('--store', 'sqlite')
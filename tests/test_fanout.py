@@ -0,0 +1,62 @@
+import logging
+
+from cli_helper import ArgBuilder, read_hosts
+from fanout import CollectionError, collect, stream
+from progress import _TagFilter, log
+from tests.helpers import SimTestCase
+from vsphere_api import TaskError, VSphereApi
+from vsphere_sim import SimInventory, sim_connect
+
+# a VM name that isn't ascii, logged by the workers
+NAME = u'caf\xe9'
+
+
+def sim_api(args):
+    if args.host == 'broken':
+        raise TaskError("Simulated failure of {}".format(args.host))
+    inv = SimInventory.generate(20, 100)
+    log.warning(u"Collecting from %s", NAME)
+    log.warning(u"Collecting VMs like {}".format(NAME))
+    return VSphereApi(args, service_instance=sim_connect(inv))
+
+
+def count_vms(args):
+    return len(sim_api(args).list_all_vms())
+
+
+def vm_names(args):
+    for vm in sim_api(args).list_all_vms():
+        yield vm.name
+
+
+class TagFilterTest(SimTestCase):
+    def test_unicode(self):
+        for msg in [u'caf\xe9', 'caf\xc3\xa9', 'plain', ValueError('x')]:
+            record = logging.LogRecord('test', logging.INFO, __file__, 1,
+                                       msg, (), None)
+            self.assertTrue(_TagFilter('vc1').filter(record))
+            self.assertTrue(record.getMessage().startswith('vc1: '))
+
+
+class FanoutTest(SimTestCase):
+    def args(self, *hosts):
+        argv = []
+        for host in hosts:
+            argv.extend(['-H', host])
+        args = ArgBuilder().parser.parse_args(
+            argv + ['-u', 'sim', '-p', 'sim', '--cache_dir', self.cacheDir])
+        args.hosts = read_hosts(args)
+        return args
+
+    def test_collect(self):
+        self.assertEqual(collect(self.args('good', 'broken'), count_vms),
+                         [('good', 20)])
+        self.assertRaises(CollectionError, collect,
+                          self.args('broken', 'broken:444'), count_vms)
+
+    def test_stream(self):
+        records = list(stream(self.args('good', 'broken'), vm_names))
+        self.assertEqual(len(records), 20)
+        self.assertEqual(set(host for host, name in records), set(['good']))
+        self.assertRaises(CollectionError, list,
+                          stream(self.args('broken', 'broken:444'), vm_names))
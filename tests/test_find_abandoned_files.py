@@ -0,0 +1,43 @@
+import sys
+
+from six import StringIO
+
+from find_abandoned_files import print_report
+from reconcile import FolderSummary
+from tests.helpers import SimTestCase, orphaned_files, renamed_vsan_inventory
+
+
+class PrintReportTest(SimTestCase):
+    def report(self, summary):
+        out, sys.stdout = sys.stdout, StringIO()
+        try:
+            print_report(summary)
+            return sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = out
+
+    def test_counts(self):
+        inv = renamed_vsan_inventory()
+        for argv in [(), ('-c', '--store', 'sqlite')]:
+            summary = self.api(inv, *argv).summarize_unaccounted_folders(
+                ignore=['orphan-1/'], processes=1)
+            ignored = [f for f in inv.files if 'orphan-1/' in f.pathTo]
+            lines = self.report(summary)
+            self.assertEqual(lines[:5], [
+                '',
+                'Unaccounted file count [{}]'.format(
+                    len(inv.files) - len(ignored)),
+                'Removing known VMs from the list...',
+                '',
+                'Found {} files that are unaccounted.'.format(
+                    len(orphaned_files(inv)) - len(ignored))])
+
+    def test_merged(self):
+        a = FolderSummary()
+        a.checked = 10
+        a.add('[LUN01] x/', ['a.log'])
+        b = FolderSummary()
+        b.checked = 5
+        merged = FolderSummary().merge(a, 'vc1').merge(b, 'vc2')
+        self.assertEqual(self.report(merged)[1], 'Unaccounted file count [15]')
+        self.assertIn('    vc1 [LUN01] x/', self.report(merged))
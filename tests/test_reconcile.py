@@ -0,0 +1,204 @@
+import os.path
+import unittest
+
+from reconcile import FileFilter, FolderAliases, find_unaccounted_files, \
+    summarize_unaccounted
+from tests.helpers import SimTestCase, orphaned_files, renamed_vsan_inventory
+from vsphere_objects import Disk, DsFile
+from vsphere_sim import SimInventory
+
+
+def keys(files):
+    return sorted((f.pathTo, f.fileName) for f in files)
+
+
+def nested_loop_unaccounted(vms, files):
+    """The original O(VMs x files) matching, the reference for the index"""
+    for vm in vms:
+        newFiles = []
+        for f in files:
+            # remove paths starting with VM name
+            if f.pathTo == '[{}] {}/'.format(f.datastore, vm.name):
+                continue
+            # remove other references to VM files
+            vmDisksLoc = vm.path.split('/')[0]
+            if f.pathTo == '{}/'.format(vmDisksLoc):
+                continue
+            # remove attached disks
+            if any([os.path.join(f.pathTo, f.fileName) == disk.path
+                    for disk in vm.disks]):
+                continue
+            newFiles.append(f)
+        files = newFiles
+    return files
+
+
+def canonical_vms(vms, aliases):
+    """`vms` with their paths by friendly name, which is all the original
+    matching understood"""
+    return [vm._replace(path=aliases.canonical(vm.path), disks=[
+        disk._replace(path=aliases.canonical(disk.path))
+        for disk in vm.disks]) for vm in vms]
+
+
+def sim_aliases(inv):
+    aliases = {}
+    for (ds, folder), uuid in inv.uuids.items():
+        aliases.setdefault(ds, {})[uuid] = folder
+    return FolderAliases(aliases)
+
+
+class MatchesNestedLoopTest(unittest.TestCase):
+    """The indexed matching finds the same files as the original"""
+    def assertMatches(self, vms, files, aliases=None):
+        reference = nested_loop_unaccounted(
+            canonical_vms(vms, aliases) if aliases else vms, files)
+        self.assertEqual(keys(find_unaccounted_files(vms, files, aliases)),
+                         keys(reference))
+        return reference
+
+    def test_sim_inventories(self):
+        for seed in range(3):
+            inv = SimInventory.generate(200, 3000, seed=seed)
+            self.assertTrue(self.assertMatches(inv.vms, inv.files))
+
+    def test_vsan(self):
+        inv = SimInventory.generate(200, 3000, vsan=True)
+        self.assertTrue(self.assertMatches(inv.vms, inv.files,
+                                           sim_aliases(inv)))
+
+    def test_vsan_renamed_vms(self):
+        inv = renamed_vsan_inventory()
+        reference = self.assertMatches(inv.vms, inv.files, sim_aliases(inv))
+        self.assertEqual(keys(reference), keys(orphaned_files(inv)))
+
+    def test_edge_cases(self):
+        inv = SimInventory.generate(20, 100)
+        vm = inv.vms[0]
+        elsewhere = DsFile('LUN02', '[LUN02] shared/', 'data.vmdk', 10)
+        vms = [vm._replace(disks=vm.disks + [
+            Disk('Hard disk 2', '', '[LUN02] shared/data.vmdk', 10,
+                 'persistent', 'thin')])] + inv.vms[1:]
+        files = inv.files + [
+            elsewhere,
+            DsFile('LUN02', '[LUN02] shared/', 'other.vmdk', 10),
+            # folders under a VM's folder, or named like a VM deeper down
+            DsFile('LUN01', '[LUN01] vm-0/sub/', 'x.log', 1),
+            DsFile('LUN01', '[LUN01] other/vm-0/', 'x.log', 1),
+            # a folder named after a VM on another datastore
+            DsFile('LUN03', '[LUN03] vm-0/', 'x.log', 1),
+            # files at the root of a datastore
+            DsFile('LUN01', '[LUN01] ', 'root.iso', 1),
+        ]
+        reference = self.assertMatches(vms, files)
+        self.assertNotIn(elsewhere, reference)
+
+
+class SummarizeShardsTest(unittest.TestCase):
+    def summaries(self, inv, aliases=None):
+        shards = {}
+        for f in inv.files:
+            shards.setdefault(f.datastore, []).append(f)
+        self.assertGreater(len(shards), 2)
+        return [summarize_unaccounted(inv.vms, list(shards.values()),
+                                      aliases, processes)
+                for processes in (1, 2)]
+
+    def assertSameSummary(self, inProcess, pooled):
+        self.assertEqual(pooled.files, inProcess.files)
+        self.assertEqual(pooled.checked, inProcess.checked)
+        self.assertEqual(
+            dict((c, sorted(f)) for c, f in pooled.categories.items()),
+            dict((c, sorted(f)) for c, f in inProcess.categories.items()))
+
+    def test_pool(self):
+        inv = SimInventory.generate(200, 3000, datastore_count=4)
+        inProcess, pooled = self.summaries(inv)
+        self.assertTrue(inProcess.files)
+        self.assertEqual(inProcess.checked, len(inv.files))
+        self.assertSameSummary(inProcess, pooled)
+
+    def test_pool_vsan(self):
+        inv = renamed_vsan_inventory(datastore_count=4)
+        inProcess, pooled = self.summaries(inv, sim_aliases(inv))
+        self.assertEqual(inProcess.files, len(orphaned_files(inv)))
+        self.assertSameSummary(inProcess, pooled)
+
+
+class FileFilterTest(unittest.TestCase):
+    def test_accepts(self):
+        f = FileFilter(['*.vmdk', '*.log'], ['templates', ''])
+        self.assertTrue(f)
+        self.assertEqual(f.ignore, ['templates'])
+        self.assertTrue(f.accepts(DsFile('LUN01', '[LUN01] a/', 'a.vmdk', 1)))
+        self.assertFalse(f.accepts(DsFile('LUN01', '[LUN01] a/', 'a.vmx', 1)))
+        self.assertFalse(f.accepts(
+            DsFile('LUN01', '[LUN01] templates/', 'a.vmdk', 1)))
+        self.assertFalse(FileFilter())
+        self.assertFalse(FileFilter(ignore=['']))
+
+    def test_covers(self):
+        everything = FileFilter()
+        disks = FileFilter(['*.vmdk'])
+        self.assertTrue(everything.covers(disks))
+        self.assertTrue(everything.covers(everything))
+        self.assertFalse(disks.covers(everything))
+        self.assertTrue(FileFilter(['*.vmdk', '*.log']).covers(disks))
+        self.assertFalse(disks.covers(FileFilter(['*.log'])))
+        self.assertTrue(FileFilter(ignore=['a']).covers(
+            FileFilter(ignore=['a', 'b'])))
+        self.assertFalse(FileFilter(ignore=['a', 'b']).covers(
+            FileFilter(ignore=['a'])))
+
+    def test_round_trip(self):
+        f = FileFilter(['*.vmdk'], ['templates'])
+        self.assertEqual(FileFilter.from_dict(f.to_dict()).to_dict(),
+                         f.to_dict())
+        self.assertFalse(FileFilter.from_dict(None))
+
+
+class VsanAliasesTest(SimTestCase):
+    """Files on vSAN only match renamed VMs through the folder aliases"""
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.inv = renamed_vsan_inventory()
+        self.expected = keys(orphaned_files(self.inv))
+
+    def test_streaming_without_cache(self):
+        api = self.api(self.inv)
+        self.assertEqual(keys(api.iter_unaccounted_files()), self.expected)
+
+    def test_streaming_from_cache(self):
+        self.api(self.inv, '-c').list_all_files()
+        api = self.api(self.inv, '-c')
+        self.assertEqual(keys(api.iter_unaccounted_files()), self.expected)
+
+    def test_summary(self):
+        for argv in [(), ('-c',), ('-c', '--store', 'sqlite')]:
+            summary = self.api(self.inv, *argv).summarize_unaccounted_folders(
+                processes=1)
+            self.assertEqual(summary.files, len(self.expected))
+            self.assertEqual(summary.checked, len(self.inv.files))
+
+    def test_aliases_filled_while_matching(self):
+        api = self.api(self.inv)
+        self.assertFalse(api.aliases)
+        files = find_unaccounted_files(api.list_all_vms(),
+                                       api.list_all_files(), api.aliases)
+        self.assertEqual(keys(files), self.expected)
+
+    def test_filtered(self):
+        # the sim leaves the folders out of a search with a matchPattern,
+        #  like vSphere, so the aliases have to come from somewhere else
+        for argv in [(), ('--crawl', 'folders')]:
+            for match, ignore in [(['*.vmdk'], ()), (['*.log'], ()),
+                                  (['*.vmdk', '*.log'], ['orphan-1/']),
+                                  ((), ['orphan-1/'])]:
+                api = self.api(self.inv, *argv)
+                files = keys(api.iter_unaccounted_files(ignore, match))
+                self.assertTrue(api.aliases)
+                fileFilter = FileFilter(match, ignore)
+                self.assertEqual(files, [
+                    (pathTo, fileName) for pathTo, fileName in self.expected
+                    if fileFilter.matches(fileName) and
+                    not fileFilter.is_ignored(pathTo)])
@@ -0,0 +1,66 @@
+from report_service import ReportService, Snapshot
+from rollup import Rollup
+from tests.helpers import SimTestCase
+from vsphere_api import VSphereApi
+from vsphere_objects import DsFile
+from vsphere_sim import SimInventory, sim_connect
+
+SEARCH = 'SearchDatastoreSubFolders_Task'
+
+
+class FilesRefreshTest(SimTestCase):
+    """The service searches the datastores every --files_interval, even
+    with a cache that would still be fresh"""
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.inv = SimInventory.generate(50, 500)
+        self.si = sim_connect(self.inv)
+        args = self.args('-c')
+        self.service = ReportService(args, api_factory=lambda: VSphereApi(
+            args, service_instance=self.si))
+
+    def tearDown(self):
+        self.service.stop()
+        SimTestCase.tearDown(self)
+
+    def searches(self):
+        return self.si._stub.calls.get(SEARCH, 0)
+
+    def test_crawls_when_asked(self):
+        self.service.refresh()
+        searched = self.searches()
+        self.assertTrue(searched)
+        self.assertEqual(len(self.service.files), len(self.inv.files))
+
+        # the VMs are refreshed alone from the fresh cache
+        self.service.refresh()
+        self.assertEqual(self.searches(), searched)
+
+        ds = self.inv.datastores[0]
+        self.inv.folders[ds]['new-orphan'] = [
+            DsFile(ds, '[{}] new-orphan/'.format(ds), 'file.log', 1)]
+        self.service.refresh(files=True)
+        self.assertGreater(self.searches(), searched)
+        self.assertEqual(len(self.service.files), len(self.inv.files) + 1)
+
+    def test_starts_from_cache(self):
+        VSphereApi(self.args('-c'),
+                   service_instance=sim_connect(self.inv)).list_all_files()
+        self.service.refresh()
+        self.assertEqual(self.searches(), 0)
+        self.assertEqual(len(self.service.files), len(self.inv.files))
+
+
+class DiskUsageTest(SimTestCase):
+    def test_vcenter_grouping(self):
+        inv = SimInventory.generate(50, 500)
+        snapshot = Snapshot('vc1', inv.vms, inv.files, None,
+                            {'vms': 1, 'files': 1})
+        usage = snapshot.disk_usage([('vcenter',), ('vcenter', 'host')])
+        total = Rollup().add_all(inv.vms)
+        self.assertEqual(usage['total'], total.total)
+        self.assertEqual(usage['groups']['vcenter'], [
+            {'group': ['vc1'], 'size': total.total, 'disks': total.disks}])
+        self.assertEqual(len(usage['groups']['vcenter,host']),
+                         len(total.rows(('host',))))
+        self.assertNotIn((), snapshot.rollup.accumulators)
@@ -0,0 +1,34 @@
+from rollup import MEASURES, SINGLE_GROUPINGS, Rollup
+from tests.helpers import SimTestCase
+from vsphere_sim import SimInventory
+
+GROUPINGS = [('datastore', 'resource_pool'), ('cluster', 'host'),
+             ('disk_type', 'power_state', 'folder')]
+
+
+def sorted_rows(rollup, grouping):
+    return sorted(rollup.rows(grouping))
+
+
+class SqliteRollupTest(SimTestCase):
+    """Rollups summed by SQL match those summed over the VMs"""
+    def test_matches_python(self):
+        inv = SimInventory.generate(300, 1000, vsan=True)
+        measures = list(MEASURES)
+        rollups = self.api(inv, '-c', '--store', 'sqlite') \
+            .disk_usage_rollups(GROUPINGS, measures)
+        for measure in measures:
+            expected = Rollup(GROUPINGS, measure).add_all(inv.vms)
+            rollup = rollups[measure]
+            for grouping in GROUPINGS + SINGLE_GROUPINGS + [()]:
+                self.assertEqual(sorted_rows(rollup, grouping),
+                                 sorted_rows(expected, grouping))
+            self.assertEqual(rollup.vms, len(inv.vms))
+
+    def test_saved_with_cache(self):
+        inv = SimInventory.generate(50, 100)
+        self.api(inv, '-c', '--store', 'sqlite').disk_usage_rollups()
+        api = self.api(inv, '-c', '--store', 'sqlite')
+        rollup = api.disk_usage_rollups()['capacity']
+        self.assertEqual(rollup.total,
+                         sum(d.size for vm in inv.vms for d in vm.disks))
@@ -0,0 +1,116 @@
+"""Smoke tests of the collection code against the vSphere simulator"""
+from tests.helpers import SimTestCase
+from vsphere_api import TaskError, VSphereApi
+from vsphere_sim import SimInventory, sim_connect
+
+SEARCH = 'SearchDatastoreSubFolders_Task'
+
+
+def keys(files):
+    return sorted((f.pathTo, f.fileName) for f in files)
+
+
+class VmLoadTest(SimTestCase):
+    def test_bulk_round_trips(self):
+        inv = SimInventory.generate(1000, 2000)
+        api = self.api(inv)
+        vms = api.load_all_vms_from_property_collector()
+        bulk = api.service_instance._stub.round_trips
+        self.assertEqual(sorted(vm.name for vm in vms),
+                         sorted(vm.name for vm in inv.vms))
+
+        api = self.api(inv)
+        vms = api.load_all_vms_from_api()
+        perVm = api.service_instance._stub.round_trips
+        self.assertEqual(sorted(vm.name for vm in vms),
+                         sorted(vm.name for vm in inv.vms))
+        # a few pages in bulk, against a few requests for each VM
+        self.assertLess(bulk, 10)
+        self.assertGreater(perVm, 3 * len(inv.vms))
+
+    def test_same_vms(self):
+        inv = SimInventory.generate(200, 400, vsan=True)
+        self.assertEqual(
+            sorted(self.api(inv).load_all_vms_from_property_collector()),
+            sorted(self.api(inv).load_all_vms_from_api()))
+
+
+class DeltaTest(SimTestCase):
+    def setUp(self):
+        SimTestCase.setUp(self)
+        self.inv = SimInventory.generate(100, 200)
+        self.si = sim_connect(self.inv)
+
+    def delta(self, si=None):
+        api = VSphereApi(self.args('-c', '--delta'),
+                         service_instance=si or self.si)
+        return sorted(api.list_all_vms())
+
+    def current(self):
+        api = VSphereApi(self.args(), service_instance=self.si)
+        return sorted(api.load_all_vms_from_property_collector())
+
+    def test_changes(self):
+        stub = self.si._stub
+        self.assertEqual(self.delta(), sorted(self.inv.vms))
+
+        before = stub.round_trips
+        self.assertEqual(self.delta(), sorted(self.inv.vms))
+        self.assertEqual(stub.round_trips - before, 1)
+
+        added = self.inv.vms[0]._replace(name='added')
+        stub.add_vm(added)
+        stub.update_vm(1, self.inv.vms[1]._replace(state='poweredOff'))
+        stub.remove_vm(2)
+        vms = self.delta()
+        self.assertEqual(vms, self.current())
+        self.assertIn(added, vms)
+        self.assertIn(self.inv.vms[1]._replace(state='poweredOff'), vms)
+        self.assertNotIn(self.inv.vms[2], vms)
+
+    def test_collector_gone(self):
+        self.delta()
+        # a new session, without the saved collector
+        si = sim_connect(self.inv)
+        self.assertEqual(self.delta(si), sorted(self.inv.vms))
+        # the saved collector is tried first, then a new one loads every VM
+        self.assertEqual(si._stub.calls['WaitForUpdatesEx'], 2)
+        self.assertEqual(si._stub.calls['CreatePropertyCollector'], 1)
+
+
+class CheckpointTest(SimTestCase):
+    def test_resume(self):
+        inv = SimInventory.generate(100, 2000)
+        api = self.api(inv, '-c', '--crawl', 'folders',
+                       failing_datastores=['LUN03'])
+        self.assertRaises(TaskError, list, api.load_all_files_from_api())
+        searched = api.service_instance._stub.calls[SEARCH]
+        shards = api.objStore.checkpoint_shards('sim')
+        self.assertEqual(set(ds for ds, folder in shards),
+                         set(['LUN01', 'LUN02', 'LUN04']))
+
+        # only the folders that failed are searched again
+        api = self.api(inv, '-c', '--crawl', 'folders')
+        self.assertEqual(keys(api.load_all_files_from_api()), keys(inv.files))
+        lun03 = len(inv.folders['LUN03'])
+        self.assertEqual(api.service_instance._stub.calls[SEARCH], lun03)
+        self.assertEqual(searched + lun03,
+                         sum(len(f) for f in inv.folders.values()))
+        self.assertFalse(api.objStore.checkpoint_shards('sim'))
+
+
+class SplitAfterTest(SimTestCase):
+    def test_split_and_remembered(self):
+        # the datastores take 2-4 secs to search, their folders far less
+        inv = SimInventory.generate(100, 4000)
+        api = self.api(inv, '-c', '--split_after', '1', search_rate=500)
+        self.assertEqual(keys(api.list_all_files()), keys(inv.files))
+        stub = api.service_instance._stub
+        self.assertTrue(stub.calls['CancelTask'])
+        self.assertEqual(len(api.searchSplits), stub.calls['CancelTask'])
+
+        # the next crawl splits them straight away, without waiting
+        api = self.api(inv, '-c', '--split_after', '1', '--max_age', '0',
+                       search_rate=500)
+        self.assertEqual(keys(api.list_all_files()), keys(inv.files))
+        self.assertEqual(api.service_instance._stub.calls['CancelTask'], 0)
@@ -0,0 +1,141 @@
+import random
+
+import snapshots
+from find_abandoned_files import parse_snapshot
+from rollup import Rollup
+from snapshots import SnapshotStore, diff_abandoned_folders, diff_files, \
+    diff_usage, external_sort
+from tests.helpers import SimTestCase, orphaned_files, renamed_vsan_inventory
+from vsphere_api import VSphereApi
+from vsphere_objects import DsFile
+from vsphere_sim import SimInventory, sim_connect
+
+
+class ExternalSortTest(SimTestCase):
+    def test_sorts_across_runs(self):
+        rand = random.Random(0)
+        records = [[rand.choice('abc'), rand.randint(0, 1000)]
+                   for i in range(5000)]
+        self.assertEqual(list(external_sort(records, tmpdir=self.cacheDir,
+                                            chunk=333)), sorted(records))
+
+    def test_fits_in_one_run(self):
+        self.assertEqual(list(external_sort([[2], [1]], chunk=3)),
+                         [[1], [2]])
+        self.assertEqual(list(external_sort([], chunk=3)), [])
+
+
+class SnapshotVsanTest(SimTestCase):
+    def test_abandoned_files(self):
+        inv = renamed_vsan_inventory()
+        expected = sorted((f.pathTo, f.fileName) for f in orphaned_files(inv))
+        for argv in [(), ('-c',), ('-c',), ('-c', '--store', 'sqlite')]:
+            api = self.api(inv, *argv)
+            snapshot = api.objStore.snapshots().open(api.save_snapshot())
+            self.assertEqual(sorted((f.pathTo, f.fileName)
+                                    for f in snapshot.iter_files()
+                                    if f.abandoned), expected)
+            self.assertEqual(snapshot.meta['files'], len(inv.files))
+
+    def test_one_crawl_for_the_report(self):
+        inv = renamed_vsan_inventory()
+        args = self.args()
+        args.snapshot = True
+        parse_snapshot(args)
+        api = VSphereApi(args, service_instance=sim_connect(inv))
+        api.save_snapshot()
+        summary = api.summarize_unaccounted_folders(match=['*.log'],
+                                                    processes=1)
+        self.assertEqual(summary.files, len(orphaned_files(inv)))
+        self.assertEqual(api.service_instance._stub.calls[
+            'SearchDatastoreSubFolders_Task'], len(inv.datastores))
+
+
+def changes(old, new, key):
+    old = dict((key(f), f) for f in old)
+    new = dict((key(f), f) for f in new)
+    result = {}
+    for k in set(old) | set(new):
+        if k not in old:
+            result[k] = 'added'
+        elif k not in new:
+            result[k] = 'removed'
+        elif old[k].size != new[k].size:
+            result[k] = 'resized'
+    return result
+
+
+class SnapshotDiffTest(SimTestCase):
+    def setUp(self):
+        SimTestCase.setUp(self)
+        snapshots.SORT_CHUNK = 700
+        self.old = SimInventory.generate(200, 3000)
+        rand = random.Random(1)
+        files = list(self.old.files)
+        removed = set(rand.sample(range(len(files)), 50))
+        resized = set(rand.sample(range(len(files)), 40)) - removed
+        files = [f._replace(size=f.size + 7) if i in resized else f
+                 for i, f in enumerate(files) if i not in removed]
+        ds = self.old.datastores[0]
+        files += [DsFile(ds, '[{}] new-orphan/'.format(ds),
+                         'file-{}.log'.format(i), 1000) for i in range(5)]
+        vms = [vm._replace(resourcePool='new-pool') if i < 10 else vm
+               for i, vm in enumerate(self.old.vms)]
+        self.new = SimInventory(vms, files)
+
+    def tearDown(self):
+        snapshots.SORT_CHUNK = 200000
+        SimTestCase.tearDown(self)
+
+    def snapshots(self):
+        runs = []
+        write = snapshots._write_gzip_records
+
+        def write_run(path, records, compresslevel=6):
+            if compresslevel == 1:
+                runs.append(path)
+            return write(path, records, compresslevel)
+        snapshots._write_gzip_records = write_run
+        try:
+            for inv in [self.old, self.new]:
+                self.api(inv).save_snapshot()
+        finally:
+            snapshots._write_gzip_records = write
+        # the files were sorted in runs of SORT_CHUNK and merged
+        self.assertGreater(len(runs), 2)
+        store = SnapshotStore(self.api(self.old).objStore.SNAPSHOTS_DIR)
+        names = store.names()
+        self.assertEqual(len(names), 2)
+        return store.open(names[0]), store.open(names[1])
+
+    def test_files(self):
+        old, new = self.snapshots()
+        self.assertEqual(
+            dict(((f.pathTo, f.fileName), change)
+                 for change, a, b in diff_files(old, new) for f in [b or a]),
+            changes(self.old.files, self.new.files,
+                    lambda f: (f.pathTo, f.fileName)))
+
+    def test_abandoned_folders(self):
+        old, new = self.snapshots()
+        diff = dict((folder, change) for change, folder, oldSize, newSize
+                    in diff_abandoned_folders(old, new))
+        self.assertEqual(diff['[{}] new-orphan/'.format(
+            self.old.datastores[0])], 'added')
+        self.assertTrue(all(folder.split('] ')[1].startswith('orphan-')
+                            for folder in diff if 'new-orphan' not in folder))
+
+    def test_usage(self):
+        old, new = self.snapshots()
+        grouping = ('resource_pool',)
+        before = dict((g, s) for g, s, c in
+                      Rollup().add_all(self.old.vms).rows(grouping))
+        after = dict((g, s) for g, s, c in
+                     Rollup().add_all(self.new.vms).rows(grouping))
+        usage = diff_usage(old, new, grouping)
+        self.assertEqual(
+            sorted(usage),
+            sorted((g, before.get(g, 0), after.get(g, 0))
+                   for g in set(before) | set(after)
+                   if before.get(g, 0) != after.get(g, 0)))
+        self.assertEqual(usage[0][0], ('new-pool',))
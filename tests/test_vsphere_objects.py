@@ -0,0 +1,53 @@
+import unittest
+
+from vsphere_objects import DsFile, FileTable
+from vsphere_sim import SimInventory
+
+DISK = u'\u30c7\u30a3\u30b9\u30af.vmdk'
+
+
+class FileTableTest(unittest.TestCase):
+    def setUp(self):
+        self.files = SimInventory.generate(20, 500, datastore_count=3).files
+        self.files += [
+            DsFile('LUN01', u'[LUN01] caf\xe9/', DISK, None),
+            DsFile('LUN01', '[LUN01] ', 'root.iso', 0),
+            DsFile('LUN02', '[LUN02] big/', 'big.vmdk', 2 ** 42),
+            DsFile('LUN02', '[LUN02] big/', u'', 1),
+        ]
+        self.table = FileTable(self.files)
+
+    def test_round_trip(self):
+        self.assertEqual(len(self.table), len(self.files))
+        self.assertEqual(list(self.table), self.files)
+        self.assertEqual([self.table[i] for i in range(len(self.files))],
+                         self.files)
+
+    def test_negative_indices(self):
+        for i in range(1, len(self.files) + 1):
+            self.assertEqual(self.table[-i], self.files[-i])
+        self.assertRaises(IndexError, lambda: self.table[len(self.files)])
+        self.assertRaises(IndexError,
+                          lambda: self.table[-len(self.files) - 1])
+
+    def test_sizes_and_names(self):
+        unicodeFile = self.table[-4]
+        self.assertIsNone(unicodeFile.size)
+        self.assertEqual(unicodeFile.fileName, DISK)
+        self.assertEqual(self.table[-3].size, 0)
+        self.assertEqual(self.table[-2].size, 2 ** 42)
+        self.assertEqual(self.table[-1].fileName, u'')
+
+    def test_folders_stored_once(self):
+        self.assertEqual(sorted(self.table.folders),
+                         sorted(set(f.pathTo for f in self.files)))
+        self.assertEqual(sorted(self.table.datastores),
+                         sorted(set(f.datastore for f in self.files)))
+
+    def test_empty(self):
+        table = FileTable()
+        self.assertEqual(len(table), 0)
+        self.assertEqual(list(table), [])
+        self.assertRaises(IndexError, lambda: table[0])
+        table.append(self.files[0])
+        self.assertEqual(list(table), self.files[:1])
@@ -0,0 +1,34 @@
+import csv
+import json
+import os
+
+from tests.helpers import SimTestCase
+from writers import WRITERS
+
+FIELDS = ['name', 'path', 'size']
+RECORDS = [{'name': 'a', 'path': ['x', 'y'], 'size': 1},
+           {'name': u'b\xe9', 'path': [], 'size': None}]
+
+
+class WritersTest(SimTestCase):
+    def write(self, fmt, records):
+        path = os.path.join(self.cacheDir, 'out')
+        with WRITERS[fmt](FIELDS, path) as writer:
+            for record in records:
+                writer.write(record)
+        with open(path) as fp:
+            return fp.read()
+
+    def test_ndjson(self):
+        lines = self.write('ndjson', RECORDS).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], RECORDS)
+
+    def test_json(self):
+        self.assertEqual(json.loads(self.write('json', RECORDS)), RECORDS)
+        self.assertEqual(json.loads(self.write('json', [])), [])
+
+    def test_csv(self):
+        rows = list(csv.reader(self.write('csv', RECORDS).splitlines()))
+        self.assertEqual(rows[0], FIELDS)
+        self.assertEqual(rows[1], ['a', 'x / y', '1'])
+        self.assertEqual(len(rows), 3)
@@ -1,3 +1,5 @@
+import importlib
+
 
 def convert_size(b):
     b = (b, 'bytes')
@@ -15,3 +17,33 @@ def convert_size(b):
         return "{:>7.2f}{}".format(*gb)
     else:
         return "{:>7.2f}{}".format(*tb)
+
+
+class LazyImport:
+    """Stands in for a module, or a name in one, until it's first used
+
+    pyVim & pyVmomi take a good part of a second to import, which runs that
+    get everything from the cache never need.  `LazyImport('pyVim.connect')`
+    imports `pyVim.connect`, and `LazyImport('pyVmomi', 'vim')` imports
+    `pyVmomi.vim`, when it's first used.  `name` can be dotted, like
+    `vmodl.query.PropertyCollector`.
+    """
+    def __init__(self, module, name=None):
+        self._module = module
+        self._name = name
+        self._target = None
+
+    def _resolve(self):
+        if self._target is None:
+            target = importlib.import_module(self._module)
+            for part in (self._name or '').split('.'):
+                if part:
+                    target = getattr(target, part)
+            self._target = target
+        return self._target
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
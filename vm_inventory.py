@@ -0,0 +1,261 @@
+"""Keeps a list of VMs up-to-date using vSphere's change notifications
+
+Rather than loading every VM each time, a `VmInventory` registers a property
+collector filter on the properties we report on, for every VM and the
+resource pools, hosts, clusters, folders and datastores they're in.  The
+first call to `WaitForUpdatesEx` returns all of them, after that it returns
+only the objects that have been added (`enter`), changed (`modify`) or
+removed (`leave`) since the version we pass in.
+
+The property collector lives as long as the vSphere session, so with a
+saved session (`--session_cache`) the collector and version can be stored
+with the cache and picked up by the next run.  A long running process can
+call `update` in a loop to always have a current list of VMs, each call
+costs one request and returns as soon as something changes.
+"""
+from collections import defaultdict
+
+from rollup import datastore_name
+from utils import LazyImport
+from vsphere_objects import Vm, Disk, DsUsage
+
+vim = LazyImport('pyVmomi', 'vim')
+PC = LazyImport('pyVmomi', 'vmodl.query.PropertyCollector')
+
+# property path -> VM record field
+VM_PROPERTIES = {
+    'summary.config.name': 'name',
+    'summary.config.vmPathName': 'path',
+    'summary.runtime.powerState': 'state',
+    'summary.guest.ipAddress': 'ip',
+    'resourcePool': 'pool',
+    'runtime.host': 'host',
+    'parent': 'folder',
+    'config.hardware.device': 'disks',
+    'layoutEx.file': 'files',
+    'storage.perDatastoreUsage': 'storage',
+}
+
+
+def committed_by_datastore(files):
+    """Sums the sizes of a VM's files (`layoutEx.file`) on each datastore"""
+    committed = defaultdict(int)
+    for f in files:
+        committed[datastore_name(f.name)] += f.size or 0
+    return dict(committed)
+
+
+def storage_usage(committed, usage):
+    """Lists a VM's `DsUsage` on each datastore
+
+    `committed` is from `committed_by_datastore`, `usage` is a list of
+    (datastore name, committed, uncommitted) from `storage.perDatastoreUsage`.
+    The file layout is current, while vCenter only refreshes the storage
+    usage every so often, so that's only used for the committed space on
+    datastores missing from the layout.
+    """
+    committed = dict(committed)
+    uncommitted = {}
+    for name, usageCommitted, usageUncommitted in usage:
+        committed.setdefault(name, usageCommitted or 0)
+        uncommitted[name] = usageUncommitted or 0
+    return [DsUsage(name, committed[name], uncommitted.get(name, 0))
+            for name in sorted(committed)]
+
+
+def vm_filter_spec(view):
+    """Selects what we need to know about every VM in a container view
+
+    That's the properties in `VM_PROPERTIES`, plus the names of the resource
+    pools, hosts, folders and datastores the VMs are in and of the clusters
+    the hosts are in, all in one request.
+    """
+    hostToCluster = PC.TraversalSpec(
+        name='hostToCluster', type=vim.HostSystem,
+        path='parent', skip=False)
+    vmToPool = PC.TraversalSpec(
+        name='vmToResourcePool', type=vim.VirtualMachine,
+        path='resourcePool', skip=False)
+    vmToHost = PC.TraversalSpec(
+        name='vmToHost', type=vim.VirtualMachine,
+        path='runtime.host', skip=False, selectSet=[hostToCluster])
+    vmToFolder = PC.TraversalSpec(
+        name='vmToFolder', type=vim.VirtualMachine,
+        path='parent', skip=False)
+    vmToDatastore = PC.TraversalSpec(
+        name='vmToDatastore', type=vim.VirtualMachine,
+        path='datastore', skip=False)
+    viewToVms = PC.TraversalSpec(
+        name='viewToVms', type=vim.view.ContainerView,
+        path='view', skip=False,
+        selectSet=[vmToPool, vmToHost, vmToFolder, vmToDatastore])
+    return PC.FilterSpec(
+        objectSet=[PC.ObjectSpec(
+            obj=view, skip=True, selectSet=[viewToVms])],
+        propSet=[
+            PC.PropertySpec(type=vim.VirtualMachine, all=False,
+                            pathSet=sorted(VM_PROPERTIES.keys())),
+            PC.PropertySpec(type=vim.ResourcePool, all=False,
+                            pathSet=['name']),
+            PC.PropertySpec(type=vim.HostSystem, all=False,
+                            pathSet=['name', 'parent']),
+            PC.PropertySpec(type=vim.ComputeResource, all=False,
+                            pathSet=['name']),
+            PC.PropertySpec(type=vim.Folder, all=False,
+                            pathSet=['name']),
+            PC.PropertySpec(type=vim.Datastore, all=False,
+                            pathSet=['name'])])
+
+
+class VmInventory:
+    # max number of objects vSphere should return per update
+    PAGE_SIZE = 500
+    # bumped when what's kept in `state` changes, older states are ignored
+    STATE_FORMAT = 3
+
+    def __init__(self, service_instance, build_disks):
+        """`build_disks` turns a VM's devices into a list of `Disk`"""
+        self.service_instance = service_instance
+        self.build_disks = build_disks
+        self.collector = None
+        self.view = None
+        self.version = ''
+        # moId -> dict of VM record fields, `pool`, `host` and `folder` are
+        #  the moIds of those objects, `files` is from
+        #  `committed_by_datastore` and `storage` is a list of (datastore
+        #  moId, committed, uncommitted)
+        self.vms = {}
+        # moId -> name, of resource pools, hosts, clusters, folders and
+        #  datastores
+        self.names = {}
+        # host moId -> cluster moId, for hosts in a cluster
+        self.clusters = {}
+
+    def start(self):
+        """Creates the property collector & filter, on the server"""
+        content = self.service_instance.RetrieveContent()
+        self.view = content.viewManager.CreateContainerView(
+            content.rootFolder, [vim.VirtualMachine], True)
+        self.collector = content.propertyCollector.CreatePropertyCollector()
+        self.collector.CreateFilter(vm_filter_spec(self.view), False)
+
+    def resume(self, state):
+        """Picks up a collector saved with `state`
+
+        The collector isn't checked until the next `update`, which raises
+        `ManagedObjectNotFound` if it's gone with its session or
+        `InvalidCollectorVersion` if the version is no good.
+        """
+        stub = self.service_instance._stub
+        self.collector = PC(state['collector'], stub)
+        self.view = vim.view.ContainerView(state['view'], stub)
+        self.version = state['version']
+        self.vms = state['vms']
+        self.names = state['names']
+        self.clusters = state['clusters']
+
+    def state(self):
+        """Returns the collector, version and records as a json-able dict"""
+        return {
+            'format': self.STATE_FORMAT,
+            'collector': self.collector._moId,
+            'view': self.view._moId,
+            'version': self.version,
+            'vms': self.vms,
+            'names': self.names,
+            'clusters': self.clusters,
+        }
+
+    def update(self, max_wait=0):
+        """Applies the changes since the last update, returns how many
+
+        Waits up to `max_wait` seconds for something to change, or returns
+        straight away if that's 0.
+        """
+        changed = 0
+        while True:
+            update = self.collector.WaitForUpdatesEx(
+                self.version, PC.WaitOptions(maxWaitSeconds=max_wait,
+                                             maxObjectUpdates=self.PAGE_SIZE))
+            if update is None:
+                break
+            for filterSet in update.filterSet:
+                for objUpdate in filterSet.objectSet:
+                    self._apply(objUpdate)
+                    changed += 1
+            self.version = update.version
+            if not update.truncated:
+                break
+            # there's more to come, fetch it without waiting
+            max_wait = 0
+        return changed
+
+    def _apply(self, objUpdate):
+        obj = objUpdate.obj
+        if objUpdate.kind == 'leave':
+            self.vms.pop(obj._moId, None)
+            self.names.pop(obj._moId, None)
+            self.clusters.pop(obj._moId, None)
+            return
+        if objUpdate.kind == 'enter':
+            self.vms.pop(obj._moId, None)
+        self.set_properties(obj, (
+            (change.name, change.val if change.op == 'assign' else None)
+            for change in objUpdate.changeSet))
+
+    def set_properties(self, obj, props):
+        """Records (property path, value) pairs for an object"""
+        if not isinstance(obj, vim.VirtualMachine):
+            for name, val in props:
+                if name == 'name':
+                    self.names[obj._moId] = val
+                elif name == 'parent' and \
+                        isinstance(val, vim.ClusterComputeResource):
+                    self.clusters[obj._moId] = val._moId
+                elif name == 'parent':
+                    self.clusters.pop(obj._moId, None)
+            return
+
+        record = self.vms.get(obj._moId)
+        if record is None:
+            record = self.vms[obj._moId] = dict(
+                (field, None) for field in VM_PROPERTIES.values())
+            record['disks'] = []
+            record['files'] = {}
+            record['storage'] = []
+        for name, val in props:
+            field = VM_PROPERTIES.get(name)
+            if field is None:
+                continue
+            if field in ('pool', 'host', 'folder'):
+                val = val._moId if val else None
+            elif field == 'disks':
+                val = [list(disk) for disk in self.build_disks(val or [])]
+            elif field == 'files':
+                val = committed_by_datastore(val or [])
+            elif field == 'storage':
+                val = [[usage.datastore._moId, usage.committed,
+                        usage.uncommitted] for usage in val or []]
+            record[field] = val
+
+    def list_vms(self):
+        names = self.names
+        return [Vm(name=rec['name'],
+                   path=rec['path'],
+                   resourcePool=names.get(rec['pool']),
+                   state=rec['state'],
+                   ip=rec['ip'],
+                   disks=[Disk._make(disk) for disk in rec['disks']],
+                   host=names.get(rec['host']),
+                   cluster=names.get(self.clusters.get(rec['host'])),
+                   folder=names.get(rec['folder']),
+                   storage=storage_usage(
+                       rec['files'],
+                       [(names.get(ds), committed, uncommitted)
+                        for ds, committed, uncommitted in rec['storage']]))
+                for rec in self.vms.values()]
+
+    def destroy(self):
+        """Removes the collector & filter from the server"""
+        self.collector.DestroyPropertyCollector()
+        self.view.Destroy()
@@ -1,49 +1,363 @@
+import itertools
+import logging
 import ssl
+import threading
 import time
 
-from vsphere_objects import Vm, Disk, DsFile, VSphereObjectStore
-from pyVim import connect
-from pyVmomi import vim
-from Queue import Queue, Empty
-from threading import Thread
+import six
+from collections import defaultdict
+from collector import Collector, TokenBucket, rate_limit_stub
+from profiler import Profiler
+from progress import Progress, log
+from reconcile import FileFilter, FolderAliases, FolderSummary, VmIndex, \
+    find_unaccounted_files, summarize_unaccounted
+from rollup import Rollup
+from session_cache import SessionCache
+from vm_inventory import VmInventory, committed_by_datastore, \
+    storage_usage, vm_filter_spec
+from vsphere_objects import Vm, Disk, DsFile, FileTable, \
+    VSphereObjectStore, SqliteObjectStore
+from utils import LazyImport
+
+# only imported once we need to talk to vSphere
+connect = LazyImport('pyVim.connect')
+vim = LazyImport('pyVmomi', 'vim')
+vmodl = LazyImport('pyVmomi', 'vmodl')
+
+
+class TaskError(Exception):
+    """A vSphere task failed or did not finish in time"""
+    pass
+
+
+class TaskTimeout(TaskError):
+    """A vSphere task did not finish in time and was cancelled"""
+    pass
 
 
 class VSphereApi:
-    def __init__(self, args):
+    # max number of objects vSphere should return per page when using the
+    #  property collector to bulk load properties
+    PAGE_SIZE = 500
+    # max number of seconds to block waiting on a task before checking in
+    TASK_WAIT_SECS = 60
+    # methods that are reported as phases when profiling, these must only
+    #  be called from the main thread
+    PROFILED_PHASES = ['list_all_vms', 'list_all_files',
+                       'disk_usage_rollups',
+                       'list_unaccounted_folders',
+                       'summarize_unaccounted_folders',
+                       'load_all_vms_from_api',
+                       'load_all_vms_from_property_collector',
+                       'load_all_vms_from_updates',
+                       'load_datastore_summaries',
+                       'load_all_files_from_search_api',
+                       'load_all_files_from_api']
+
+    def __init__(self, args, service_instance=None, always_connect=False):
+        """Sets up to connect to vSphere the first time it's needed
+
+        Pass a `service_instance` to use an existing connection instead,
+        for example one from `vsphere_sim`.  `always_connect` connects
+        straight away, for processes that keep watching vSphere.
+        """
         self.args = args
-        self.service_instance = None
-        self.objStore = VSphereObjectStore()
-
-        # setup SSL context
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
-        ssl_context.verify_mode = ssl.CERT_NONE \
-            if args.disable_ssl_verification else ssl.CERT_REQUIRED
-
-        # setup vSphere connection
-        if not args.cache or (args.cache and (
-                not self.objStore.vms_cache_exists() or
-                not self.objStore.files_cache_exists())):
-            self.service_instance = connect.SmartConnect(
+        self._service_instance = None
+        self._connectLock = threading.Lock()
+        self.objStore = SqliteObjectStore(args.cache_dir) \
+            if args.store == 'sqlite' else VSphereObjectStore(args.cache_dir)
+        self.collector = Collector(args.concurrency)
+        self.sessions = SessionCache()
+        # filled in as datastores are crawled, or from the cache
+        self.aliases = FolderAliases()
+        # datastore -> folders that are searched a level at a time, rather
+        #  than recursively, see `load_all_files_from_search_api`
+        self.searchSplits = {}
+        # the files that crawls are limited to, see `list_all_files`
+        self.fileFilter = FileFilter()
+        # datastores whose files the last crawl couldn't all search
+        self.failedDatastores = set()
+        self.profiler = None
+        if args.profile:
+            self.profiler = Profiler()
+            for name in self.PROFILED_PHASES:
+                setattr(self, name, self.profiler.wrap_phase(
+                    name, getattr(self, name)))
+
+        if service_instance:
+            self._instrument(service_instance)
+            self._service_instance = service_instance
+        elif always_connect:
+            self.connect()
+
+    @property
+    def service_instance(self):
+        """The connection to vSphere, made the first time it's used
+
+        A run that gets everything it needs from the cache never connects,
+        or even imports pyVmomi.
+        """
+        if self._service_instance is None:
+            self.connect()
+        return self._service_instance
+
+    def connect(self):
+        with self._connectLock:
+            if self._service_instance is not None:
+                return
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
+            ssl_context.verify_mode = ssl.CERT_NONE \
+                if self.args.disable_ssl_verification else ssl.CERT_REQUIRED
+
+            start = time.time()
+            si = self._connect(ssl_context)
+            if self.profiler:
+                self.profiler.record(
+                    'SmartConnect', start, time.time() - start)
+            self._instrument(si)
+            self._service_instance = si
+
+    def _instrument(self, si):
+        if self.profiler:
+            self.profiler.instrument_stub(si._stub)
+        if self.args.rate:
+            rate_limit_stub(si._stub, TokenBucket(self.args.rate))
+
+    def _connect(self, ssl_context):
+        """Logs in to vSphere, or resumes the saved session if there is one"""
+        args = self.args
+        si = None
+        if args.session_cache:
+            si = self.sessions.resume(
+                args.host, args.port, args.user, ssl_context)
+        if not si:
+            si = connect.SmartConnect(
                 host=args.host,
                 user=args.user,
                 pwd=args.password,
                 port=int(args.port),
                 sslContext=ssl_context)
+            if args.session_cache:
+                self.sessions.save(args.host, args.port, args.user, si._stub)
+
+        # give each worker thread its own HTTP connection, by default the
+        #  stub only keeps 5 around and opens a new one for each request
+        #  beyond that
+        si._stub.poolSize = max(args.concurrency, args.max_searches)
+        return si
 
     def close(self):
-        if self.service_instance:
+        if not self._service_instance:
+            return
+        if self.args.session_cache:
+            # leave the session logged in for the next run
+            self.service_instance._stub.DropConnections()
+        else:
             connect.Disconnect(self.service_instance)
 
+    def vms_cache_is_fresh(self):
+        """Checks if the VMs cache can be used without talking to vSphere
+
+        With `--delta` we always ask vSphere what's changed, so it's never
+        fresh.  Caches from before all of the `Vm` fields were collected
+        aren't either.
+        """
+        if self.args.delta:
+            return False
+        entry = self.objStore.vms_cache_entry()
+        return (self.objStore.vms_cache_exists() and
+                (entry or {}).get('fields') == len(Vm._fields) and
+                self.objStore.cache_entry_is_fresh(
+                    entry, self.args.host, self.args.max_age))
+
+    def files_cache_is_fresh(self):
+        """Checks if the files cache can be used without talking to vSphere
+
+        With `--refresh_changed` we always need to ask vSphere if the
+        datastores have changed, so it's never fresh.
+        """
+        if not self.objStore.files_cache_exists() or \
+                self.args.refresh_changed:
+            return False
+        entries = self.objStore.datastore_cache_entries()
+        if not entries:
+            return self.objStore.cache_entry_is_fresh(
+                None, self.args.host, self.args.max_age)
+        return all(self.objStore.cache_entry_is_fresh(
+            entry, self.args.host, self.args.max_age) and
+            self._filter_covered(entry)
+            for entry in entries.values())
+
+    def _filter_covered(self, entry):
+        # files cached with a filter can only be used for the same files
+        #  or fewer
+        return FileFilter.from_dict(entry.get('filter')).covers(
+            self.fileFilter)
+
     def list_all_vms(self):
         # load list of vms from vSphere or cache
-        if self.args.cache and self.objStore.vms_cache_exists():
-            vms = self.objStore.load_list_of_vms_from_json()
+        if self.args.cache and self.vms_cache_is_fresh():
+            vms = self.objStore.iter_vms()
+        elif self.args.cache and self.args.delta:
+            vms = self.load_all_vms_from_updates()
+            self.objStore.save_vms(vms, self.args.host)
         else:
-            vms = self.load_all_vms_from_api()
+            vms = self.load_all_vms_from_property_collector()
+            # vms = self.load_all_vms_from_api()
             if self.args.cache:
-                self.objStore.save_list_of_vms_to_json(vms)
+                self.objStore.save_vms(vms, self.args.host)
         return vms
 
+    def _can_query_store(self):
+        # the sqlite store can answer reports with queries, but only if it's
+        #  caching the data
+        return self.args.cache and isinstance(self.objStore, SqliteObjectStore)
+
+    def disk_usage_rollups(self, groupings=(), measures=('capacity',)):
+        """Sums usage by each of `groupings` in one pass over the VMs
+
+        Each grouping is a tuple of dimensions from `rollup.DIMENSIONS`,
+        every dimension on its own is always included.  Returns a dict of
+        measure -> `Rollup`, for each of `measures` from `rollup.MEASURES`.
+        With the cache on, the rollups are saved along with the VMs, so
+        later reports on any of the groupings in them come straight from
+        the cache until the VMs are loaded again.
+        """
+        if self.args.cache and self.vms_cache_is_fresh():
+            saved = self.objStore.load_rollup()
+            if saved and saved.get('vms_captured') == self._vms_captured():
+                rollups = dict(
+                    (measure, Rollup.from_dict(rollup))
+                    for measure, rollup in saved.get('rollups', {}).items())
+                if all(measure in rollups and
+                       rollups[measure].covers(groupings)
+                       for measure in measures):
+                    return rollups
+
+        if self._can_query_store():
+            # summed by the database, without loading the VMs
+            self.list_all_vms()  # make sure the cache is loaded
+            rollups = dict((measure, Rollup.from_rows(
+                groupings, measure,
+                lambda grouping: self.objStore.disk_usage_rows(
+                    grouping, measure),
+                self.objStore.count_vms())) for measure in measures)
+        else:
+            rollups = dict((measure, Rollup(groupings, measure))
+                           for measure in measures)
+            for vm in self.list_all_vms():
+                for rollup in rollups.values():
+                    rollup.add(vm)
+        if self.args.cache:
+            self.objStore.save_rollup({
+                'vms_captured': self._vms_captured(),
+                'rollups': dict((measure, rollup.to_dict())
+                                for measure, rollup in rollups.items())})
+        return rollups
+
+    def _vms_captured(self):
+        entry = self.objStore.vms_cache_entry()
+        return entry.get('captured') if entry else None
+
+    def list_unaccounted_folders(self, ignore=(), match=()):
+        """Lists files that don't belong to a VM, grouped by folder
+
+        Returns an iterable of (folder, [file names]).  Files in folders
+        containing any of the strings in `ignore` are skipped, and with
+        `match` only files with names matching one of the patterns are
+        looked at.  Only those files are searched for, see `FileFilter`.
+        """
+        if self._can_query_store():
+            fileFilter = FileFilter(match, ignore)
+            self._load_for_query(fileFilter)
+            return self.objStore.iter_unaccounted_folders(
+                fileFilter.ignore, fileFilter.match)
+
+        folders = defaultdict(list)
+        for f in self.iter_unaccounted_files(ignore, match):
+            folders[f.pathTo].append(f.fileName)
+        return folders.items()
+
+    def summarize_unaccounted_folders(self, ignore=(), match=(),
+                                      processes=None):
+        """Sorts the folders of files that don't belong to a VM by category
+
+        Takes the same arguments as `list_unaccounted_folders` and returns a
+        `FolderSummary`.  Files are split by datastore and matched in up to
+        `processes` processes, see `reconcile.summarize_unaccounted`, or
+        with the sqlite store by one query.
+        """
+        if self._can_query_store():
+            summary = FolderSummary()
+            for folder, fileNames in self.list_unaccounted_folders(
+                    ignore, match):
+                summary.add(folder, fileNames)
+            fileFilter = FileFilter(match, ignore)
+            summary.checked = self.objStore.count_files(fileFilter.ignore,
+                                                        fileFilter.match)
+            return summary
+
+        fileFilter = FileFilter(match, ignore)
+        shards = defaultdict(FileTable)
+        progress = Progress('Files loaded')
+        for f in progress.iterate(self.list_all_files(fileFilter)):
+            if fileFilter.accepts(f):
+                shards[f.datastore].append(f)
+        progress.finish()
+        return summarize_unaccounted(list(self.list_all_vms()),
+                                     list(shards.values()),
+                                     self.aliases, processes)
+
+    def iter_unaccounted_files(self, ignore=(), match=()):
+        """Yields each `DsFile` that doesn't belong to a VM as it's found
+
+        Takes the same arguments as `list_unaccounted_folders`.  Files are
+        matched to the VMs as the datastores are crawled, or with the
+        sqlite store by one query once they're all loaded.
+        """
+        fileFilter = FileFilter(match, ignore)
+        if self._can_query_store():
+            self._load_for_query(fileFilter)
+            for f in self.objStore.iter_unaccounted_files(
+                    fileFilter.ignore, fileFilter.match):
+                yield f
+            return
+
+        files = (f for f in self.list_all_files(fileFilter)
+                 if fileFilter.accepts(f))
+        progress = Progress('Files checked')
+        for f in find_unaccounted_files(self.list_all_vms(),
+                                        progress.iterate(files),
+                                        self.aliases):
+            yield f
+        progress.finish()
+
+    def _load_for_query(self, fileFilter):
+        # make sure the cache is loaded
+        self.list_all_files(fileFilter)
+        self.list_all_vms()
+
+    def save_snapshot(self):
+        """Saves a dated snapshot of every file and the VMs' disk usage
+
+        Each file is marked with whether it's accounted for by a VM, see
+        `snapshots`.  All the files are needed, so with `-c` a cache of
+        filtered files is searched again, and without it the files can't be
+        used for a report afterwards.  Returns the snapshot's name.
+        """
+        vms = list(self.list_all_vms())
+        files = self.list_all_files()
+        # loading the files from the cache loads its aliases, the index
+        #  needs those rather than the ones from before
+        index = VmIndex(vms, self.aliases)
+        progress = Progress('Files snapshotted')
+        name = self.objStore.snapshots().save(
+            vms, progress.iterate(files),
+            lambda f: not index.is_accounted(f), self.args.host)
+        progress.finish()
+        log.info("Saved snapshot %s", name)
+        return name
+
     def load_all_vms_from_api(self):
         content = self.service_instance.RetrieveContent()
         container = content.rootFolder  # starting point to look into
@@ -53,79 +367,268 @@ class VSphereApi:
         containerView = content.viewManager.CreateContainerView(
             container, viewType, recursive)
 
-        # initialize queue and worker threads
-        q = Queue()
-        done = False
+        vms = containerView.view
+        progress = Progress('VMs loaded', total=len(vms))
 
-        def handle_vm(ctx, vm):
+        def handle_vm(vm):
             summary = vm.summary
-            devices = vm.config.hardware.device
+            host = vm.runtime.host
+            cluster = host.parent if host else None
+            layout = vm.layoutEx
+            storage = vm.storage
             vm_rec = Vm(
                 name=summary.config.name,
                 path=summary.config.vmPathName,
                 resourcePool=vm.resourcePool.name if vm.resourcePool else None,
                 state=summary.runtime.powerState,
                 ip=summary.guest.ipAddress,
-                disks=[])
-            for disk in devices:
-                if type(disk) == vim.vm.device.VirtualDisk:
-                    dt = "thin" if disk.backing.thinProvisioned else "thick"
-                    vm_rec.disks.append(
-                        Disk(label=disk.deviceInfo.label,
-                             summary=disk.deviceInfo.summary,
-                             path=disk.backing.fileName,
-                             size=disk.capacityInBytes,
-                             mode=disk.backing.diskMode,
-                             type=dt))
-            ctx.append(vm_rec)
-            print("Located vm [{}]".format(vm_rec.name))
-
-        def worker():
-            while not done:
-                try:
-                    (ctx, vm) = q.get(True, 1)
-                    handle_vm(ctx, vm)
-                    q.task_done()
-                except Empty:
-                    pass
-
-        threads = []
-        for i in range(15):
-            t = Thread(target=worker)
-            t.start()
-            threads.append(t)
-
-        # load up the queue with work
-        # Note: ctx is shared across all worker threads,
-        #   but it's a list and we're only appending so it should be OK
-        #     https://stackoverflow.com/questions/6319207/are-lists-thread-safe
-        ctx = []
-        for child in containerView.view:
-            q.put((ctx, child))
+                disks=self._build_disks(vm.config.hardware.device),
+                host=host.name if host else None,
+                cluster=cluster.name if isinstance(
+                    cluster, vim.ClusterComputeResource) else None,
+                folder=vm.parent.name if vm.parent else None,
+                storage=storage_usage(
+                    committed_by_datastore(layout.file if layout else []),
+                    [(usage.datastore.name, usage.committed,
+                      usage.uncommitted)
+                     for usage in (storage.perDatastoreUsage
+                                   if storage else [])]))
+            log.debug("Located vm [%s]", vm_rec.name)
+            progress.update()
+            return vm_rec
 
-        # wait for it to finish & clean up threads
-        q.join()
-        done = True
-        [th.join() for th in threads]
+        ctx = list(self.collector.map(handle_vm, vms))
+        progress.finish()
         return ctx
 
-    def list_all_files(self):
-        # load list of files from vSphere or cache
-        if self.args.cache and self.objStore.files_cache_exists():
-            files = self.objStore.load_list_of_files_from_json()
-        else:
-            files = self.load_all_files_from_search_api()
-            # files = self.load_all_files_from_api()
-            if self.args.cache:
-                self.objStore.save_list_of_files_to_json(files)
-        return files
+    def load_all_vms_from_property_collector(self):
+        """Loads all VMs using bulk requests to the property collector
 
-    def load_all_files_from_search_api(self):
-        """Loads all files using a recursive search run on all datastores
+        Rather than walking the list of VMs and fetching the properties of
+        each one (every property access is a round trip to the server), this
+        asks the property collector for just the properties we need on every
+        VM in one go.  The resource pool, host, cluster, folder and datastores
+        of each VM are traversed in the same request so we can get their
+        names too.
+        Results come back in pages of `PAGE_SIZE` objects, so the number of
+        requests depends on the number of pages not the number of VMs.
+        """
+        content = self.service_instance.RetrieveContent()
+        containerView = content.viewManager.CreateContainerView(
+            content.rootFolder, [vim.VirtualMachine], True)
 
-        Logically this is pretty simple.  Just point it at the datastore and
-        search recursively for all files.
+        # pools, hosts, etc. can come back on a later page than the VMs that
+        #  reference them, so collect everything before building records
+        records = VmInventory(self.service_instance, self._build_disks)
+        progress = Progress('VMs loaded')
+        try:
+            for obj, props in self.retrieve_properties(
+                    vm_filter_spec(containerView)):
+                records.set_properties(obj, props.items())
+                if isinstance(obj, vim.VirtualMachine):
+                    progress.update()
+        finally:
+            containerView.Destroy()
+        progress.finish()
+
+        ctx = records.list_vms()
+        if log.isEnabledFor(logging.DEBUG):
+            for vm_rec in ctx:
+                log.debug("Located vm [%s]", vm_rec.name)
+        return ctx
+
+    def load_all_vms_from_updates(self):
+        """Loads all VMs, applying just the changes since the last run
+
+        Picks up the property collector saved in the object store by the
+        last run and applies the VMs added, changed or removed since then,
+        see `vm_inventory`.  The collector only lasts as long as the session,
+        so this needs `--session_cache` to help.  If there's no saved
+        collector or it's gone, a new one is created and all VMs loaded.
+        """
+        inventory = VmInventory(self.service_instance, self._build_disks)
+        state = self.objStore.vm_updates_state()
+        changed = None
+        if state and state.get('host') == self.args.host and \
+                state.get('format') == VmInventory.STATE_FORMAT:
+            inventory.resume(state)
+            try:
+                changed = inventory.update()
+                log.info("Applied %d VM changes since the last run", changed)
+            except (vmodl.fault.ManagedObjectNotFound,
+                    vmodl.query.InvalidCollectorVersion) as e:
+                log.info("Unable to resume VM updates, loading all VMs [%s]",
+                         e.msg)
+                inventory = VmInventory(self.service_instance,
+                                        self._build_disks)
+        if changed is None:
+            inventory.start()
+            inventory.update()
+
+        state = inventory.state()
+        state['host'] = self.args.host
+        self.objStore.save_vm_updates_state(state)
+        return inventory.list_vms()
+
+    def retrieve_properties(self, filterSpec):
+        """Run a property collector query, following all result pages
+
+        Yields a tuple of (managed object, dict of property path -> value)
+        for each object matched by `filterSpec`.
+        """
+        pc = self.service_instance.RetrieveContent().propertyCollector
+        options = vmodl.query.PropertyCollector.RetrieveOptions(
+            maxObjects=self.PAGE_SIZE)
+        result = pc.RetrievePropertiesEx([filterSpec], options)
+        while result:
+            for objContent in result.objects:
+                yield (objContent.obj,
+                       dict((p.name, p.val) for p in objContent.propSet))
+            if not result.token:
+                break
+            result = pc.ContinueRetrievePropertiesEx(result.token)
+
+    def _build_disks(self, devices):
+        disks = []
+        for disk in devices:
+            if type(disk) == vim.vm.device.VirtualDisk:
+                dt = "thin" if disk.backing.thinProvisioned else "thick"
+                disks.append(
+                    Disk(label=disk.deviceInfo.label,
+                         summary=disk.deviceInfo.summary,
+                         path=disk.backing.fileName,
+                         size=disk.capacityInBytes,
+                         mode=disk.backing.diskMode,
+                         type=dt))
+        return disks
+
+    def list_all_files(self, fileFilter=None, refresh=False):
+        """Loads files from vSphere or cache
+
+        Returns an iterable that streams the files, so they never need to
+        all be in memory at once.  Pass a `FileFilter` to search for just
+        those files, the cache is reused as long as it was searched for at
+        least those files.  Files that don't pass the filter may still be
+        returned.  `refresh` searches every datastore again whatever's
+        cached.
+        """
+        self.fileFilter = fileFilter or FileFilter()
+        if not self.args.cache:
+            return self._crawl()
+        if not refresh and self.files_cache_is_fresh():
+            self.aliases = FolderAliases(self.objStore.folder_aliases())
+            return self.objStore.iter_files()
+
+        # work out which datastores need to be crawled again, that's all of
+        #  them if there's no cache, otherwise just the ones that are stale
+        #  or have changed since they were cached
+        current = self.load_datastore_summaries()
+        cached = []
+        stale = current
+        forget = []
+        if self.objStore.files_cache_exists():
+            entries = self.objStore.datastore_cache_entries()
+            stale = dict((name, ds) for name, ds in current.items()
+                         if refresh or
+                         self._datastore_is_stale(entries.get(name), ds))
+            forget = [name for name in entries if name not in current]
+            cached = (f for f in self.objStore.iter_files()
+                      if f.datastore not in stale and
+                      f.datastore not in forget)
+            self.aliases = FolderAliases(self.objStore.folder_aliases())
+            self.aliases.forget(set(stale) | set(forget))
+        self.searchSplits = dict(
+            (name, set(paths))
+            for name, paths in self.objStore.search_splits().items()
+            if name not in forget)
+        log.info("Refreshing files on %d of %d datastores",
+                 len(stale), len(current))
+
+        failures = []
+
+        def crawl():
+            # a crawl raises once every search has finished, the files from
+            #  the searches that succeeded are still saved
+            try:
+                for f in self._crawl([ds for (ds, summary) in stale.values()]):
+                    yield f
+            except TaskError as e:
+                failures.append(e)
+
+        # files are written to the cache as they're found, then streamed
+        #  back out of the cache
+        self.objStore.save_files(
+            itertools.chain(cached, crawl()),
+            datastores=dict(
+                (name, dict(summary, filter=self.fileFilter.to_dict()))
+                for name, (ds, summary) in stale.items()),
+            host=self.args.host,
+            forget=forget)
+        self.objStore.save_folder_aliases(self.aliases.to_dict())
+        self.objStore.save_search_splits(dict(
+            (name, sorted(paths))
+            for name, paths in self.searchSplits.items()))
+        if failures:
+            # so the next run searches them again
+            self.objStore.save_failed_datastores(self.failedDatastores,
+                                                 self.args.host)
+            raise failures[0]
+        return self.objStore.iter_files()
+
+    def _crawl(self, datastores=None):
+        if self.args.crawl == 'folders':
+            return self.load_all_files_from_api(datastores)
+        return self.load_all_files_from_search_api(datastores)
+
+    def _datastore_is_stale(self, entry, ds):
+        if not self.objStore.cache_entry_is_fresh(
+                entry, self.args.host, self.args.max_age):
+            return True
+        if entry is not None and not self._filter_covered(entry):
+            return True
+        if entry is None:
+            # can't tell if it's changed without a record of what it was
+            return self.args.refresh_changed
+        if self.args.refresh_changed:
+            summary = ds[1]
+            return any(entry.get(k) != v for k, v in summary.items())
+        return False
+
+    def load_datastore_summaries(self):
+        """Loads the name and space usage of every datastore
+
+        Returns a dict of datastore name -> (datastore, summary) where
+        summary is a dict of the `freeSpace` and `uncommitted` values.  This
+        is done with one property collector request, so it's cheap enough to
+        run every time we need to check if the files cache is up-to-date.
         """
+        content = self.service_instance.RetrieveContent()
+        containerView = content.viewManager.CreateContainerView(
+            content.rootFolder, [vim.Datastore], True)
+
+        PC = vmodl.query.PropertyCollector
+        filterSpec = PC.FilterSpec(
+            objectSet=[PC.ObjectSpec(
+                obj=containerView, skip=True,
+                selectSet=[PC.TraversalSpec(
+                    name='viewToDatastores', type=vim.view.ContainerView,
+                    path='view', skip=False)])],
+            propSet=[PC.PropertySpec(
+                type=vim.Datastore, all=False,
+                pathSet=['name', 'summary.freeSpace',
+                         'summary.uncommitted'])])
+
+        summaries = {}
+        try:
+            for ds, props in self.retrieve_properties(filterSpec):
+                summaries[props['name']] = (ds, {
+                    'freeSpace': props.get('summary.freeSpace'),
+                    'uncommitted': props.get('summary.uncommitted')})
+        finally:
+            containerView.Destroy()
+        return summaries
+
+    def _list_datastores(self):
         content = self.service_instance.RetrieveContent()
         container = content.rootFolder  # starting point to look into
         viewType = [vim.Datastore]  # object types to look for
@@ -133,64 +636,294 @@ class VSphereApi:
 
         containerView = content.viewManager.CreateContainerView(
             container, viewType, recursive)
+        return containerView.view
 
-        def handle_datastore(ctx, ds):
-            # configure search to return all files and size of each
-            search = vim.host.DatastoreBrowser.SearchSpec()
-            search.details = vim.host.DatastoreBrowser.FileInfo.Details()
-            search.details.fileType = True
-            search.details.fileSize = True
-            search.details.modification = False
-            search.details.fileOwner = False
-            search.query.append(vim.host.DatastoreBrowser.Query)
-
-            # caching this property because accessing it triggers an HTTP
-            #  request and the name doesn't change since we're searching
-            #  a specific datastore
-            dsName = ds.name
+    def _search_files(self, ds, dsName, path, timeout=None):
+        """Recursively searches `path` on a datastore for all files
 
-            # search starting from the root of our datasource recursive
-            print("Searching for all files on [{}]".format(dsName))
-            search_req = ds.browser.SearchSubFolders(
-                "[{}] /".format(dsName), search)
-            count = 0
-            # TODO: doesn't handle error cases, will fail forever
-            while search_req.info.state != "success":
-                time.sleep(1.0)  # wait a bit so we don't hammer the server
-                count += 1
-                if count % 60 == 0:
-                    print("Still running after {} secs".format(count))
-
-            # search has finished.
-            #  it returns a list of results, each of which has files
-            results = search_req.info.result
-            for result in results:
-                if result.folderPath == '[LUN01]':
-                    # skip this node which just lists all the top level folders
-                    continue
-                if hasattr(result, 'file'):
-                    for f in result.file:
-                        if hasattr(f, 'path'):
-                            # TODO: check if results have duplicate folders
-                            # i.e. folder friendly name and folder guid
-                            dsf = DsFile(
-                                datastore=dsName,
-                                pathTo=result.folderPath,
-                                fileName=f.path,
-                                size=f.fileSize)
-                            ctx.append(dsf)
-                            print("Located file {} /{}".format(
-                                dsf.pathTo, dsf.fileName))
-                        else:
-                            print("Not a file [{}]".format(f))
-                else:
-                    print("No files [{}]".format(result))
+        Returns a `FileTable` of the files found, raises `TaskError` if the
+        search fails, or `TaskTimeout` if it takes longer than `timeout`,
+        which defaults to `--search_timeout`.  The node for the root of the
+        datastore, which just lists the top level folders, is skipped.
+        """
+        # configure search to return all files and size of each
+        search = vim.host.DatastoreBrowser.SearchSpec()
+        search.details = vim.host.DatastoreBrowser.FileInfo.Details()
+        search.details.fileType = True
+        search.details.fileSize = True
+        search.details.modification = False
+        search.details.fileOwner = False
+        search.query.append(vim.host.DatastoreBrowser.Query)
+        if self.fileFilter.match:
+            # vSphere leaves out the other files, rather than sending them
+            search.matchPattern = self.fileFilter.match
 
-        ctx = []
-        for child in containerView.view:
-            handle_datastore(ctx, child)
+        search_req = ds.browser.SearchSubFolders(
+            "[{}] {}".format(dsName, path), search)
+        try:
+            info = self.wait_for_task(
+                search_req, timeout or self.args.search_timeout)
+        except TaskError as e:
+            raise type(e)("Search of [{}] {} failed: {}".format(
+                dsName, path, e))
+
+        # search has finished.
+        #  it returns a list of results, each of which has files
+        debug = log.isEnabledFor(logging.DEBUG)
+        rootPath = '[{}]'.format(dsName)
+        results = info.result
+        for result in results:
+            if result.folderPath == rootPath:
+                # this node just lists all the top level folders, which
+                #  tells us which are aliases of each other
+                self.aliases.add_root_listing(dsName, result.file or [])
+        ctx = FileTable()
+        for result in results:
+            if result.folderPath == rootPath:
+                continue
+            if self.aliases.is_duplicate(result.folderPath):
+                # same files as the folder's friendly name, which is also
+                #  in the results
+                continue
+            pathTo = self.aliases.canonical(result.folderPath)
+            if hasattr(result, 'file'):
+                for f in result.file:
+                    if hasattr(f, 'path'):
+                        dsf = DsFile(
+                            datastore=dsName,
+                            pathTo=pathTo,
+                            fileName=f.path,
+                            size=f.fileSize)
+                        ctx.append(dsf)
+                        if debug:
+                            log.debug("Located file %s /%s",
+                                      dsf.pathTo, dsf.fileName)
+                    elif debug:
+                        log.debug("Not a file [%s]", f)
+            elif debug:
+                log.debug("No files [%s]", result)
         return ctx
 
+    def _list_folder(self, ds, dsName, path):
+        """Lists just the top level of `path` on a datastore
+
+        Returns a `FileTable` of the files directly in `path` and a list of
+        the paths of its subfolders.  Files in the root of the datastore are
+        left out, as they are from a recursive search.  Files are matched to
+        `fileFilter` here, as a `matchPattern` would leave out the folders,
+        but folders aren't checked against it.
+        """
+        if path == '/':
+            return FileTable(), self._list_top_level_folders(ds, dsName)
+        search = vim.host.DatastoreBrowser.SearchSpec()
+        search.details = vim.host.DatastoreBrowser.FileInfo.Details()
+        search.details.fileType = True
+        search.details.fileSize = True
+        search.query.append(vim.host.DatastoreBrowser.Query)
+        search_req = ds.browser.Search("[{}] {}".format(dsName, path), search)
+        try:
+            info = self.wait_for_task(search_req, self.args.search_timeout)
+        except TaskError as e:
+            raise TaskError("Listing [{}] {} failed: {}".format(
+                dsName, path, e))
+
+        pathTo = self.aliases.canonical(info.result.folderPath)
+        files = FileTable()
+        folders = []
+        for f in info.result.file or []:
+            if isinstance(f, vim.host.DatastoreBrowser.FolderInfo):
+                folders.append('{}/{}'.format(path.rstrip('/'), f.path))
+            elif self.fileFilter.matches(f.path):
+                files.append(DsFile(datastore=dsName, pathTo=pathTo,
+                                    fileName=f.path, size=f.fileSize))
+        return files, folders
+
+    def load_all_files_from_search_api(self, datastores=None):
+        """Loads all files using a recursive search run on all datastores
+
+        Logically this is pretty simple.  Just point it at the datastore and
+        search recursively for all files.  Datastores are searched in
+        parallel, with at most `--max_searches` searches running at a time,
+        so the total time is close to that of the slowest datastore.
+
+        A search of a big datastore can run for an hour and come back as one
+        enormous result.  With `--split_after`, a search that runs longer is
+        cancelled and split: its folder is listed a level at a time and each
+        subfolder searched on its own, which can be split again.  With
+        `--split_files`, a search that finds more files is split on the next
+        run.  The folders that were split are kept in `searchSplits`, and
+        saved with the cache, so later runs split them straight away.
+
+        With a `fileFilter`, the top level of each datastore is listed before
+        it's searched, as the search's `matchPattern` would leave out the
+        folders that `aliases` are found from.  Folders ignored by it aren't
+        searched, when any are found in the top level of a datastore or in a
+        folder that's split, the other folders are searched separately.
+
+        Pass a list of `datastores` to search just those.
+
+        This is a generator, files are yielded as each search completes.
+        """
+        if datastores is None:
+            datastores = self._list_datastores()
+        progress = Progress('Datastores searched', total=len(datastores),
+                            items='files')
+        splitAfter = self.args.split_after
+        if self.args.search_timeout and splitAfter and \
+                self.args.search_timeout <= splitAfter:
+            # the search is given up on before it would be split
+            splitAfter = None
+        planned = self.searchSplits
+
+        def split(ds, dsName, path):
+            files, folders = self._list_folder(ds, dsName, path)
+            kept = [f for f in folders if not self.fileFilter.is_ignored(
+                '[{}] {}/'.format(dsName, f))]
+            return files, kept, len(kept) < len(folders)
+
+        def search(item):
+            ds, dsName, path = item
+            if dsName is None:
+                # caching this property because accessing it triggers an
+                #  HTTP request and the name doesn't change since we're
+                #  searching a specific datastore
+                dsName = ds.name
+                log.info("Searching for all files on [%s]", dsName)
+            # a failed search shouldn't stop the others
+            try:
+                if path in planned.get(dsName, ()):
+                    log.debug("Splitting search of [%s] %s", dsName, path)
+                    files, folders, ignored = split(ds, dsName, path)
+                    return (ds, dsName, path), (files, folders, True)
+                if path == '/' and self.fileFilter:
+                    # a matchPattern leaves the folders out of the search's
+                    #  root node, so the aliases come from listing them
+                    #  first.  If any top level folders are ignored, search
+                    #  the others one by one rather than the whole datastore
+                    files, folders, ignored = split(ds, dsName, path)
+                    if ignored:
+                        return (ds, dsName, path), (files, folders, False)
+                try:
+                    files = self._search_files(ds, dsName, path, splitAfter)
+                except TaskTimeout:
+                    if not splitAfter:
+                        raise
+                    log.info("Search of [%s] %s ran over %d secs, searching "
+                             "its folders separately", dsName, path,
+                             splitAfter)
+                    files, folders, ignored = split(ds, dsName, path)
+                    return (ds, dsName, path), (files, folders, True)
+                return (ds, dsName, path), (files, None, False)
+            except (TaskError, vmodl.MethodFault) as e:
+                return (ds, dsName, path), e
+
+        # searches are run in rounds, the folders of the searches that were
+        #  split in one round are searched in the next
+        errors = []
+        self.failedDatastores = set()
+        splits = {}
+        remaining = {}
+        searches = [(ds, None, '/') for ds in datastores]
+        while searches:
+            following = []
+            for (ds, dsName, path), result in self.collector.map(
+                    search, searches, concurrency=self.args.max_searches):
+                files, folders, remember = (), None, False
+                if isinstance(result, Exception):
+                    log.warning("%s", result)
+                    errors.append(result)
+                    self.failedDatastores.add(dsName)
+                else:
+                    files, folders, remember = result
+                if remember:
+                    # listing it again is quicker than another search that
+                    #  runs over
+                    splits.setdefault(dsName, set()).add(path)
+                elif folders is None and self.args.split_files and \
+                        len(files) > self.args.split_files and \
+                        len(files.folders) > 1:
+                    # too late for this run, but there are subfolders it
+                    #  can be split into next time
+                    splits.setdefault(dsName, set()).add(path)
+                following.extend((ds, dsName, f) for f in folders or ())
+                # a datastore is done once all its searches have finished
+                left = remaining.get(dsName, 1) - 1 + len(folders or ())
+                remaining[dsName] = left
+                progress.update(done=0 if left else 1, items=len(files))
+                for dsf in files:
+                    yield dsf
+            searches = following
+        progress.finish()
+
+        for dsName in remaining:
+            if dsName in splits:
+                self.searchSplits[dsName] = splits[dsName]
+            else:
+                self.searchSplits.pop(dsName, None)
+
+        if errors:
+            raise TaskError("{} datastore searches failed: {}".format(
+                len(errors), "; ".join(str(e) for e in errors)))
+
+    def wait_for_task(self, task, timeout=None):
+        """Blocks until `task` finishes and returns the task's info
+
+        Rather than polling the task state, this registers a property
+        collector filter on `info.state` and waits for the server to tell us
+        it's changed.  Each call gets its own property collector so that
+        concurrent waits don't steal each other's updates.
+
+        Raises `TaskError` if the task fails or if it runs for longer than
+        `timeout` seconds, in which case the task is also cancelled.
+        """
+        PC = vmodl.query.PropertyCollector
+        pc = self.service_instance.RetrieveContent() \
+            .propertyCollector.CreatePropertyCollector()
+        done = (vim.TaskInfo.State.success, vim.TaskInfo.State.error)
+        state = None
+        try:
+            pc.CreateFilter(PC.FilterSpec(
+                objectSet=[PC.ObjectSpec(obj=task, skip=False)],
+                propSet=[PC.PropertySpec(
+                    type=vim.Task, all=False, pathSet=['info.state'])]),
+                True)
+            version = ''
+            start = time.time()
+            while state not in done:
+                elapsed = time.time() - start
+                wait = self.TASK_WAIT_SECS
+                if timeout:
+                    if elapsed >= timeout:
+                        self._cancel_task(task)
+                        raise TaskTimeout(
+                            "Timed out after {} secs".format(int(elapsed)))
+                    wait = int(min(wait, max(1, timeout - elapsed)))
+                if elapsed >= self.TASK_WAIT_SECS:
+                    log.info("Still running after %d secs", elapsed)
+                update = pc.WaitForUpdatesEx(
+                    version, PC.WaitOptions(maxWaitSeconds=wait))
+                if update is None:
+                    continue  # nothing changed before the wait expired
+                version = update.version
+                for filterSet in update.filterSet:
+                    for objUpdate in filterSet.objectSet:
+                        for change in objUpdate.changeSet:
+                            if change.name == 'info.state':
+                                state = change.val
+        finally:
+            pc.DestroyPropertyCollector()
+
+        info = task.info
+        if info.state == vim.TaskInfo.State.error:
+            raise TaskError(info.error.msg if info.error else "Unknown error")
+        return info
+
+    def _cancel_task(self, task):
+        try:
+            task.CancelTask()
+        except vmodl.MethodFault as e:
+            log.warning("Unable to cancel task [%s]", e.msg)
+
     def find_datastore_by_name(self, name):
         content = self.service_instance.RetrieveContent()
         container = content.rootFolder  # starting point to look into
@@ -218,25 +951,20 @@ class VSphereApi:
         search.query.append(vim.host.DatastoreBrowser.Query)
 
         # list only the files in underPath
-        print("Searching for all files on [{}] {}".format(
-            dsName, underPath))
+        log.debug("Searching for all files on [%s] %s", dsName, underPath)
         search_req = ds.browser.Search(
             "[{}] {}".format(dsName, underPath), search)
-        count = 0
-        while search_req.info.state != "success":
-            if search_req.info.state == "error":
-                print("Lookup failed [{}]".format(search_req.info.error.msg))
-                return []
-            time.sleep(1.0)  # wait a bit so we don't hammer the server
-            count += 1
-            if count % 60 == 0:
-                print("Not finished after {} secs -> {}".format(
-                    count, search_req.info.state))
+        try:
+            info = self.wait_for_task(search_req, self.args.search_timeout)
+        except TaskError as e:
+            log.warning("Lookup failed [%s]", e)
+            return []
 
         # search has finished.
         #  it returns a list of results, each of which has files
+        debug = log.isEnabledFor(logging.DEBUG)
         ctx = []
-        results = search_req.info.result
+        results = info.result
         for f in results.file:
             dsf = DsFile(
                 datastore=dsName,
@@ -244,55 +972,124 @@ class VSphereApi:
                 fileName=f.path.strip(),
                 size=f.fileSize)
             ctx.append(dsf)
-            print("Located file {} {}".format(dsf.pathTo, dsf.fileName))
+            if debug:
+                log.debug("Located file %s %s", dsf.pathTo, dsf.fileName)
         return ctx
 
-    def load_all_files_from_api(self):
+    def _list_top_level_folders(self, ds, dsName):
+        """Lists the folders to search on a datastore, leaving out aliases"""
+        search = vim.host.DatastoreBrowser.SearchSpec()
+        search.query.append(vim.host.DatastoreBrowser.FolderQuery())
+        search_req = ds.browser.Search("[{}] /".format(dsName), search)
+        try:
+            info = self.wait_for_task(search_req, self.args.search_timeout)
+        except TaskError as e:
+            raise TaskError("Listing folders on [{}] failed: {}".format(
+                dsName, e))
+        return self.aliases.add_root_listing(dsName, info.result.file or [])
+
+    def load_all_files_from_api(self, datastores=None):
         """Load all files by submitting multiple smaller search requests.
 
         Starts by loading the root level of each datastore, which this assumes
         is all folders (assumes based on standard way of storing VMs).  Then
-        for each folder in the root level, we issue another search that loads
-        just the contents of that sub folder.  We combine all the results into
-        one list.
+        each folder in the root level is a shard of the crawl, searched
+        recursively on its own.  Shards from every datastore go on one work
+        queue, interleaved by datastore, and each worker takes the next shard
+        as soon as it's done with its last.  That way a few large folders
+        don't hold up the rest, and at most `--max_searches` searches run at
+        once.
+
+        Each shard's files are saved to the crawl checkpoint in the object
+        store as the shard completes.  If the crawl is interrupted or some
+        searches fail, the next crawl only searches the shards that aren't
+        in the checkpoint, as long as they were captured from the same
+        vCenter within `--max_age`.  The checkpoint is cleared once a crawl
+        completes.
 
-        This should in theory do the same thing as the method
-        `load_all_files_from_search_api`, but more testing needs to be done to
-        confirm.
+        Top level folders ignored by `fileFilter` aren't searched, and
+        shards are only resumed if they were searched for the same files or
+        more.
+
+        Pass a list of `datastores` to crawl just those.  This is a
+        generator, files are yielded as each shard completes.
         """
-        ds = self.find_datastore_by_name('LUN01')
-        q = Queue()
-        done = False
+        if datastores is None:
+            datastores = self._list_datastores()
+        host = self.args.host
+        done = dict(
+            (key, entry) for key, entry in self.objStore.checkpoint_shards(
+                host, self.args.max_age).items()
+            if self._filter_covered(entry))
 
-        def worker():
-            while not done:
-                try:
-                    (ctx, path) = q.get(True, 1)
-                    newFiles = self.load_all_files_from_ds_under_path(ds, path)
-                    print("Adding {} new files".format(len(newFiles)))
-                    ctx.extend(newFiles)
-                    q.task_done()
-                except Empty:
-                    pass
-
-        threads = []
-        for i in range(15):
-            t = Thread(target=worker)
-            t.start()
-            threads.append(t)
-
-        # load up the queue with work
-        # Note: ctx is shared across all worker threads,
-        #   but it's a list and we're only appending so it should be OK
-        #     https://stackoverflow.com/questions/6319207/are-lists-thread-safe
-        ctx = []
-        # TODO: there will be duplicates: one for folder name and one for folder guid
-        #  figure out how to strip out the dups
-        for f in self.load_all_files_from_ds_under_path(ds, '/'):
-            q.put((ctx, f.fileName))
-
-        # wait for it to finish & clean up threads
-        q.join()
-        done = True
-        [th.join() for th in threads]
-        return ctx
+        def list_folders(ds):
+            dsName = ds.name
+            try:
+                return [(ds, dsName, folder) for folder in
+                        self._list_top_level_folders(ds, dsName)
+                        if not self.fileFilter.is_ignored(
+                            '[{}] {}/'.format(dsName, folder))]
+            except (TaskError, vmodl.MethodFault) as e:
+                self.failedDatastores.add(dsName)
+                return e
+
+        errors = []
+        self.failedDatastores = set()
+        byDatastore = []
+        for result in self.collector.map(
+                list_folders, datastores, concurrency=self.args.max_searches):
+            if isinstance(result, Exception):
+                log.warning("%s", result)
+                errors.append(result)
+            else:
+                byDatastore.append(result)
+        allShards = set((dsName, folder) for shards in byDatastore
+                        for (ds, dsName, folder) in shards)
+        resumed = dict((key, entry) for key, entry in done.items()
+                       if key in allShards)
+        # spread the work over the datastores, so the concurrent searches
+        #  aren't all on one datastore
+        shards = [shard for shards in six.moves.zip_longest(*byDatastore)
+                  for shard in shards
+                  if shard and (shard[1], shard[2]) not in resumed]
+        if resumed:
+            log.info("Resuming crawl, %d of %d folders already searched",
+                     len(resumed), len(allShards))
+
+        progress = Progress('Folders searched', total=len(allShards),
+                            items='files')
+        resumedFiles = 0
+        for dsf in self.objStore.iter_checkpoint_files(resumed):
+            resumedFiles += 1
+            yield dsf
+        progress.update(done=len(resumed), items=resumedFiles)
+
+        def search(shard):
+            ds, dsName, folder = shard
+            # a failed search shouldn't stop the others
+            try:
+                return shard, self._search_files(ds, dsName, folder)
+            except (TaskError, vmodl.MethodFault) as e:
+                return shard, e
+
+        for (ds, dsName, folder), result in self.collector.map(
+                search, shards, concurrency=self.args.max_searches):
+            progress.update(items=0 if isinstance(result, Exception)
+                            else len(result))
+            if isinstance(result, Exception):
+                log.warning("%s", result)
+                errors.append(result)
+                self.failedDatastores.add(dsName)
+                continue
+            log.debug("Adding %d new files", len(result))
+            self.objStore.save_checkpoint_shard(dsName, folder, result, host,
+                                                self.fileFilter.to_dict())
+            for dsf in result:
+                yield dsf
+        progress.finish()
+
+        if errors:
+            raise TaskError("{} searches failed, rerun to resume the crawl: "
+                            "{}".format(len(errors),
+                                        "; ".join(str(e) for e in errors)))
+        self.objStore.clear_checkpoint()
@@ -1,14 +1,25 @@
 # Some lightweight data types
+import array
+import itertools
 import json
 import os.path
+import sqlite3
+import time
 from collections import namedtuple
+from reconcile import vm_home, file_path, folder_name
 
 Vm = namedtuple('Vm', ['name',
                        'path',
                        'resourcePool',
                        'state',
                        'ip',
-                       'disks'])
+                       'disks',
+                       'host',
+                       'cluster',
+                       'folder',
+                       'storage'])
+# added later, caches from before then don't have them
+Vm.__new__.__defaults__ = (None, None, None, None)
 Disk = namedtuple('Disk', ['label',
                            'summary',
                            'path',
@@ -16,11 +27,134 @@ Disk = namedtuple('Disk', ['label',
                            'mode',
                            'type'])
 DsFile = namedtuple('DsFile', ['datastore', 'pathTo', 'fileName', 'size'])
+# space used by a VM on one datastore, `committed` is the size of its files
+#  there and `uncommitted` what its thin disks could still grow by
+DsUsage = namedtuple('DsUsage', ['datastore', 'committed', 'uncommitted'])
+
+# python 2's array doesn't have 'q', but long is 64 bits on 64 bit Linux
+try:
+    array.array('q')
+    SIZE_TYPECODE = 'q'
+except ValueError:
+    SIZE_TYPECODE = 'l'
+
+
+class FileTable:
+    """A compact list of `DsFile`, for holding millions of files in memory
+
+    Crawls find a few thousand folders holding millions of files, so as
+    `DsFile` records each file carries its own copies of the datastore and
+    folder strings.  Here each datastore and folder is stored once and
+    files refer to them by number, sizes are kept in an array and file
+    names packed into one buffer, which takes several times less memory.
+
+    Iterating or indexing gives `DsFile` records, so it can be used
+    anywhere a list of files is.
+    """
+    def __init__(self, files=()):
+        self.datastores = []
+        self.folders = []
+        # folder number -> datastore number
+        self.folderDatastores = array.array('l')
+        self._folderIds = {}
+        self._datastoreIds = {}
+        self.fileFolders = array.array('l')
+        self.sizes = array.array(SIZE_TYPECODE)
+        # file names as utf-8, one after the other, and where each ends
+        self.names = bytearray()
+        self.nameEnds = array.array(SIZE_TYPECODE)
+        self.extend(files)
+
+    def __len__(self):
+        return len(self.fileFolders)
+
+    def _folder_id(self, datastore, pathTo):
+        key = (datastore, pathTo)
+        folderId = self._folderIds.get(key)
+        if folderId is None:
+            dsId = self._datastoreIds.get(datastore)
+            if dsId is None:
+                dsId = self._datastoreIds[datastore] = len(self.datastores)
+                self.datastores.append(datastore)
+            folderId = self._folderIds[key] = len(self.folders)
+            self.folders.append(pathTo)
+            self.folderDatastores.append(dsId)
+        return folderId
+
+    def append(self, f):
+        self.fileFolders.append(self._folder_id(f.datastore, f.pathTo))
+        self.sizes.append(-1 if f.size is None else f.size)
+        name = f.fileName
+        self.names.extend(name if isinstance(name, bytes)
+                          else name.encode('utf-8'))
+        self.nameEnds.append(len(self.names))
+
+    def extend(self, files):
+        for f in files:
+            self.append(f)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('file index out of range')
+        folderId = self.fileFolders[i]
+        size = self.sizes[i]
+        return DsFile(
+            datastore=self.datastores[self.folderDatastores[folderId]],
+            pathTo=self.folders[folderId],
+            fileName=self.names[self.nameEnds[i - 1] if i else 0:
+                                self.nameEnds[i]].decode('utf-8'),
+            size=None if size == -1 else size)
+
+    def __iter__(self):
+        i = 0
+        while i < len(self):
+            yield self[i]
+            i += 1
 
 
 class VSphereObjectStore:
-    VMS_CACHE_FILE = 'vms.json'
-    FILES_CACHE_FILE = 'files.json'
+    """Caches VMs and datastore files in local files
+
+    Records are stored one per line as json arrays (ndjson), so they can be
+    written as they're loaded from vSphere and read back one at a time.
+    Memory use doesn't grow with the size of the cache.
+
+    Alongside the data we keep a metadata file recording when each part of
+    the cache was captured and from which vCenter.  VMs are one cache entry,
+    files are tracked with one entry per datastore so that datastores can
+    be refreshed individually.  Datastore entries also record the datastore
+    `freeSpace` and `uncommitted` values at capture time, which are a cheap
+    way to tell if anything has changed on the datastore since.
+
+    The store also keeps a checkpoint of a crawl in progress, the files
+    found in each top level folder (a shard) that's been searched so far, so
+    an interrupted crawl can pick up where it left off.  Shards are appended
+    to the checkpoint one per line as they complete.
+
+    Dated snapshots of past runs are kept in `SNAPSHOTS_DIR`, see
+    `snapshots`.
+    """
+    VMS_CACHE_FILE = 'vms.ndjson'
+    FILES_CACHE_FILE = 'files.ndjson'
+    META_CACHE_FILE = 'cache_meta.json'
+    CHECKPOINT_FILE = 'crawl_checkpoint.ndjson'
+    VM_UPDATES_FILE = 'vm_updates.json'
+    ROLLUP_CACHE_FILE = 'rollup.json'
+    SNAPSHOTS_DIR = 'snapshots'
+    CACHE_FILES = ['VMS_CACHE_FILE', 'FILES_CACHE_FILE', 'META_CACHE_FILE',
+                   'CHECKPOINT_FILE', 'VM_UPDATES_FILE', 'ROLLUP_CACHE_FILE',
+                   'SNAPSHOTS_DIR']
+
+    def __init__(self, directory=None):
+        """Keeps the cache in `directory`, or the current directory"""
+        if not directory:
+            return
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in self.CACHE_FILES:
+            setattr(self, name, os.path.join(directory, getattr(self, name)))
 
     def vms_cache_exists(self):
         return os.path.exists(self.VMS_CACHE_FILE)
@@ -28,22 +162,604 @@ class VSphereObjectStore:
     def files_cache_exists(self):
         return os.path.exists(self.FILES_CACHE_FILE)
 
-    def save_list_of_vms_to_json(self, vms):
-        json.dump(vms, open(self.VMS_CACHE_FILE, 'w'))
-
-    def save_list_of_files_to_json(self, files):
-        json.dump(files, open(self.FILES_CACHE_FILE, 'w'))
-
-    def load_list_of_vms_from_json(self):
-        vms_json = json.load(open(self.VMS_CACHE_FILE))
-        vms = []
-        for vm in vms_json:
-            vm_rec = Vm._make(vm[0:5] + [[]])
-            for disk in vm[5]:
-                vm_rec.disks.append(Disk._make(disk))
-            vms.append(vm_rec)
-        return vms
-
-    def load_list_of_files_from_json(self):
-        files_json = json.load(open(self.FILES_CACHE_FILE))
-        return [DsFile._make(f) for f in files_json]
+    def load_cache_metadata(self):
+        if not os.path.exists(self.META_CACHE_FILE):
+            return {}
+        return json.load(open(self.META_CACHE_FILE))
+
+    def save_cache_metadata(self, meta):
+        json.dump(meta, open(self.META_CACHE_FILE, 'w'), indent=2)
+
+    def vms_cache_entry(self):
+        return self.load_cache_metadata().get('vms')
+
+    def datastore_cache_entries(self):
+        return self.load_cache_metadata().get('datastores', {})
+
+    def cache_entry_is_fresh(self, entry, host=None, max_age=None):
+        """Checks if a cache entry can still be used
+
+        An entry is stale if it was captured from a different vCenter, is
+        older than `max_age` seconds or is for a datastore that failed.
+        Caches written before metadata was kept have no entry, those are
+        trusted unless there's a `max_age`.
+        """
+        if entry is None:
+            return max_age is None
+        if entry.get('failed'):
+            return False
+        if host and entry.get('host') != host:
+            return False
+        if max_age is not None and time.time() - entry['captured'] > max_age:
+            return False
+        return True
+
+    def _cache_entry(self, host, **kwargs):
+        entry = {'captured': time.time(), 'host': host}
+        entry.update(kwargs)
+        return entry
+
+    def _write_records(self, path, records):
+        # write to a temp file & move into place, so a failed or interrupted
+        #  run doesn't leave a partial cache and so `records` can be a
+        #  generator that's still reading the previous cache
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as fp:
+                for rec in records:
+                    fp.write(json.dumps(rec))
+                    fp.write('\n')
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        os.rename(tmp_path, path)
+
+    def _read_records(self, path):
+        with open(path) as fp:
+            for line in fp:
+                yield json.loads(line)
+
+    def save_vms(self, vms, host=None):
+        self._write_records(self.VMS_CACHE_FILE, vms)
+        meta = self.load_cache_metadata()
+        meta['vms'] = self._cache_entry(host, scope='vms',
+                                        fields=len(Vm._fields))
+        self.save_cache_metadata(meta)
+
+    def save_files(self, files, datastores=None, host=None, forget=()):
+        """Saves files, `files` can be any iterable and is consumed once
+
+        `datastores` maps the name of each datastore that was just crawled
+        to a dict of its `freeSpace` and `uncommitted` values, these get
+        new cache entries.  Entries for datastores named in `forget` are
+        removed, entries for any other datastores are left as they are.
+        """
+        self._write_records(self.FILES_CACHE_FILE, files)
+        meta = self.load_cache_metadata()
+        entries = meta.setdefault('datastores', {})
+        for name in forget:
+            entries.pop(name, None)
+        for name, summary in (datastores or {}).items():
+            entries[name] = self._cache_entry(host, scope=name, **summary)
+        self.save_cache_metadata(meta)
+
+    def save_failed_datastores(self, names, host=None):
+        """Marks the files of datastores that couldn't all be searched
+
+        Their entries are never fresh, so the next crawl searches them
+        again, while the other datastores' files can be used.
+        """
+        meta = self.load_cache_metadata()
+        entries = meta.setdefault('datastores', {})
+        for name in names:
+            entries[name] = self._cache_entry(host, scope=name, failed=True)
+        self.save_cache_metadata(meta)
+
+    def iter_vms(self):
+        for vm in self._read_records(self.VMS_CACHE_FILE):
+            storage = vm[9] if len(vm) > 9 else None
+            yield Vm(*vm[0:5] + [[Disk._make(disk) for disk in vm[5]]] +
+                     vm[6:9] + [[DsUsage._make(usage) for usage in storage]
+                                if storage is not None else None])
+
+    def iter_files(self):
+        for f in self._read_records(self.FILES_CACHE_FILE):
+            yield DsFile._make(f)
+
+    def folder_aliases(self):
+        """Returns the folder aliases as datastore -> {uuid: name}"""
+        return self.load_cache_metadata().get('aliases', {})
+
+    def save_folder_aliases(self, aliases):
+        meta = self.load_cache_metadata()
+        meta['aliases'] = aliases
+        self.save_cache_metadata(meta)
+
+    def search_splits(self):
+        """Returns the folders to search piecewise as datastore -> [path]"""
+        return self.load_cache_metadata().get('search_splits', {})
+
+    def save_search_splits(self, splits):
+        meta = self.load_cache_metadata()
+        meta['search_splits'] = splits
+        self.save_cache_metadata(meta)
+
+    def load_rollup(self):
+        """Returns the saved `rollup.Rollup` dict, if any"""
+        if not os.path.exists(self.ROLLUP_CACHE_FILE):
+            return None
+        return json.load(open(self.ROLLUP_CACHE_FILE))
+
+    def save_rollup(self, rollup):
+        json.dump(rollup, open(self.ROLLUP_CACHE_FILE, 'w'))
+
+    def vm_updates_state(self):
+        """Returns the saved `vm_inventory.VmInventory` state, if any"""
+        if not os.path.exists(self.VM_UPDATES_FILE):
+            return None
+        return json.load(open(self.VM_UPDATES_FILE))
+
+    def save_vm_updates_state(self, state):
+        tmp_path = self.VM_UPDATES_FILE + '.tmp'
+        json.dump(state, open(tmp_path, 'w'))
+        os.rename(tmp_path, self.VM_UPDATES_FILE)
+
+    def snapshots(self):
+        # imported here as snapshots needs rollup, which needs this module
+        from snapshots import SnapshotStore
+        return SnapshotStore(self.SNAPSHOTS_DIR)
+
+    def _read_checkpoint(self):
+        if not os.path.exists(self.CHECKPOINT_FILE):
+            return
+        with open(self.CHECKPOINT_FILE) as fp:
+            for line in fp:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # the last line may be cut short if we were interrupted
+                    #  while writing it, that shard just gets searched again
+                    continue
+
+    def checkpoint_shards(self, host=None, max_age=None):
+        """Returns the shards in the crawl checkpoint that can be reused
+
+        Returns a dict of (datastore, folder) -> cache entry for each shard
+        captured from `host` less than `max_age` seconds ago.  Pass the
+        dict to `iter_checkpoint_files` to read back the shards' files.
+        """
+        shards = {}
+        for entry, files in self._read_checkpoint():
+            if self.cache_entry_is_fresh(entry, host, max_age):
+                shards[(entry['scope'], entry['folder'])] = entry
+        return shards
+
+    def save_checkpoint_shard(self, datastore, folder, files, host=None,
+                              filter=None):
+        """Adds the files found in a shard to the crawl checkpoint
+
+        `filter` is the `reconcile.FileFilter` dict the shard was searched
+        with.
+        """
+        entry = self._cache_entry(host, scope=datastore, folder=folder,
+                                  filter=filter)
+        with open(self.CHECKPOINT_FILE, 'a') as fp:
+            fp.write(json.dumps([entry, list(files)]))
+            fp.write('\n')
+
+    def iter_checkpoint_files(self, shards):
+        for entry, files in self._read_checkpoint():
+            # a shard may have been checkpointed more than once, only the
+            #  copy in `shards` is used
+            if shards.get((entry['scope'], entry['folder'])) == entry:
+                for f in files:
+                    yield DsFile._make(f)
+
+    def clear_checkpoint(self):
+        if os.path.exists(self.CHECKPOINT_FILE):
+            os.remove(self.CHECKPOINT_FILE)
+
+
+class SqliteObjectStore(VSphereObjectStore):
+    """Caches VMs and datastore files in a local SQLite database
+
+    Works like `VSphereObjectStore`, but the records are kept in indexed
+    tables so reports can be run as queries rather than by loading every
+    record.  Records are inserted in batches of `BATCH_SIZE`, each batch in
+    one transaction.
+
+    A few derived columns are stored with the records so that matching files
+    to VMs can use the indexes: the home folder of each VM, the full path of
+    each file and the top level folder name each file is in (if any).
+    """
+    DB_FILE = 'vsphere.db'
+    CACHE_FILES = ['DB_FILE', 'SNAPSHOTS_DIR']
+    BATCH_SIZE = 10000
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cache_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT);
+        CREATE TABLE IF NOT EXISTS vms (
+            id INTEGER PRIMARY KEY,
+            name TEXT,
+            path TEXT,
+            resource_pool TEXT,
+            state TEXT,
+            ip TEXT,
+            home TEXT,
+            host TEXT,
+            cluster TEXT,
+            folder TEXT);
+        CREATE INDEX IF NOT EXISTS vms_name_idx ON vms (name);
+        CREATE INDEX IF NOT EXISTS vms_home_idx ON vms (home);
+        CREATE INDEX IF NOT EXISTS vms_pool_idx ON vms (resource_pool);
+        CREATE TABLE IF NOT EXISTS disks (
+            vm_id INTEGER REFERENCES vms (id),
+            label TEXT,
+            summary TEXT,
+            path TEXT,
+            size INTEGER,
+            mode TEXT,
+            type TEXT);
+        CREATE INDEX IF NOT EXISTS disks_vm_idx ON disks (vm_id);
+        CREATE INDEX IF NOT EXISTS disks_path_idx ON disks (path);
+        CREATE TABLE IF NOT EXISTS vm_storage (
+            vm_id INTEGER REFERENCES vms (id),
+            datastore TEXT,
+            committed INTEGER,
+            uncommitted INTEGER);
+        CREATE INDEX IF NOT EXISTS vm_storage_vm_idx ON vm_storage (vm_id);
+        CREATE TABLE IF NOT EXISTS crawl_shards (
+            datastore TEXT,
+            folder TEXT,
+            entry TEXT,
+            PRIMARY KEY (datastore, folder));
+        CREATE TABLE IF NOT EXISTS crawl_files (
+            datastore TEXT,
+            folder TEXT,
+            path_to TEXT,
+            file_name TEXT,
+            size INTEGER);
+        CREATE INDEX IF NOT EXISTS crawl_files_shard_idx
+            ON crawl_files (datastore, folder);
+        CREATE TABLE IF NOT EXISTS folder_aliases (
+            datastore TEXT,
+            uuid TEXT,
+            name TEXT,
+            uuid_folder TEXT PRIMARY KEY,
+            name_folder TEXT);
+    """
+
+    FILES_SCHEMA = """
+        CREATE TABLE {table} (
+            datastore TEXT,
+            path_to TEXT,
+            file_name TEXT,
+            size INTEGER,
+            folder_name TEXT,
+            full_path TEXT);
+    """
+
+    FILES_INDEXES = """
+        CREATE INDEX IF NOT EXISTS files_datastore_idx
+            ON files (datastore, path_to);
+        CREATE INDEX IF NOT EXISTS files_path_to_idx ON files (path_to);
+        CREATE INDEX IF NOT EXISTS files_folder_name_idx
+            ON files (folder_name);
+        CREATE INDEX IF NOT EXISTS files_full_path_idx ON files (full_path);
+    """
+
+    def __init__(self, directory=None):
+        VSphereObjectStore.__init__(self, directory)
+        self.db = sqlite3.connect(self.DB_FILE)
+        self.db.executescript(self.SCHEMA)
+        # databases from before these columns were added
+        columns = [row[1] for row in self.db.execute(
+            "PRAGMA table_info(vms)")]
+        for column in ('host', 'cluster', 'folder'):
+            if column not in columns:
+                self.db.execute(
+                    "ALTER TABLE vms ADD COLUMN {} TEXT".format(column))
+        if not self._table_exists('files'):
+            self.db.executescript(self.FILES_SCHEMA.format(table='files'))
+            self.db.executescript(self.FILES_INDEXES)
+
+    def _table_exists(self, name):
+        return self.db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (name,)).fetchone() is not None
+
+    def _insert_batches(self, sql, rows):
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.BATCH_SIZE))
+            if not batch:
+                break
+            with self.db:
+                self.db.executemany(sql, batch)
+
+    def vms_cache_exists(self):
+        return 'vms' in self.load_cache_metadata()
+
+    def files_cache_exists(self):
+        return 'datastores' in self.load_cache_metadata()
+
+    def load_cache_metadata(self):
+        row = self.db.execute(
+            "SELECT value FROM cache_meta WHERE key = 'meta'").fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save_cache_metadata(self, meta):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache_meta (key, value) "
+                "VALUES ('meta', ?)", (json.dumps(meta),))
+
+    def _write_vms(self, vms):
+        with self.db:
+            self.db.execute("DELETE FROM disks")
+            self.db.execute("DELETE FROM vm_storage")
+            self.db.execute("DELETE FROM vms")
+        for batch in iter(lambda: list(itertools.islice(
+                vms, self.BATCH_SIZE)), []):
+            with self.db:
+                for vm in batch:
+                    vm_id = self.db.execute(
+                        "INSERT INTO vms (name, path, resource_pool, state, "
+                        "ip, home, host, cluster, folder) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        tuple(vm[0:5]) + (vm_home(vm),) +
+                        tuple(vm[6:9])).lastrowid
+                    self.db.executemany(
+                        "INSERT INTO disks (vm_id, label, summary, path, "
+                        "size, mode, type) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(vm_id,) + tuple(disk) for disk in vm.disks])
+                    self.db.executemany(
+                        "INSERT INTO vm_storage (vm_id, datastore, "
+                        "committed, uncommitted) VALUES (?, ?, ?, ?)",
+                        [(vm_id,) + tuple(usage)
+                         for usage in vm.storage or ()])
+
+    def _write_files(self, files):
+        # write into a new table & swap it in once it's complete, as `files`
+        #  may be a generator that's still reading from the current table
+        with self.db:
+            self.db.execute("DROP TABLE IF EXISTS files_new")
+            self.db.executescript(self.FILES_SCHEMA.format(table='files_new'))
+        prefixes = {}
+
+        def rows():
+            for f in files:
+                prefix = prefixes.get(f.datastore)
+                if prefix is None:
+                    prefix = prefixes[f.datastore] = '[{}] '.format(
+                        f.datastore)
+                yield (f.datastore, f.pathTo, f.fileName, f.size,
+                       folder_name(f.pathTo, prefix), file_path(f))
+
+        self._insert_batches(
+            "INSERT INTO files_new VALUES (?, ?, ?, ?, ?, ?)", rows())
+        with self.db:
+            self.db.execute("DROP TABLE files")
+            self.db.execute("ALTER TABLE files_new RENAME TO files")
+        self.db.executescript(self.FILES_INDEXES)
+
+    def save_vms(self, vms, host=None):
+        self._write_vms(iter(vms))
+        meta = self.load_cache_metadata()
+        meta['vms'] = self._cache_entry(host, scope='vms',
+                                        fields=len(Vm._fields))
+        self.save_cache_metadata(meta)
+
+    def save_files(self, files, datastores=None, host=None, forget=()):
+        self._write_files(files)
+        meta = self.load_cache_metadata()
+        entries = meta.setdefault('datastores', {})
+        for name in forget:
+            entries.pop(name, None)
+        for name, summary in (datastores or {}).items():
+            entries[name] = self._cache_entry(host, scope=name, **summary)
+        self.save_cache_metadata(meta)
+
+    def iter_vms(self):
+        rows = self.db.execute(
+            "SELECT v.id, v.name, v.path, v.resource_pool, v.state, v.ip, "
+            "v.host, v.cluster, v.folder, "
+            "d.label, d.summary, d.path, d.size, d.mode, d.type "
+            "FROM vms v LEFT JOIN disks d ON d.vm_id = v.id ORDER BY v.id")
+        # storage is read alongside, in the same order, rather than joined
+        #  which would repeat it for every disk
+        storage = itertools.groupby(self.db.execute(
+            "SELECT vm_id, datastore, committed, uncommitted FROM vm_storage "
+            "ORDER BY vm_id"), lambda row: row[0])
+        usage_id, usage = next(storage, (None, None))
+        for vm_id, group in itertools.groupby(rows, lambda row: row[0]):
+            group = list(group)
+            vmStorage = []
+            while usage_id is not None and usage_id <= vm_id:
+                if usage_id == vm_id:
+                    vmStorage = [DsUsage._make(row[1:]) for row in usage]
+                usage_id, usage = next(storage, (None, None))
+            yield Vm._make(list(group[0][1:6]) + [
+                [Disk._make(row[9:]) for row in group if row[9] is not None]] +
+                list(group[0][6:9]) + [vmStorage])
+
+    def iter_files(self):
+        for row in self.db.execute(
+                "SELECT datastore, path_to, file_name, size FROM files"):
+            yield DsFile._make(row)
+
+    def load_rollup(self):
+        row = self.db.execute(
+            "SELECT value FROM cache_meta WHERE key = 'rollup'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_rollup(self, rollup):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache_meta (key, value) "
+                "VALUES ('rollup', ?)", (json.dumps(rollup),))
+
+    def vm_updates_state(self):
+        row = self.db.execute(
+            "SELECT value FROM cache_meta WHERE key = 'vm_updates'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_vm_updates_state(self, state):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache_meta (key, value) "
+                "VALUES ('vm_updates', ?)", (json.dumps(state),))
+
+    def folder_aliases(self):
+        aliases = {}
+        for datastore, uuid, name in self.db.execute(
+                "SELECT datastore, uuid, name FROM folder_aliases"):
+            aliases.setdefault(datastore, {})[uuid] = name
+        return aliases
+
+    def save_folder_aliases(self, aliases):
+        # the folders are stored whole so queries can match them to paths
+        #  with an index lookup
+        with self.db:
+            self.db.execute("DELETE FROM folder_aliases")
+            self.db.executemany(
+                "INSERT INTO folder_aliases VALUES (?, ?, ?, ?, ?)",
+                [(ds, uuid, name, '[{}] {}/'.format(ds, uuid),
+                  '[{}] {}/'.format(ds, name))
+                 for ds, folders in aliases.items()
+                 for uuid, name in folders.items()])
+
+    def checkpoint_shards(self, host=None, max_age=None):
+        shards = {}
+        for datastore, folder, entry in self.db.execute(
+                "SELECT datastore, folder, entry FROM crawl_shards"):
+            entry = json.loads(entry)
+            if self.cache_entry_is_fresh(entry, host, max_age):
+                shards[(datastore, folder)] = entry
+        return shards
+
+    def save_checkpoint_shard(self, datastore, folder, files, host=None,
+                              filter=None):
+        # the shard and its files go in one transaction, so a shard is
+        #  either completely checkpointed or not at all
+        entry = self._cache_entry(host, scope=datastore, folder=folder,
+                                  filter=filter)
+        with self.db:
+            self.db.execute(
+                "DELETE FROM crawl_files WHERE datastore = ? AND folder = ?",
+                (datastore, folder))
+            self.db.executemany(
+                "INSERT INTO crawl_files VALUES (?, ?, ?, ?, ?)",
+                [(datastore, folder, f.pathTo, f.fileName, f.size)
+                 for f in files])
+            self.db.execute(
+                "INSERT OR REPLACE INTO crawl_shards VALUES (?, ?, ?)",
+                (datastore, folder, json.dumps(entry)))
+
+    def iter_checkpoint_files(self, shards):
+        rows = self.db.execute(
+            "SELECT f.datastore, f.folder, f.path_to, f.file_name, f.size "
+            "FROM crawl_files f JOIN crawl_shards s "
+            "ON s.datastore = f.datastore AND s.folder = f.folder")
+        for row in rows:
+            if (row[0], row[1]) in shards:
+                yield DsFile._make((row[0],) + row[2:])
+
+    def clear_checkpoint(self):
+        with self.db:
+            self.db.execute("DELETE FROM crawl_files")
+            self.db.execute("DELETE FROM crawl_shards")
+
+    # measure -> (tables summed, size, datastore, disk type), matching
+    #  `rollup.MEASURES` and `rollup.DIMENSIONS`
+    USAGE_MEASURES = {
+        'capacity': (
+            "vms v JOIN disks d ON d.vm_id = v.id", "d.size",
+            "CASE WHEN d.path LIKE '[%' "
+            "THEN substr(d.path, 2, instr(d.path, ']') - 2) END",
+            "d.type"),
+        'committed': (
+            "vms v JOIN vm_storage s ON s.vm_id = v.id", "s.committed",
+            "s.datastore", "NULL"),
+        'provisioned': (
+            "vms v JOIN vm_storage s ON s.vm_id = v.id",
+            "s.committed + s.uncommitted", "s.datastore", "NULL"),
+    }
+    USAGE_DIMENSIONS = {
+        'resource_pool': "v.resource_pool",
+        'host': "v.host",
+        'cluster': "v.cluster",
+        'folder': "v.folder",
+        'power_state': "v.state",
+    }
+
+    def disk_usage_rows(self, grouping, measure='capacity'):
+        """Returns a list of (group, total size, number of items) like
+        `rollup.Rollup.rows`, summed by a GROUP BY"""
+        tables, size, datastore, diskType = self.USAGE_MEASURES[measure]
+        columns = [datastore if d == 'datastore' else
+                   diskType if d == 'disk_type' else
+                   self.USAGE_DIMENSIONS[d] for d in grouping]
+        sql = "SELECT {}COALESCE(SUM({}), 0), COUNT(*) FROM {}".format(
+            ''.join(c + ', ' for c in columns), size, tables)
+        if columns:
+            sql += " GROUP BY {}".format(', '.join(columns))
+        return [(tuple(row[:-2]), row[-2], row[-1])
+                for row in self.db.execute(sql)]
+
+    def count_vms(self):
+        return self.db.execute("SELECT COUNT(*) FROM vms").fetchone()[0]
+
+    def count_files(self, ignore=(), match=()):
+        """Counts the files, skipping the same ones as
+        `iter_unaccounted_files`"""
+        sql = "SELECT COUNT(*) FROM files WHERE 1 "
+        for s in ignore:
+            sql += "AND instr(path_to, ?) = 0 "
+        if match:
+            sql += "AND ({}) ".format(
+                " OR ".join(["file_name GLOB ?"] * len(match)))
+        return self.db.execute(
+            sql, tuple(ignore) + tuple(match)).fetchone()[0]
+
+    def iter_unaccounted_files(self, ignore=(), match=()):
+        """Yields each `DsFile` that doesn't belong to a VM
+
+        Matches files to VMs the same way as `reconcile.VmIndex`, but as
+        one query.  VM paths in a UUID folder are matched in their friendly
+        name form too, see `reconcile.FolderAliases`.  Files in folders
+        containing any of the strings in `ignore` are skipped, and with
+        `match` only files matching one of the patterns are included.
+        Files come out sorted by folder.
+        """
+        sql = ("SELECT datastore, path_to, file_name, size FROM files "
+               "WHERE (folder_name IS NULL OR folder_name NOT IN "
+               "  (SELECT name FROM vms WHERE name IS NOT NULL)) "
+               "AND path_to NOT IN "
+               "  (SELECT home FROM vms WHERE home IS NOT NULL "
+               "   UNION SELECT a.name_folder || "
+               "     substr(v.home, length(a.uuid_folder) + 1) "
+               "   FROM vms v JOIN folder_aliases a "
+               "   ON a.uuid_folder = substr(v.home, 1, instr(v.home, '/'))) "
+               "AND full_path NOT IN "
+               "  (SELECT path FROM disks WHERE path IS NOT NULL "
+               "   UNION SELECT a.name_folder || "
+               "     substr(d.path, length(a.uuid_folder) + 1) "
+               "   FROM disks d JOIN folder_aliases a "
+               "   ON a.uuid_folder = substr(d.path, 1, instr(d.path, '/'))) ")
+        for s in ignore:
+            sql += "AND instr(path_to, ?) = 0 "
+        if match:
+            sql += "AND ({}) ".format(
+                " OR ".join(["file_name GLOB ?"] * len(match)))
+        sql += "ORDER BY path_to"
+        for row in self.db.execute(sql, tuple(ignore) + tuple(match)):
+            yield DsFile._make(row)
+
+    def iter_unaccounted_folders(self, ignore=(), match=()):
+        """Yields (folder, [file names]) for `iter_unaccounted_files`"""
+        files = self.iter_unaccounted_files(ignore, match)
+        for pathTo, group in itertools.groupby(files, lambda f: f.pathTo):
+            yield (pathTo, [f.fileName for f in group])
@@ -0,0 +1,671 @@
+"""An offline stand-in for vCenter
+
+This lets the collection code in `vsphere_api` run without a live vCenter.
+It works at the level of the pyVmomi stub, the object that turns property
+accesses and method calls on managed objects into SOAP requests.  The real
+pyVmomi types are used throughout, so the code under test can't tell the
+difference, but each request is answered from a synthetic inventory.
+
+Every request counts as one round trip and can be given a fixed latency.
+Datastore searches run as tasks that finish after a delay based on the
+number of files searched, and can be made to fail for given datastores.
+
+Example:
+
+    inventory = SimInventory.generate(vm_count=1000, file_count=10000)
+    si = sim_connect(inventory, latency=0.001)
+    api = VSphereApi(args, service_instance=si)
+    vms = api.load_all_vms_from_property_collector()
+    print(si._stub.round_trips)
+"""
+import fnmatch
+import itertools
+import random
+import re
+import threading
+import time
+import uuid as uuidlib
+
+from collections import Counter, OrderedDict
+from pyVmomi import vim, vmodl, VmomiSupport
+from vsphere_objects import Vm, Disk, DsFile, DsUsage
+
+PC = vmodl.query.PropertyCollector
+Browser = vim.host.DatastoreBrowser
+Backing = vim.vm.device.VirtualDisk.FlatVer2BackingInfo
+
+# key for the record an object's properties were last reported from
+_RECORD = object()
+
+
+def _same(a, b):
+    if a is None or b is None:
+        return a is b
+    if isinstance(a, (list, VmomiSupport.DataObject)):
+        # data objects don't compare by value
+        return repr(a) == repr(b)
+    return a == b
+
+
+class SimInventory:
+    """The VMs and datastore files served by the simulator
+
+    `vms` is a list of `Vm` and `files` a list of `DsFile`, the same records
+    the collection code produces.  Files are expected to be in top level
+    folders, with `pathTo` of the form `[datastore] folder/`.
+
+    `uuids` maps (datastore, folder) to a UUID for folders laid out like
+    vSAN, these are listed under both names.
+    """
+    def __init__(self, vms, files, uuids=None):
+        self.vms = vms
+        self.files = files
+        self.uuids = uuids or {}
+        self.names = dict(((ds, uuid), folder)
+                          for (ds, folder), uuid in self.uuids.items())
+        self.pools = sorted(set(vm.resourcePool for vm in vms
+                                if vm.resourcePool))
+        # host -> cluster
+        self.hosts = OrderedDict(sorted(set(
+            (vm.host, vm.cluster) for vm in vms if vm.host)))
+        self.clusters = sorted(set(c for c in self.hosts.values() if c))
+        self.vm_folders = sorted(set(vm.folder for vm in vms if vm.folder))
+        # datastore -> folder -> [files]
+        self.folders = OrderedDict()
+        for f in files:
+            folder = f.pathTo[len(f.datastore) + 3:].rstrip('/')
+            self.folders.setdefault(f.datastore, OrderedDict()) \
+                .setdefault(folder, []).append(f)
+        for vm in vms:
+            self.folders.setdefault(vm.path[1:vm.path.index(']')],
+                                    OrderedDict())
+        self.datastores = list(self.folders.keys())
+
+    @classmethod
+    def generate(cls, vm_count, file_count, datastore_count=4,
+                 pool_count=10, abandoned=0.1, seed=0, vsan=False,
+                 host_count=8, cluster_count=2, folder_count=5):
+        """Generates a random inventory
+
+        Each VM gets a folder on one of the datastores with its `vmx` and
+        `vmdk` files, as long as there are files left.  VMs are spread over
+        `host_count` hosts, in `cluster_count` clusters, and
+        `folder_count` VM folders.  The remaining files
+        are spread across the VM folders, except for roughly `abandoned` of
+        them which go into folders that don't belong to any VM.  Half of
+        each thin disk is committed.
+
+        With `vsan`, every folder also gets a UUID and the VMs' disks are
+        given by their UUID path.
+        """
+        rand = random.Random(seed)
+        datastores = ['LUN{:02}'.format(i + 1) for i in range(datastore_count)]
+        pools = ['rp-{}'.format(i) for i in range(pool_count)]
+        hosts = ['esx-{}'.format(i) for i in range(host_count)]
+        folders = ['folder-{}'.format(i) for i in range(folder_count)]
+
+        vms = []
+        files = []
+        for i in range(vm_count):
+            name = 'vm-{}'.format(i)
+            ds = datastores[i % datastore_count]
+            folder = '[{}] {}/'.format(ds, name)
+            size = rand.randint(1, 100) * 1024 ** 3
+            diskType = rand.choice(['thin', 'thick'])
+            # thin disks are half written
+            committed = size // 2 if diskType == 'thin' else size
+            vms.append(Vm(
+                name=name,
+                path='{}{}.vmx'.format(folder, name),
+                resourcePool=rand.choice(pools),
+                state='poweredOn',
+                ip='10.0.{}.{}'.format(i // 250, i % 250 + 1),
+                disks=[Disk(label='Hard disk 1',
+                            summary='{:,} KB'.format(size // 1024),
+                            path='{}{}.vmdk'.format(folder, name),
+                            size=size,
+                            mode='persistent',
+                            type=diskType)],
+                host=hosts[i % host_count] if hosts else None,
+                cluster='cluster-{}'.format(i % host_count % cluster_count)
+                if hosts and cluster_count else None,
+                folder=rand.choice(folders) if folders else None,
+                storage=[DsUsage(ds, 4096 + committed, size - committed)]))
+            for fileName, fileSize in (('{}.vmx'.format(name), 4096),
+                                       ('{}.vmdk'.format(name), size)):
+                if len(files) < file_count:
+                    files.append(DsFile(ds, folder, fileName, fileSize))
+
+        orphans = max(1, int((file_count - len(files)) * abandoned) // 5)
+        while len(files) < file_count:
+            n = len(files)
+            if not vms or rand.random() < abandoned:
+                ds = rand.choice(datastores)
+                folder = '[{}] orphan-{}/'.format(ds, rand.randrange(orphans))
+            else:
+                vm = rand.choice(vms)
+                ds = vm.path[1:vm.path.index(']')]
+                folder = '[{}] {}/'.format(ds, vm.name)
+            files.append(DsFile(ds, folder, 'file-{}.log'.format(n),
+                                rand.randint(1, 1024 ** 2)))
+
+        uuids = {}
+        if vsan:
+            def folder_uuid(ds, folder):
+                if (ds, folder) not in uuids:
+                    uuids[(ds, folder)] = str(
+                        uuidlib.UUID(int=rand.getrandbits(128)))
+                return uuids[(ds, folder)]
+            for f in files:
+                folder_uuid(f.datastore,
+                            f.pathTo[len(f.datastore) + 3:].rstrip('/'))
+            for i, vm in enumerate(vms):
+                uuid = folder_uuid(vm.path[1:vm.path.index(']')], vm.name)
+                vms[i] = vm._replace(disks=[
+                    disk._replace(path=disk.path.replace(
+                        '] {}/'.format(vm.name), '] {}/'.format(uuid), 1))
+                    for disk in vm.disks])
+        return cls(vms, files, uuids)
+
+
+class SimTask:
+    def __init__(self, moId, duration, result, error=None):
+        self.moId = moId
+        self.started = time.time()
+        self.duration = duration
+        self.result = result
+        self.error = error
+        self.cancelled = False
+
+    def finishes_at(self):
+        return self.started + self.duration
+
+    def state(self):
+        if self.cancelled:
+            return vim.TaskInfo.State.error
+        if time.time() < self.finishes_at():
+            return vim.TaskInfo.State.running
+        if self.error:
+            return vim.TaskInfo.State.error
+        return vim.TaskInfo.State.success
+
+
+class SimStub(object):
+    """Answers pyVmomi requests from a `SimInventory`
+
+    `latency` is the number of seconds each request takes.  Searches take
+    `search_latency` seconds, plus one second per `search_rate` files
+    searched if that's set.  Searches of the datastores named in
+    `failing_datastores` fail.
+    """
+    def __init__(self, inventory, latency=0.0, search_latency=0.0,
+                 search_rate=None, failing_datastores=()):
+        self.inventory = inventory
+        self.latency = latency
+        self.search_latency = search_latency
+        self.search_rate = search_rate
+        self.failing_datastores = set(failing_datastores)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+        self.objects = {}
+        self.vms = [self._add(vim.VirtualMachine, 'vm-{}'.format(i), vm)
+                    for i, vm in enumerate(inventory.vms)]
+        self.pools = dict(
+            (name, self._add(vim.ResourcePool, 'resgroup-{}'.format(i), name))
+            for i, name in enumerate(inventory.pools))
+        self.datastores = [
+            self._add(vim.Datastore, 'datastore-{}'.format(i), name)
+            for i, name in enumerate(inventory.datastores)]
+        self.datastores_by_name = dict(
+            zip(inventory.datastores, self.datastores))
+        self.clusters = dict(
+            (name, self._add(vim.ClusterComputeResource,
+                             'domain-c{}'.format(i), name))
+            for i, name in enumerate(inventory.clusters))
+        self.hosts = dict(
+            (name, self._add(vim.HostSystem, 'host-{}'.format(i),
+                             (name, self.clusters.get(cluster))))
+            for i, (name, cluster) in enumerate(inventory.hosts.items()))
+        self.folders = dict(
+            (name, self._add(vim.Folder, 'group-v{}'.format(i), name))
+            for i, name in enumerate(inventory.vm_folders))
+        self.content = vim.ServiceInstanceContent(
+            rootFolder=self._add(vim.Folder, 'group-d1', None),
+            viewManager=self._add(vim.view.ViewManager, 'ViewManager', None),
+            propertyCollector=self._add(
+                PC, 'propertyCollector', {'filters': []}),
+            sessionManager=self._add(
+                vim.SessionManager, 'SessionManager', None))
+
+    @property
+    def round_trips(self):
+        return sum(self.calls.values())
+
+    # changes to the inventory, these show up in property collector updates
+
+    def add_vm(self, vm):
+        self.vms.append(self._add(vim.VirtualMachine,
+                                  self._new_id('vm-added'), vm))
+
+    def update_vm(self, index, vm):
+        self.objects[self.vms[index]._moId] = vm
+
+    def remove_vm(self, index):
+        self.objects.pop(self.vms.pop(index)._moId)
+
+    def _add(self, moType, moId, record):
+        mo = moType(moId, self)
+        self.objects[moId] = record
+        return mo
+
+    def _new_id(self, prefix):
+        return '{}-{}'.format(prefix, next(self.ids))
+
+    def _request(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    # pyVmomi calls these for every method call & property access
+
+    def InvokeMethod(self, mo, info, args):
+        self._request(info.wsdlName)
+        handler = getattr(self, '_do_' + info.wsdlName, None)
+        if handler is None:
+            raise vmodl.fault.NotImplemented(
+                msg='{} is not simulated'.format(info.wsdlName))
+        return handler(mo, *args)
+
+    def InvokeAccessor(self, mo, info):
+        self._request('get:' + info.name)
+        return self._get(mo, info.name)
+
+    # properties
+
+    def _get(self, mo, name):
+        if isinstance(mo, vim.ServiceInstance):
+            return {'content': self.content}[name]
+        if mo._moId not in self.objects:
+            raise vmodl.fault.ManagedObjectNotFound(
+                msg='{} has been deleted'.format(mo._moId), obj=mo)
+        record = self.objects[mo._moId]
+        if isinstance(mo, vim.view.ContainerView):
+            return {'view': self._view(record)}[name]
+        if isinstance(mo, vim.VirtualMachine):
+            return self._get_vm(record, name)
+        if isinstance(mo, (vim.ResourcePool, vim.ClusterComputeResource)):
+            return {'name': record}[name]
+        if isinstance(mo, vim.HostSystem):
+            return {'name': record[0], 'parent': record[1]}[name]
+        if isinstance(mo, vim.Folder):
+            return {'name': record or 'Datacenters'}[name]
+        if isinstance(mo, vim.Datastore):
+            return self._get_datastore(mo, record, name)
+        if isinstance(mo, vim.Task):
+            return {'info': self._task_info(mo, record)}[name]
+        raise AttributeError(name)
+
+    def _get_path(self, mo, path):
+        # walks a property path like `summary.config.name`
+        parts = path.split('.')
+        val = self._get(mo, parts[0])
+        for part in parts[1:]:
+            if val is None:
+                break
+            val = getattr(val, part)
+        return val
+
+    def _get_vm(self, vm, name):
+        if name == 'name':
+            return vm.name
+        if name == 'resourcePool':
+            return self.pools.get(vm.resourcePool)
+        if name == 'runtime':
+            return vim.vm.RuntimeInfo(powerState=vm.state,
+                                      host=self.hosts.get(vm.host))
+        if name == 'parent':
+            return self.folders.get(vm.folder)
+        if name == 'datastore':
+            return [self.datastores_by_name[usage.datastore]
+                    for usage in vm.storage or []]
+        if name == 'layoutEx':
+            # a file for everything the VM has on each datastore
+            return vim.vm.FileLayoutEx(file=[
+                vim.vm.FileLayoutEx.FileInfo(
+                    key=i, type='diskExtent', size=usage.committed,
+                    name='[{}] {}/{}-flat.vmdk'.format(
+                        usage.datastore, vm.name, vm.name))
+                for i, usage in enumerate(vm.storage or [])])
+        if name == 'storage':
+            return vim.vm.StorageInfo(perDatastoreUsage=[
+                vim.vm.StorageInfo.UsageOnDatastore(
+                    datastore=self.datastores_by_name[usage.datastore],
+                    committed=usage.committed,
+                    uncommitted=usage.uncommitted,
+                    unshared=usage.committed)
+                for usage in vm.storage or []])
+        if name == 'summary':
+            return vim.vm.Summary(
+                config=vim.vm.Summary.ConfigSummary(
+                    name=vm.name, vmPathName=vm.path),
+                runtime=vim.vm.RuntimeInfo(powerState=vm.state),
+                guest=vim.vm.Summary.GuestSummary(ipAddress=vm.ip))
+        if name == 'config':
+            return vim.vm.ConfigInfo(hardware=vim.vm.VirtualHardware(
+                device=vim.vm.device.VirtualDevice.Array([
+                    vim.vm.device.VirtualDisk(
+                        key=2000 + i,
+                        deviceInfo=vim.Description(
+                            label=disk.label, summary=disk.summary),
+                        backing=Backing(
+                            fileName=disk.path,
+                            diskMode=disk.mode,
+                            thinProvisioned=disk.type == 'thin'),
+                        capacityInBytes=disk.size)
+                    for i, disk in enumerate(vm.disks)])))
+        raise AttributeError(name)
+
+    def _get_datastore(self, mo, name, prop):
+        if prop == 'name':
+            return name
+        if prop == 'browser':
+            moId = 'datastoreBrowser-' + mo._moId
+            if moId not in self.objects:
+                self._add(Browser, moId, name)
+            return Browser(moId, self)
+        if prop == 'summary':
+            used = sum(f.size for files in self.inventory.folders[name]
+                       .values() for f in files)
+            capacity = 1024 ** 5
+            return vim.Datastore.Summary(
+                datastore=mo, name=name, type='VMFS', accessible=True,
+                capacity=capacity, freeSpace=capacity - used, uncommitted=0)
+        raise AttributeError(prop)
+
+    def _task_info(self, mo, task):
+        info = vim.TaskInfo(key=task.moId, task=mo, state=task.state())
+        if info.state == vim.TaskInfo.State.success:
+            info.result = task.result
+        elif info.state == vim.TaskInfo.State.error:
+            info.error = vim.fault.RequestCanceled(msg='Task was cancelled') \
+                if task.cancelled else task.error
+        return info
+
+    # methods, named after the SOAP method
+
+    def _do_RetrieveServiceContent(self, si):
+        return self.content
+
+    def _do_Logout(self, sessionManager):
+        pass
+
+    def _view(self, types):
+        view = []
+        if vim.VirtualMachine in types:
+            view.extend(self.vms)
+        if vim.Datastore in types:
+            view.extend(self.datastores)
+        if vim.ResourcePool in types:
+            view.extend(self.pools.values())
+        return view
+
+    def _do_CreateContainerView(self, viewManager, container, types,
+                                recursive):
+        # views follow changes to the inventory, like the real thing
+        return self._add(vim.view.ContainerView,
+                         self._new_id('session[sim]view'), list(types))
+
+    def _do_DestroyView(self, view):
+        self.objects.pop(view._moId, None)
+
+    def _do_CreatePropertyCollector(self, pc):
+        return self._add(PC, self._new_id('session[sim]pc'),
+                         {'filters': [], 'version': ''})
+
+    def _do_DestroyPropertyCollector(self, pc):
+        self.objects.pop(pc._moId, None)
+
+    def _do_CreateFilter(self, pc, spec, partialUpdates):
+        f = PC.Filter(self._new_id('session[sim]filter'), self)
+        self.objects[pc._moId]['filters'].append((f, spec, {}))
+        return f
+
+    def _do_RetrievePropertiesEx(self, pc, specSet, options):
+        contents = []
+        for spec in specSet:
+            for mo in self._select(spec):
+                contents.append(PC.ObjectContent(
+                    obj=mo, propSet=self._props(mo, spec)))
+        return self._page(contents, options.maxObjects)
+
+    def _do_ContinueRetrievePropertiesEx(self, pc, token):
+        contents, maxObjects = self.objects.pop(token)
+        return self._page(contents, maxObjects)
+
+    def _page(self, contents, maxObjects):
+        if not contents:
+            return None
+        maxObjects = maxObjects or len(contents)
+        result = PC.RetrieveResult(objects=contents[:maxObjects])
+        if len(contents) > maxObjects:
+            result.token = self._new_id('token')
+            self.objects[result.token] = (contents[maxObjects:], maxObjects)
+        return result
+
+    def _select(self, spec):
+        """Lists the objects matched by a filter spec, in order"""
+        named = {}
+
+        def collect_names(selectSet):
+            for sel in selectSet or []:
+                if isinstance(sel, PC.TraversalSpec) and sel.name not in named:
+                    named[sel.name] = sel
+                    collect_names(sel.selectSet)
+
+        for objSpec in spec.objectSet:
+            collect_names(objSpec.selectSet)
+
+        found = OrderedDict()
+
+        def walk(mo, skip, selectSet):
+            if not skip:
+                found.setdefault(mo._moId, mo)
+            for sel in selectSet or []:
+                if not isinstance(sel, PC.TraversalSpec):
+                    sel = named[sel.name]
+                if not isinstance(mo, sel.type):
+                    continue
+                children = self._get_path(mo, sel.path)
+                if not isinstance(children, list):
+                    children = [children] if children is not None else []
+                for child in children:
+                    walk(child, sel.skip, sel.selectSet)
+
+        for objSpec in spec.objectSet:
+            walk(objSpec.obj, objSpec.skip, objSpec.selectSet)
+        return found.values()
+
+    def _props(self, mo, spec):
+        props = []
+        for propSpec in spec.propSet:
+            if not isinstance(mo, propSpec.type):
+                continue
+            for path in propSpec.pathSet or []:
+                val = self._get_path(mo, path)
+                if isinstance(val, list) and not hasattr(type(val), 'Item'):
+                    managed = val and isinstance(
+                        val[0], VmomiSupport.ManagedObject)
+                    val = VmomiSupport.ManagedObject.Array(val) if managed \
+                        else VmomiSupport.DataObject.Array(val)
+                props.append(vmodl.DynamicProperty(name=path, val=val))
+        return props
+
+    def _do_WaitForUpdatesEx(self, pc, version, options):
+        if pc._moId not in self.objects:
+            raise vmodl.fault.ManagedObjectNotFound(
+                msg='{} has been deleted'.format(pc._moId), obj=pc)
+        collector = self.objects[pc._moId]
+        if version != collector['version']:
+            raise vmodl.query.InvalidCollectorVersion(
+                msg='Unknown version {}'.format(version))
+        maxWait = options.maxWaitSeconds if options else None
+        maxUpdates = options.maxObjectUpdates if options else None
+        deadline = time.time() + maxWait if maxWait is not None else None
+        filters = collector['filters']
+        while True:
+            updates = []
+            truncated = False
+            count = 0
+            for f, spec, reported in filters:
+                objUpdates = []
+                selected = self._select(spec)
+                for mo in selected:
+                    if maxUpdates and count >= maxUpdates:
+                        truncated = True
+                        break
+                    changes = []
+                    entered = (mo._moId, None) not in reported
+                    reported[(mo._moId, None)] = mo
+                    record = self.objects.get(mo._moId)
+                    if not isinstance(record, SimTask) and \
+                            reported.get((mo._moId, _RECORD)) is record:
+                        continue  # the record hasn't been replaced
+                    reported[(mo._moId, _RECORD)] = record
+                    for prop in self._props(mo, spec):
+                        key = (mo._moId, prop.name)
+                        if key not in reported or \
+                                not _same(reported[key], prop.val):
+                            reported[key] = prop.val
+                            changes.append(PC.Change(
+                                name=prop.name, op='assign', val=prop.val))
+                    if changes or entered:
+                        count += 1
+                        objUpdates.append(PC.ObjectUpdate(
+                            kind='enter' if entered else 'modify',
+                            obj=mo, changeSet=changes))
+                # objects that are no longer selected have left
+                selectedIds = set(mo._moId for mo in selected)
+                for (moId, prop), mo in list(reported.items()):
+                    if prop is None and moId not in selectedIds and \
+                            not truncated:
+                        for key in [k for k in reported if k[0] == moId]:
+                            del reported[key]
+                        count += 1
+                        objUpdates.append(PC.ObjectUpdate(
+                            kind='leave', obj=mo, changeSet=[]))
+                if objUpdates:
+                    updates.append(PC.FilterUpdate(
+                        filter=f, objectSet=objUpdates))
+            if updates:
+                collector['version'] = self._new_id('version')
+                return PC.UpdateSet(version=collector['version'],
+                                    filterSet=updates, truncated=truncated)
+
+            # nothing has changed, sleep until the next task finishes
+            wake = [self.objects[mo._moId].finishes_at()
+                    for f, spec, reported in filters
+                    for mo in self._select(spec)
+                    if isinstance(self.objects.get(mo._moId), SimTask)]
+            now = time.time()
+            wake = min([w for w in wake if w > now] or [now + 1.0])
+            if deadline is not None:
+                if now >= deadline:
+                    return None
+                wake = min(wake, deadline)
+            time.sleep(max(0, wake - now))
+
+    def _do_CancelTask(self, task):
+        self.objects[task._moId].cancelled = True
+
+    # datastore browser
+
+    def _parse_path(self, datastorePath):
+        m = re.match(r'^\[(.*?)\]\s*(.*)$', datastorePath)
+        return m.group(1), m.group(2).strip().strip('/')
+
+    def _search_task(self, dsName, results, searched):
+        error = None
+        if dsName in self.failing_datastores:
+            error = vmodl.fault.SystemError(
+                msg='Simulated search failure on [{}]'.format(dsName),
+                reason='simulated')
+        duration = self.search_latency
+        if self.search_rate:
+            duration += float(searched) / self.search_rate
+        moId = self._new_id('task')
+        self.objects[moId] = SimTask(
+            moId, duration, Browser.SearchResults.Array(results), error)
+        return vim.Task(moId, self)
+
+    def _search_results(self, dsName, folder, files, searchSpec=None):
+        patterns = searchSpec and searchSpec.matchPattern
+        return Browser.SearchResults(
+            folderPath='[{}] {}/'.format(dsName, folder),
+            file=[Browser.FileInfo(path=f.fileName, fileSize=f.size)
+                  for f in files if not patterns or any(
+                      fnmatch.fnmatchcase(f.fileName, p) for p in patterns)])
+
+    def _root_listing(self, dsName, folders, searchSpec=None):
+        # folders with a UUID are listed under both names, like vSAN
+        patterns = searchSpec and searchSpec.matchPattern
+        infos = []
+        for name in folders:
+            infos.append(vim.FolderFileInfo(path=name))
+            uuid = self.inventory.uuids.get((dsName, name))
+            if uuid:
+                infos.append(vim.FolderFileInfo(path=uuid, friendlyName=name))
+        return Browser.SearchResults(
+            folderPath='[{}]'.format(dsName),
+            file=[f for f in infos if not patterns or any(
+                fnmatch.fnmatchcase(f.path, p) for p in patterns)])
+
+    def _do_SearchDatastoreSubFolders_Task(self, browser, datastorePath,
+                                           searchSpec=None):
+        dsName, folder = self._parse_path(datastorePath)
+        folders = self.inventory.folders.get(dsName, {})
+        results = []
+        if folder:
+            name = self.inventory.names.get((dsName, folder), folder)
+            results.append(self._search_results(
+                dsName, folder, folders.get(name, []), searchSpec))
+            searched = len(folders.get(name, []))
+        else:
+            results.append(self._root_listing(dsName, folders, searchSpec))
+            searched = 0
+            for name, files in folders.items():
+                results.append(self._search_results(
+                    dsName, name, files, searchSpec))
+                searched += len(files)
+                uuid = self.inventory.uuids.get((dsName, name))
+                if uuid:
+                    results.append(self._search_results(
+                        dsName, uuid, files, searchSpec))
+                    searched += len(files)
+        return self._search_task(dsName, results, searched)
+
+    def _do_SearchDatastore_Task(self, browser, datastorePath,
+                                 searchSpec=None):
+        dsName, folder = self._parse_path(datastorePath)
+        folders = self.inventory.folders.get(dsName, {})
+        if folder:
+            name = self.inventory.names.get((dsName, folder), folder)
+            result = self._search_results(
+                dsName, folder, folders.get(name, []), searchSpec)
+        else:
+            result = self._root_listing(dsName, folders, searchSpec)
+        task = self._search_task(dsName, [], len(result.file or []))
+        # a search of one folder has a single result, not a list
+        self.objects[task._moId].result = result
+        return task
+
+
+def sim_connect(inventory, **kwargs):
+    """Returns a service instance backed by a `SimStub`
+
+    Keyword args are passed on to `SimStub`.  The stub is available as
+    `si._stub`, for example to read `si._stub.round_trips`.
+    """
+    return vim.ServiceInstance('ServiceInstance', SimStub(inventory, **kwargs))
@@ -0,0 +1,113 @@
+"""Writes report records as CSV, NDJSON or JSON, as they're produced
+
+The reports print text for people to read once everything is collected.
+For other tools, `--format` writes each record as soon as the report has it
+instead, to `--output` or stdout, so a consumer can start on the records
+while the collection carries on.  Records are written one at a time and
+never kept, so memory use doesn't grow with the size of the report.
+
+A record is a dict with a value for each of the writer's fields.  Lists are
+kept as lists in NDJSON and JSON and joined with ` / ` in CSV.  JSON output
+is one array, written an element at a time.
+"""
+import csv
+import json
+import sys
+from collections import OrderedDict
+
+import six
+
+FORMATS = ['text', 'csv', 'ndjson', 'json']
+
+
+class RecordWriter:
+    """Writes records one at a time, each format defines `_write(record)`"""
+    def __init__(self, fields, out=None):
+        """Writes records with `fields` to the file `out`, or stdout"""
+        self.fields = fields
+        self.path = out
+        self.fp = open(out, 'w') if out and out != '-' else sys.stdout
+        self.count = 0
+
+    def write(self, record):
+        self._write(record)
+        self.count += 1
+        # so whoever is reading gets each record straight away
+        self.fp.flush()
+
+    def _ordered(self, record):
+        return OrderedDict((f, record.get(f)) for f in self.fields)
+
+    def close(self):
+        if self.fp is not sys.stdout:
+            self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CsvWriter(RecordWriter):
+    def __init__(self, fields, out=None):
+        RecordWriter.__init__(self, fields, out)
+        self.csv = csv.writer(self.fp)
+        self.csv.writerow(fields)
+
+    def _write(self, record):
+        self.csv.writerow([self._value(record.get(f)) for f in self.fields])
+
+    def _value(self, v):
+        if isinstance(v, (list, tuple)):
+            v = ' / '.join(six.text_type(i) for i in v)
+        if six.PY2 and isinstance(v, six.text_type):
+            # python 2's csv only writes bytes
+            v = v.encode('utf-8')
+        return v
+
+
+class NdjsonWriter(RecordWriter):
+    def _write(self, record):
+        self.fp.write(json.dumps(self._ordered(record)))
+        self.fp.write('\n')
+
+
+class JsonWriter(RecordWriter):
+    def _write(self, record):
+        self.fp.write(',\n' if self.count else '[\n')
+        self.fp.write(json.dumps(self._ordered(record)))
+
+    def close(self):
+        self.fp.write('\n]\n' if self.count else '[]\n')
+        RecordWriter.close(self)
+
+
+WRITERS = {
+    'csv': CsvWriter,
+    'ndjson': NdjsonWriter,
+    'json': JsonWriter,
+}
+
+
+def open_writer(args, fields):
+    """Returns the writer for `--format` and `--output`, None for text"""
+    if args.format == 'text':
+        return None
+    return WRITERS[args.format](fields, args.output)
+
+
+def add_arguments(ab):
+    """Adds `--format` and `--output` to an `ArgBuilder`"""
+    ab.add_argument(
+        '--format',
+        default='text',
+        choices=FORMATS,
+        action='store',
+        help='Print a report as text, or write records as they are found '
+             'in one of the other formats')
+    ab.add_argument(
+        '--output',
+        default=None,
+        action='store',
+        help='File to write records to, rather than stdout')